@@ -1,6 +1,9 @@
 from . import cg
 from . import sor
+from . import mg
 from . import version
+from .cache import FlowCache
+from .storage import FlowWriter, FlowReader
 from .version import module as __version__
 
 def get_config():
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Benchmarks for Liu's Optical Flow estimators
+
+Run it with::
+
+  $ python -m bob.ip.optflow.liu.bench
+
+Both variants (:py:func:`bob.ip.optflow.liu.sor.flow` and
+:py:func:`bob.ip.optflow.liu.cg.flow`) are timed on the bundled image pairs,
+resized by each of the given scales, with each of the given numbers of threads.
+Every configuration runs in a fresh process, and reports the number of frame
+pairs estimated per second (by ``flow_batch()``, over the given number of
+threads), the time taken by each stage of a single estimation and the peak
+resident memory of the process. Results are printed (or saved) as JSON. If a
+baseline (a JSON output of a previous run) is given, configurations whose
+throughput dropped by more than the given tolerance are reported, and the
+program exits with a non-zero status.
+
+With ``--kernels``, the matrix-vector product solved at each CG iteration (see
+:py:func:`bob.ip.optflow.liu.cg._multiply_a`) is timed instead, with its fused,
+single-pass, implementation and with the original (multi-pass) one, on systems
+built from the bundled (gray-scale) test images.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import multiprocessing
+import numpy
+import pkg_resources
+
+SAMPLES = (
+    'gray/car',
+    'gray/table',
+    'gray/complex',
+    'gray/simple',
+    'color/car',
+    'color/table',
+    'color/rubberwhale',
+    )
+
+KERNEL_SAMPLES = ('gray/car', 'gray/table', 'gray/complex')
+
+def load_pair(sample):
+  """Loads a pair of bundled images, as doubles in [0, 1]"""
+
+  import bob.io.base
+  import bob.io.image
+
+  def load(k):
+    name = os.path.join('data', '%s%d.png' % (sample, k))
+    filename = pkg_resources.resource_filename(__name__, name)
+    return bob.io.base.load(filename).astype('float64')/255.
+
+  return load(1), load(2)
+
+def resize(image, scale):
+  """Bilinearly resizes the last two dimensions of an image by ``scale``"""
+
+  def sample(size):
+    n = max(1, int(round(size*scale)))
+    x = numpy.clip((numpy.arange(n) + 0.5)/scale - 0.5, 0, size-1)
+    x0 = numpy.floor(x).astype(int)
+    x1 = numpy.minimum(x0 + 1, size-1)
+    return x0, x1, x - x0
+
+  y0, y1, dy = sample(image.shape[-2])
+  x0, x1, dx = sample(image.shape[-1])
+  rows = image[...,y0,:]*(1-dy)[:,None] + image[...,y1,:]*dy[:,None]
+  return numpy.ascontiguousarray(rows[...,x0]*(1-dx) + rows[...,x1]*dx)
+
+def cg_system(i1, i2):
+  """Builds a CG system (and search direction) similar to the one solved at
+  the finest level of :py:func:`bob.ip.optflow.liu.cg.flow`, from the
+  derivatives of the image pair"""
+
+  iy, ix = numpy.gradient(i1)
+  it = i2 - i1
+  weight = 1./numpy.sqrt(ix**2 + iy**2 + 1e-6)
+  a11 = ix*ix + 0.001
+  a12 = ix*iy
+  a22 = iy*iy + 0.001
+  return it*ix, it*iy, a11, a12, a22, weight
+
+def bench_multiply_a(sample, repeat, number):
+  """Times the fused and reference CG matrix-vector products, returning the
+  best time per call of each (in seconds) and the largest difference between
+  their results"""
+
+  from . import cg
+
+  args = cg_system(*load_pair(sample)) + (0.02,)
+  fused = cg._multiply_a(*args)
+  reference = cg._multiply_a(*args, reference=True)
+  diff = max(abs(fused[0] - reference[0]).max(),
+      abs(fused[1] - reference[1]).max(), abs(fused[2] - reference[2]))
+
+  t_fused = min(timeit.repeat(lambda: cg._multiply_a(*args), repeat=repeat,
+    number=number)) / number
+  t_reference = min(timeit.repeat(
+    lambda: cg._multiply_a(*args, reference=True), repeat=repeat,
+    number=number)) / number
+
+  return t_fused, t_reference, diff
+
+def peak_rss():
+  """Returns the peak resident memory of the current process, in megabytes"""
+
+  import resource
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin': return rss / 2.**20 #bytes
+  return rss / 2.**10 #kilobytes
+
+def best_time(function, repeat):
+  """Returns the best time (in seconds) of ``repeat`` calls to ``function``"""
+
+  retval = []
+  for k in range(repeat):
+    start = time.time()
+    function()
+    retval.append(time.time() - start)
+  return min(retval)
+
+def bench_flow(method, sample, scale, threads, pairs, repeat):
+  """Times an estimation variant (``'sor'`` or ``'cg'``) on a bundled image
+  pair, resized by ``scale``, returning a dictionary with the results.
+
+  The throughput (``pairs_per_second``) is the one of ``flow_batch()`` on a
+  stack of ``pairs+1`` frames (alternating both images), over ``threads``
+  threads. Stages are timed by profiling single calls to ``flow()`` (see its
+  ``profile`` argument), keeping the fastest one."""
+
+  from . import cg, sor
+  module = sor if method == 'sor' else cg
+
+  i1, i2 = [resize(k, scale) for k in load_pair(sample)]
+  frames = numpy.array([i1, i2] * (pairs//2 + 1))[:pairs+1]
+
+  t_batch = best_time(lambda: module.flow_batch(frames, n_threads=threads),
+      repeat)
+  profiles = [module.flow(i1, i2, profile=True)[-1] for k in range(repeat)]
+  profile = min(profiles, key=lambda k: k['total'])
+  stages = dict((k, v['time']) for k, v in profile['stages'].items())
+  stages['total'] = profile['total']
+
+  return dict(
+      method=method,
+      sample=sample,
+      scale=scale,
+      threads=threads,
+      shape=list(i1.shape),
+      pairs_per_second=pairs/t_batch,
+      stages=stages,
+      peak_rss=peak_rss(),
+      )
+
+def configuration(result):
+  """Returns the key of the configuration of a benchmark result"""
+
+  return (result['method'], result['sample'], result['scale'],
+      result['threads'])
+
+def compare(results, baseline, tolerance):
+  """Compares the throughput of ``results`` with the one of a ``baseline``
+  (both lists of results of :py:func:`bench_flow`), returning a list with
+  the comparison of every configuration found in both"""
+
+  reference = dict((configuration(k), k) for k in baseline)
+  retval = []
+  for result in results:
+    if configuration(result) not in reference: continue
+    before = reference[configuration(result)]['pairs_per_second']
+    ratio = result['pairs_per_second'] / before
+    retval.append(dict(
+      method=result['method'],
+      sample=result['sample'],
+      scale=result['scale'],
+      threads=result['threads'],
+      pairs_per_second=result['pairs_per_second'],
+      baseline=before,
+      ratio=ratio,
+      regression=ratio < 1. - tolerance,
+      ))
+  return retval
+
+def numbers(type):
+  """An argparse type for comma-separated lists of numbers"""
+
+  def convert(value):
+    try:
+      return [type(k) for k in value.split(',')]
+    except ValueError:
+      raise argparse.ArgumentTypeError("`%s' is not a comma-separated list of numbers" % value)
+
+  return convert
+
+def main(user_input=None):
+
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('-r', '--repeat', default=3, type=int, metavar='N',
+      help="Number of timing repetitions, of which the best is kept (defaults to %(default)s)")
+  parser.add_argument('-m', '--methods', default=['sor', 'cg'], type=lambda k: k.split(','), metavar='LIST',
+      help="Comma-separated list of variants to time (defaults to %s)" % 'sor,cg')
+  parser.add_argument('-s', '--scales', default=[1., 2.], type=numbers(float), metavar='LIST',
+      help="Comma-separated list of scales the images are resized by (defaults to %s)" % '1,2')
+  parser.add_argument('-t', '--threads', default=[1, 0], type=numbers(int), metavar='LIST',
+      help="Comma-separated list of numbers of threads. If smaller than 1, use one thread per available core (defaults to %s)" % '1,0')
+  parser.add_argument('-p', '--pairs', default=4, type=int, metavar='N',
+      help="Number of frame pairs estimated to measure the throughput (defaults to %(default)s)")
+  parser.add_argument('-o', '--output', metavar='FILE',
+      help="Saves results to this (JSON) file, instead of printing them")
+  parser.add_argument('-b', '--baseline', metavar='FILE',
+      help="Compares results with the ones of this (JSON) file, e.g. saved with --output by a previous run")
+  parser.add_argument('--tolerance', default=0.1, type=float, metavar='FLOAT',
+      help="Largest relative drop of throughput, compared to the baseline, not reported as a regression (defaults to %(default)s)")
+  parser.add_argument('-n', '--number', default=20, type=int, metavar='N',
+      help="Number of calls per timing repetition, with --kernels (defaults to %(default)s)")
+  parser.add_argument('--kernels', default=False, action='store_true',
+      help="Times the CG matrix-vector product instead of whole estimations")
+  parser.add_argument('samples', metavar='SAMPLE', nargs='*',
+      help="Bundled image pairs to use (defaults to %s, or to %s with --kernels)" % (', '.join(SAMPLES), ', '.join(KERNEL_SAMPLES)))
+  args = parser.parse_args(args=user_input)
+
+  for method in args.methods:
+    if method not in ('sor', 'cg'):
+      parser.error("unknown variant `%s' (choose from sor, cg)" % method)
+  for scale in args.scales:
+    if scale <= 0: parser.error("scales must be positive")
+  if args.pairs < 1: parser.error("--pairs must be at least 1")
+
+  if args.kernels:
+    sys.stdout.write('%-14s %12s %12s %8s %10s\n' % ('sample',
+      'fused [ms]', 'ref. [ms]', 'speedup', 'max. diff'))
+    for sample in args.samples or KERNEL_SAMPLES:
+      t_fused, t_reference, diff = bench_multiply_a(sample, args.repeat,
+          args.number)
+      sys.stdout.write('%-14s %12.3f %12.3f %7.2fx %10.3g\n' % (sample,
+        1e3*t_fused, 1e3*t_reference, t_reference/t_fused, diff))
+    return 0
+
+  from .version import module as version
+
+  # every configuration runs in a fresh process, so its peak memory usage is
+  # not the one of a previous configuration
+  results = []
+  pool = multiprocessing.Pool(1, maxtasksperchild=1)
+  try:
+    for sample in args.samples or SAMPLES:
+      for method in args.methods:
+        for scale in args.scales:
+          for threads in args.threads:
+            results.append(pool.apply(bench_flow, (method, sample, scale,
+              threads, args.pairs, args.repeat)))
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+  report = dict(
+      version=version,
+      python=platform.python_version(),
+      machine=platform.machine(),
+      cpu_count=multiprocessing.cpu_count(),
+      repeat=args.repeat,
+      pairs=args.pairs,
+      results=results,
+      )
+
+  regressions = []
+  if args.baseline:
+    with open(args.baseline, 'rt') as f:
+      baseline = json.load(f)['results']
+    report['comparison'] = compare(results, baseline, args.tolerance)
+    regressions = [k for k in report['comparison'] if k['regression']]
+
+  if args.output:
+    with open(args.output, 'wt') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+  for k in regressions:
+    sys.stderr.write("Regression: %s on %s (scale %g, %d thread(s)): %.3g pairs/s, %.3g before (%.0f%%)\n" % (k['method'], k['sample'], k['scale'], k['threads'], k['pairs_per_second'], k['baseline'], 100*k['ratio']))
+
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
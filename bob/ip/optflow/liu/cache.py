@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""An on-disk cache of optical flow estimations"""
+
+import os
+import errno
+import shutil
+import hashlib
+import threading
+import numpy
+
+# flow() arguments that do not change the estimated flows
+_IGNORED = ('n_threads', 'workspace', 'out')
+
+# flow() arguments whose outputs are not cached
+_UNSUPPORTED = ('return_iterations', 'return_pyramid', 'profile')
+
+# file of an estimation holding its number of outputs, written last
+_COUNT = 'outputs'
+
+class FlowCache(object):
+  """An on-disk cache of the outputs of :py:func:`bob.ip.optflow.liu.sor.flow`
+  and :py:func:`bob.ip.optflow.liu.cg.flow`
+
+  Estimations are keyed on a hash of the two input images, of the method and of
+  its parameters (as given, so passing the default value of a parameter
+  explicitly gives another key), and of the version of this package. The
+  outputs of each estimation are stored as ``.npy`` files, in a directory of
+  their own together with their number, and are returned as read-only
+  memory-mapped arrays when found in the cache.
+
+  If ``max_size`` is given, the least recently used estimations are removed
+  once the cache takes more than ``max_size`` bytes. Several processes (and
+  threads) may share the same cache directory.
+
+  Parameters:
+
+  directory
+    The directory holding the cache (created if it does not exist)
+
+  max_size
+    [optional] The largest size of the cache, in bytes. By default, the cache
+    is not limited.
+  """
+
+  def __init__(self, directory, max_size=None):
+    self.directory = directory
+    self.max_size = max_size
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as exc:
+        if exc.errno != errno.EEXIST: raise
+    self.size = sum(size for (path, size, mtime) in self.entries())
+
+  def key(self, method, i1, i2, kwargs):
+    """Returns the key (a hexadecimal string) of the estimation of ``method``
+    on ``i1`` and ``i2`` with parameters ``kwargs``"""
+
+    from .version import module as version
+
+    h = hashlib.sha256()
+    h.update(('%s.%s %s;' % (method.__module__, method.__name__,
+      version)).encode('utf-8'))
+
+    arrays = [i1, i2]
+    for name in sorted(kwargs):
+      value = kwargs[name]
+      if name in _IGNORED: continue
+      if name == 'init_flow' and value is not None:
+        arrays.extend(value)
+        value = 'given'
+      h.update(('%s=%r;' % (name, value)).encode('utf-8'))
+
+    for array in arrays:
+      array = numpy.ascontiguousarray(array)
+      h.update(('%s%s;' % (array.dtype.str, array.shape)).encode('utf-8'))
+      h.update(array)
+
+    return h.hexdigest()
+
+  def path(self, key):
+    """Returns the directory of the estimation of a given key"""
+
+    return os.path.join(self.directory, key[:2], key)
+
+  def load(self, key):
+    """Returns the (memory-mapped) outputs of the estimation of a given key, or
+    ``None`` if it is not in the cache (or not completely, while another
+    process evicts it)"""
+
+    path = self.path(key)
+    try:
+      with open(os.path.join(path, _COUNT)) as f: n = int(f.read())
+      outputs = tuple(numpy.load(os.path.join(path, '%d.npy' % k),
+        mmap_mode='r') for k in range(n))
+      os.utime(path, None) #the estimation was used last
+    except (IOError, OSError, ValueError):
+      #not in the cache, or just (or being) evicted by another process
+      return None
+    return outputs if outputs else None
+
+  def store(self, key, outputs):
+    """Stores the outputs of the estimation of a given key, evicting the least
+    recently used estimations if the cache gets too large"""
+
+    path = self.path(key)
+    temporary = '%s.%d.%d.tmp' % (path, os.getpid(),
+        threading.current_thread().ident)
+    if os.path.exists(temporary): shutil.rmtree(temporary)
+    os.makedirs(temporary)
+    size = 0
+    for k, output in enumerate(outputs):
+      filename = os.path.join(temporary, '%d.npy' % k)
+      numpy.save(filename, output)
+      size += os.path.getsize(filename)
+    filename = os.path.join(temporary, _COUNT)
+    with open(filename, 'w') as f: f.write('%d' % len(outputs))
+    size += os.path.getsize(filename)
+
+    try:
+      os.rename(temporary, path)
+    except OSError:
+      #stored by another process (or thread) in the meanwhile
+      shutil.rmtree(temporary, ignore_errors=True)
+      return
+
+    self.size += size
+    if self.max_size is not None and self.size > self.max_size:
+      self.evict(self.max_size)
+
+  def entries(self):
+    """Returns a list of tuples ``(path, size, mtime)`` describing all
+    estimations in the cache"""
+
+    retval = []
+    for prefix in os.listdir(self.directory):
+      directory = os.path.join(self.directory, prefix)
+      if not os.path.isdir(directory): continue
+      for key in os.listdir(directory):
+        if key.endswith('.tmp'): continue
+        path = os.path.join(directory, key)
+        try:
+          mtime = os.path.getmtime(path)
+          size = sum(os.path.getsize(os.path.join(path, k))
+              for k in os.listdir(path))
+        except OSError:
+          continue #evicted by another process
+        retval.append((path, size, mtime))
+    return retval
+
+  def evict(self, max_size=0):
+    """Removes the least recently used estimations, until the cache takes at
+    most ``max_size`` bytes (by default, removes all estimations)"""
+
+    entries = sorted(self.entries(), key=lambda k: k[2])
+    self.size = sum(size for (path, size, mtime) in entries)
+    for path, size, mtime in entries:
+      if self.size <= max_size: break
+      shutil.rmtree(path, ignore_errors=True)
+      self.size -= size
+
+  def flow(self, method, i1, i2, **kwargs):
+    """Returns the outputs of ``method(i1, i2, **kwargs)``, loading them from
+    the cache if the same estimation was stored before, or running (and
+    storing) it otherwise
+
+    ``method`` is either :py:func:`bob.ip.optflow.liu.sor.flow` or
+    :py:func:`bob.ip.optflow.liu.cg.flow`. The number of iterations, the
+    velocities at every pyramid level and the profile of the estimation are
+    not cached, so ``return_iterations``, ``return_pyramid`` and ``profile``
+    may not be set. If ``out`` is given, cached velocities are copied into its
+    arrays.
+    """
+
+    for name in _UNSUPPORTED:
+      if kwargs.get(name):
+        raise ValueError("`%s' is not supported by the cache" % name)
+
+    key = self.key(method, i1, i2, kwargs)
+    outputs = self.load(key)
+
+    if outputs is None:
+      outputs = method(i1, i2, **kwargs)
+      self.store(key, outputs)
+      return outputs
+
+    out = kwargs.get('out')
+    if out is not None:
+      out[0][...] = outputs[0]
+      out[1][...] = outputs[1]
+      outputs = tuple(out) + outputs[2:]
+
+    return outputs
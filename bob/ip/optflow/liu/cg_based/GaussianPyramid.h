@@ -5,19 +5,30 @@
 
 namespace cg {
 
-  class GaussianPyramid
+  template <class T>
+  class GaussianPyramidT
   {
+    public:
+      typedef cg::Image<T> TImage;
     private:
-      DImage* ImPyramid;
+      TImage* ImPyramid;
       int nLevels;
     public:
-      GaussianPyramid(void);
-      ~GaussianPyramid(void);
-      void ConstructPyramid(const DImage& image,double ratio=0.8,int minWidth=30);
+      GaussianPyramidT(void);
+      ~GaussianPyramidT(void);
+      // if fast is set, each level is smoothed and downsampled from the
+      // previous one (see ConstructPyramidFast())
+      void ConstructPyramid(const TImage& image,double ratio=0.8,int minWidth=30,bool fast=false);
+      void ConstructPyramidLevels(const TImage& image,double ratio =0.8,int _nLevels = 2);
+    private:
+      void ConstructPyramidFast(const TImage& image,double ratio);
+    public:
       inline int nlevels() const {return nLevels;};
-      inline DImage& Image(int index) {return ImPyramid[index];};
+      inline TImage& Image(int index) {return ImPyramid[index];};
   };
 
+  typedef GaussianPyramidT<double> GaussianPyramid;
+
 }
 
 #endif
@@ -96,6 +96,11 @@ namespace cg {
         template <class T1>
           void GaussianSmoothing(Image<T1>& image,double sigma,int fsize) const;
 
+        // Gaussian smoothing followed by resizing to dstWidth x dstHeight, in
+        // a single (separable) pass. temp is used for the intermediate result
+        template <class T1>
+          void GaussianSmoothingResize(Image<T1>& image,double sigma,int fsize,int dstWidth,int dstHeight,Image<T1>& temp) const;
+
         template <class T1>
           void smoothing(Image<T1>& image,double factor=4);
 
@@ -120,6 +125,11 @@ namespace cg {
         template <class T1>
           void imfilter_hv(Image<T1>& image,double* hfilter,int hfsize,double* vfilter,int vfsize) const;
 
+        // same as above, using temp for the intermediate (horizontally
+        // filtered) image instead of a temporary buffer
+        template <class T1>
+          void imfilter_hv(Image<T1>& image,double* hfilter,int hfsize,double* vfilter,int vfsize,Image<T1>& temp) const;
+
         // function to desaturating
         template <class T1>
           void desaturate(Image<T1>& image) const;
@@ -238,6 +248,18 @@ namespace cg {
   template <class T>
     void Image<T>::allocate(int width,int height,int nchannels)
     {
+      // re-uses the current buffer if it holds as many elements, so images
+      // that are re-allocated over and over (e.g. the temporary images of a
+      // workspace) keep the same memory
+      if(pData!=NULL && nElements>0 && width*height*nchannels==nElements)
+      {
+        imWidth=width;
+        imHeight=height;
+        nChannels=nchannels;
+        computeDimension();
+        memset(pData,0,sizeof(T)*nElements);
+        return;
+      }
       clear();
       imWidth=width;
       imHeight=height;
@@ -465,7 +487,7 @@ namespace cg {
   template <class T>
     void Image<T>::imresize(int dstWidth,int dstHeight)
     {
-      DImage foo(dstWidth,dstHeight,nChannels);
+      Image<T> foo(dstWidth,dstHeight,nChannels);
       ImageProcessing::ResizeImage(pData,foo.data(),imWidth,imHeight,nChannels,dstWidth,dstHeight);
       copyData(foo);
     }
@@ -574,6 +596,32 @@ namespace cg {
       delete[] gFilter;
     }
 
+  template <class T>
+    template <class T1>
+    void Image<T>::GaussianSmoothingResize(Image<T1>& image,double sigma,int fsize,int dstWidth,int dstHeight,Image<T1>& temp) const
+    {
+      // constructing the 1D gaussian filter
+      double* gFilter;
+      gFilter=new double[fsize*2+1];
+      double sum=0;
+      sigma=sigma*sigma*2;
+      for(int i=-fsize;i<=fsize;i++)
+      {
+        gFilter[i+fsize]=exp(-(double)(i*i)/sigma);
+        sum+=gFilter[i+fsize];
+      }
+      for(int i=0;i<2*fsize+1;i++)
+        gFilter[i]/=sum;
+
+      if(image.width()!=dstWidth || image.height()!=dstHeight || image.nchannels()!=nChannels)
+        image.allocate(dstWidth,dstHeight,nChannels);
+      if(temp.width()!=dstWidth || temp.height()!=imHeight || temp.nchannels()!=nChannels)
+        temp.allocate(dstWidth,imHeight,nChannels);
+      ImageProcessing::SmoothResizeImage(pData,image.data(),imWidth,imHeight,nChannels,dstWidth,dstHeight,gFilter,fsize,temp.data());
+
+      delete[] gFilter;
+    }
+
   //------------------------------------------------------------------------------------------
   // function to smooth the image using a simple 3x3 filter
   // the filter is [1 factor 1]/(factor+2), applied horizontally and vertically
@@ -664,6 +712,18 @@ namespace cg {
       delete[] pTempBuffer;
     }
 
+  template <class T>
+    template <class T1>
+    void Image<T>::imfilter_hv(Image<T1> &image, double *hfilter, int hfsize, double *vfilter, int vfsize, Image<T1> &temp) const
+    {
+      if(matchDimension(image)==false)
+        image.allocate(imWidth,imHeight,nChannels);
+      if(matchDimension(temp)==false)
+        temp.allocate(imWidth,imHeight,nChannels);
+      ImageProcessing::hfiltering(pData,temp.data(),imWidth,imHeight,nChannels,hfilter,hfsize);
+      ImageProcessing::vfiltering(temp.data(),image.data(),imWidth,imHeight,nChannels,vfilter,vfsize);
+    }
+
   //------------------------------------------------------------------------------------------
   //	 function for desaturation
   //------------------------------------------------------------------------------------------
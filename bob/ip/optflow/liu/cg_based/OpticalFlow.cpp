@@ -3,33 +3,42 @@
 #include "GaussianPyramid.h"
 #include <cstdlib> 
 #include <iostream>
+#include "../dataterm.h"
 
 using namespace std;
+using bob::ip::optflow::liu::ProfileTimer;
 
 #ifndef _MATLAB
-	bool cg::OpticalFlow::IsDisplay=true;
+	template <class T>
+	bool cg::OpticalFlowT<T>::IsDisplay=true;
 #else
-	bool cg::OpticalFlow::IsDisplay=false;
+	template <class T>
+	bool cg::OpticalFlowT<T>::IsDisplay=false;
 #endif
 
-cg::OpticalFlow::OpticalFlow(void)
+template <class T>
+cg::OpticalFlowT<T>::OpticalFlowT(void)
 {
 }
 
-cg::OpticalFlow::~OpticalFlow(void)
+template <class T>
+cg::OpticalFlowT<T>::~OpticalFlowT(void)
 {
 }
 
 //--------------------------------------------------------------------------------------------------------
 //  function to compute dx, dy and dt for motion estimation
 //--------------------------------------------------------------------------------------------------------
-void cg::OpticalFlow::getDxs(cg::DImage &imdx, cg::DImage &imdy, cg::DImage &imdt, const cg::DImage &im1, const cg::DImage &im2)
+template <class T>
+void cg::OpticalFlowT<T>::getDxs(TImage &imdx, TImage &imdy, TImage &imdt, const TImage &im1, const TImage &im2, LevelBuffers* buffers)
 {
 	// Im1 and Im2 are the smoothed version of im1 and im2
-	cg::DImage Im1,Im2;
+	LevelBuffers localBuffers;
+	LevelBuffers& b=(buffers!=NULL)?*buffers:localBuffers;
+	TImage &Im1=b.smooth1,&Im2=b.smooth2;
 	double gfilter[5]={0.05,0.2,0.5,0.2,0.05};
-	im1.imfilter_hv(Im1,gfilter,2,gfilter,2);
-	im2.imfilter_hv(Im2,gfilter,2,gfilter,2);
+	im1.imfilter_hv(Im1,gfilter,2,gfilter,2,b.filter);
+	im2.imfilter_hv(Im2,gfilter,2,gfilter,2,b.filter);
 
     //Im1.copyData(im1);
     //Im2.copyData(im2);
@@ -45,14 +54,15 @@ void cg::OpticalFlow::getDxs(cg::DImage &imdx, cg::DImage &imdy, cg::DImage &imd
 //--------------------------------------------------------------------------------------------------------
 // function to do sanity check: imdx*du+imdy*dy+imdt=0
 //--------------------------------------------------------------------------------------------------------
-void cg::OpticalFlow::SanityCheck(const cg::DImage &imdx, const cg::DImage &imdy, const cg::DImage &imdt, double du, double dv)
+template <class T>
+void cg::OpticalFlowT<T>::SanityCheck(const TImage &imdx, const TImage &imdy, const TImage &imdt, double du, double dv)
 {
 	if(imdx.matchDimension(imdy)==false || imdx.matchDimension(imdt)==false)
 	{
 		cout<<"The dimensions of the derivatives don't match!"<<endl;
 		return;
 	}
-	const double* pImDx,*pImDy,*pImDt;
+	const T* pImDx,*pImDy,*pImDt;
 	pImDx=imdx.data();
 	pImDy=imdy.data();
 	pImDt=imdt.data();
@@ -72,7 +82,8 @@ void cg::OpticalFlow::SanityCheck(const cg::DImage &imdx, const cg::DImage &imdy
 //--------------------------------------------------------------------------------------------------------
 // function to warp image based on the flow field
 //--------------------------------------------------------------------------------------------------------
-void cg::OpticalFlow::warpFL(cg::DImage &warpIm2, const cg::DImage &Im1, const cg::DImage &Im2, const cg::DImage &vx, const cg::DImage &vy)
+template <class T>
+void cg::OpticalFlowT<T>::warpFL(TImage &warpIm2, const TImage &Im1, const TImage &Im2, const TImage &vx, const TImage &vy)
 {
 	if(warpIm2.matchDimension(Im2)==false)
 		warpIm2.allocate(Im2.width(),Im2.height(),Im2.nchannels());
@@ -82,15 +93,16 @@ void cg::OpticalFlow::warpFL(cg::DImage &warpIm2, const cg::DImage &Im1, const c
 //--------------------------------------------------------------------------------------------------------
 // function to generate mask of the pixels that move inside the image boundary
 //--------------------------------------------------------------------------------------------------------
-void cg::OpticalFlow::genInImageMask(cg::DImage &mask, const cg::DImage &vx, const cg::DImage &vy)
+template <class T>
+void cg::OpticalFlowT<T>::genInImageMask(TImage &mask, const TImage &vx, const TImage &vy)
 {
 	int imWidth,imHeight;
 	imWidth=vx.width();
 	imHeight=vx.height();
 	if(mask.matchDimension(vx)==false)
 		mask.allocate(imWidth,imHeight);
-	const double *pVx,*pVy;
-	double *pMask;
+	const T *pVx,*pVy;
+	T *pMask;
 	pVx=vx.data();
 	pVy=vy.data();
 	mask.reset();
@@ -108,6 +120,66 @@ void cg::OpticalFlow::genInImageMask(cg::DImage &mask, const cg::DImage &vx, con
 		}
 }
 
+//--------------------------------------------------------------------------------------------------------
+// output=input1+input2*ratio and output+=input*ratio, computed in the precision
+// of the images (Image::Add() computes in double), for the conjugate gradient
+// iterations
+//--------------------------------------------------------------------------------------------------------
+template <class T>
+static inline void addScaled(cg::Image<T>& output,const cg::Image<T>& input1,const cg::Image<T>& input2,T ratio)
+{
+	T* pOutput=output.data();
+	const T *pInput1=input1.data(),*pInput2=input2.data();
+	for(int i=0;i<output.nelements();i++)
+		pOutput[i]=pInput1[i]+pInput2[i]*ratio;
+}
+
+template <class T>
+static inline void addScaled(cg::Image<T>& output,const cg::Image<T>& input,T ratio)
+{
+	T* pOutput=output.data();
+	const T* pInput=input.data();
+	for(int i=0;i<output.nelements();i++)
+		pOutput[i]+=pInput[i]*ratio;
+}
+
+//--------------------------------------------------------------------------------------------------------
+// the sum of x[i]*y[i], in double. Products of double images are summed in
+// pixel order, as Image::innerproduct() does, so results do not change. Those
+// of float images are summed into four partial sums, so that the additions do
+// not wait for each other (which leaves float images no faster than double
+// ones otherwise)
+//--------------------------------------------------------------------------------------------------------
+static inline double dotProduct(const double* x,const double* y,int n)
+{
+	double result=0;
+	for(int i=0;i<n;i++)
+		result+=x[i]*y[i];
+	return result;
+}
+
+static inline double dotProduct(const float* x,const float* y,int n)
+{
+	double s0=0,s1=0,s2=0,s3=0;
+	int i=0;
+	for(;i+3<n;i+=4)
+	{
+		s0+=x[i]*y[i];
+		s1+=x[i+1]*y[i+1];
+		s2+=x[i+2]*y[i+2];
+		s3+=x[i+3]*y[i+3];
+	}
+	for(;i<n;i++)
+		s0+=x[i]*y[i];
+	return (s0+s1)+(s2+s3);
+}
+
+template <class T>
+static inline double norm2(const cg::Image<T>& image)
+{
+	return dotProduct(image.data(),image.data(),image.nelements());
+}
+
 //--------------------------------------------------------------------------------------------------------
 // function to compute optical flow field using two fixed point iterations
 // Input arguments:
@@ -116,32 +188,53 @@ void cg::OpticalFlow::genInImageMask(cg::DImage &mask, const cg::DImage &vx, con
 //	u,v:									the current flow field, NOTICE that they are also output arguments
 //	
 //--------------------------------------------------------------------------------------------------------
-void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2, cg::DImage &warpIm2, cg::DImage &u, cg::DImage &v, 
-																    double alpha, int nOuterFPIterations, int nInnerFPIterations, int nCGIterations)
+template <class T>
+int cg::OpticalFlowT<T>::SmoothFlowPDE(const TImage &Im1, const TImage &Im2, TImage &warpIm2, TImage &u, TImage &v, 
+																    double alpha, int nOuterFPIterations, int nInnerFPIterations, int nCGIterations, double tolerance,
+																    LevelBuffers* buffers, Profile* profile)
 {
-	cg::DImage mask,imdx,imdy,imdt;
+	int nIterations=0;
+	double tolerance2=tolerance*tolerance;
+
+	// the temporary images are either given or local to this call
+	LevelBuffers localBuffers;
+	LevelBuffers& b=(buffers!=NULL)?*buffers:localBuffers;
+
+	TImage &mask=b.mask,&imdx=b.imdx,&imdy=b.imdy,&imdt=b.imdt;
 	int imWidth,imHeight,nChannels,nPixels;
 	imWidth=Im1.width();
 	imHeight=Im1.height();
 	nChannels=Im1.nchannels();
 	nPixels=imWidth*imHeight;
 
-	cg::DImage du(imWidth,imHeight),dv(imWidth,imHeight);
-	cg::DImage uu(imWidth,imHeight),vv(imWidth,imHeight);
-	cg::DImage ux(imWidth,imHeight),uy(imWidth,imHeight);
-	cg::DImage vx(imWidth,imHeight),vy(imWidth,imHeight);
-	cg::DImage Phi_1st(imWidth,imHeight);
-	cg::DImage Psi_1st(imWidth,imHeight,nChannels);
-
-	cg::DImage imdxy,imdx2,imdy2,imdtdx,imdtdy;
-	cg::DImage ImDxy,ImDx2,ImDy2,ImDtDx,ImDtDy;
-	cg::DImage A11,A12,A22,b1,b2;
-	cg::DImage foo1,foo2;
+	TImage &du=b.du,&dv=b.dv;
+	TImage &uu=b.uu,&vv=b.vv;
+	TImage &ux=b.ux,&uy=b.uy;
+	TImage &vx=b.vx,&vy=b.vy;
+	TImage &Phi_1st=b.Phi_1st;
+	du.allocate(imWidth,imHeight);
+	dv.allocate(imWidth,imHeight);
+	uu.allocate(imWidth,imHeight);
+	vv.allocate(imWidth,imHeight);
+	ux.allocate(imWidth,imHeight);
+	uy.allocate(imWidth,imHeight);
+	vx.allocate(imWidth,imHeight);
+	vy.allocate(imWidth,imHeight);
+	Phi_1st.allocate(imWidth,imHeight);
+
+	TImage &imdxy=b.imdxy,&imdx2=b.imdx2,&imdy2=b.imdy2,&imdtdx=b.imdtdx,&imdtdy=b.imdtdy;
+	imdxy.allocate(imWidth,imHeight);
+	imdx2.allocate(imWidth,imHeight);
+	imdy2.allocate(imWidth,imHeight);
+	imdtdx.allocate(imWidth,imHeight);
+	imdtdy.allocate(imWidth,imHeight);
+	TImage &A11=b.A11,&A12=b.A12,&A22=b.A22,&b1=b.b1,&b2=b.b2;
+	TImage &foo1=b.foo1,&foo2=b.foo2;
 
 	// variables for conjugate gradient
-	cg::DImage r1,r2,p1,p2,q1,q2;
-	double* rou;
-	rou=new double[nCGIterations];
+	TImage &r1=b.r1,&r2=b.r2,&p1=b.p1,&p2=b.p2,&q1=b.q1,&q2=b.q2;
+	b.rou.resize(nCGIterations);
+	double* rou=b.rou.data();
 
 	double varepsilon_phi=pow(0.001,2);
 	double varepsilon_psi=pow(0.001,2);
@@ -152,10 +245,12 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 	for(int count=0;count<nOuterFPIterations;count++)
 	{
 		// compute the gradient
-		getDxs(imdx,imdy,imdt,Im1,warpIm2);
+		ProfileTimer getDxsTimer(profile,"getDxs");
+		getDxs(imdx,imdy,imdt,Im1,warpIm2,&b);
 
 		// generate the mask to set the weight of the pxiels moving outside of the image boundary to be zero
 		genInImageMask(mask,vx,vy);
+		getDxsTimer.stop();
 
 		// set the derivative of the flow field to be zero
 		du.reset();
@@ -166,6 +261,9 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 		//--------------------------------------------------------------------------
 		for(int hh=0;hh<nInnerFPIterations;hh++)
 		{
+			// the robust weights and the linear system
+			ProfileTimer weightsTimer(profile,"weights");
+
 			// compute the derivatives of the current flow field
 			if(hh==0)
 			{
@@ -184,9 +282,10 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 
 			// compute the weight of phi
 			Phi_1st.reset();
-			double* phiData=Phi_1st.data();
-			double temp;
-			const double *uxData,*uyData,*vxData,*vyData;
+			T* phiData=Phi_1st.data();
+			T temp;
+			const T epsilonPhi=varepsilon_phi;
+			const T *uxData,*uyData,*vxData,*vyData;
 			uxData=ux.data();
 			uyData=uy.data();
 			vxData=vx.data();
@@ -194,66 +293,15 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 			for(int i=0;i<nPixels;i++)
 			{
 				temp=uxData[i]*uxData[i]+uyData[i]*uyData[i]+vxData[i]*vxData[i]+vyData[i]*vyData[i];
-				phiData[i]=1/(2*sqrt(temp+varepsilon_phi));
-			}
-
-			// compute the nonlinear term of psi
-			Psi_1st.reset();
-			double* psiData=Psi_1st.data();
-			const double *imdxData,*imdyData,*imdtData;
-			const double *duData,*dvData;
-			imdxData=imdx.data();
-			imdyData=imdy.data();
-			imdtData=imdt.data();
-			duData=du.data();
-			dvData=dv.data();
-		
-			if(nChannels==1)
-			{
-				for(int i=0;i<nPixels;i++)
-				{
-					temp=imdtData[i]+imdxData[i]*duData[i]+imdyData[i]*dvData[i];
-					//if(temp*temp<0.04)
-					psiData[i]=1/(2*sqrt(temp*temp+varepsilon_psi));
-					//psiData[i] = _a*_b/(1+_a*temp*temp);
-				}
+				phiData[i]=1/(2*std::sqrt(temp+epsilonPhi));
 			}
-			else
-			{
-				for(int i=0;i<nPixels;i++)
-					for(int k=0;k<nChannels;k++)
-					{
-						int offset=i*nChannels+k;
-						temp=imdtData[offset]+imdxData[offset]*duData[i]+imdyData[offset]*dvData[i];
-						//if(temp*temp<0.04)
-						psiData[offset]=1/(2*sqrt(temp*temp+varepsilon_psi));
-						//psiData[offset] =  _a*_b/(1+_a*temp*temp);
-					}
-			}
-
-			// prepare the components of the large linear system
-			ImDxy.Multiply(Psi_1st,imdx,imdy);
-			ImDx2.Multiply(Psi_1st,imdx,imdx);
-			ImDy2.Multiply(Psi_1st,imdy,imdy);
-			ImDtDx.Multiply(Psi_1st,imdx,imdt);
-			ImDtDy.Multiply(Psi_1st,imdy,imdt);
 
-			if(nChannels>1)
-			{
-				ImDxy.collapse(imdxy);
-				ImDx2.collapse(imdx2);
-				ImDy2.collapse(imdy2);
-				ImDtDx.collapse(imdtdx);
-				ImDtDy.collapse(imdtdy);
-			}
-			else
-			{
-				imdxy.copyData(ImDxy);
-				imdx2.copyData(ImDx2);
-				imdy2.copyData(ImDy2);
-				imdtdx.copyData(ImDtDx);
-				imdtdy.copyData(ImDtDy);
-			}
+			// the nonlinear term of psi and the (channel averaged) components of
+			// the large linear system, in a single pass specialized per number of
+			// channels
+			bob::ip::optflow::liu::assemble_data_term(nPixels,nChannels,imdx.data(),imdy.data(),imdt.data(),
+					du.data(),dv.data(),bob::ip::optflow::liu::L1Weight(varepsilon_psi),
+					imdxy.data(),imdx2.data(),imdy2.data(),imdtdx.data(),imdtdy.data());
 
 			// filtering
 			imdx2.smoothing(A11,3);
@@ -270,17 +318,18 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 			// laplacian filtering of the current flow field
 		    Laplacian(foo1,u,Phi_1st);
 			Laplacian(foo2,v,Phi_1st);
-			double *b1Data,*b2Data;
-			const double *foo1Data,*foo2Data;
+			T *b1Data,*b2Data;
+			const T *foo1Data,*foo2Data;
 			b1Data=b1.data();
 			b2Data=b2.data();
 			foo1Data=foo1.data();
 			foo2Data=foo2.data();
 
+			const T alphaT=alpha;
 			for(int i=0;i<nPixels;i++)
 			{
-				b1Data[i]=-b1Data[i]-alpha*foo1Data[i];
-				b2Data[i]=-b2Data[i]-alpha*foo2Data[i];
+				b1Data[i]=-b1Data[i]-alphaT*foo1Data[i];
+				b2Data[i]=-b2Data[i]-alphaT*foo2Data[i];
 			}
 
 			// for debug only, displaying the matrix coefficients
@@ -290,9 +339,12 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 			//b1.imwrite("b1.bmp",ImageIO::normalized);
 			//b2.imwrite("b2.bmp",ImageIO::normalized);
 
+			weightsTimer.stop();
+
 			//-----------------------------------------------------------------------
 			// conjugate gradient algorithm
 			//-----------------------------------------------------------------------
+			ProfileTimer solverTimer(profile,"solver");
 			r1.copyData(b1);
 			r2.copyData(b2);
 			du.reset();
@@ -300,10 +352,11 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 
 			for(int k=0;k<nCGIterations;k++)
 			{
-				rou[k]=r1.norm2()+r2.norm2();
+				rou[k]=norm2(r1)+norm2(r2);
 				//cout<<rou[k]<<endl;
 				if(rou[k]<1E-10)
 					break;
+				nIterations++;
 				if(k==0)
 				{
 					p1.copyData(r1);
@@ -311,31 +364,24 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 				}
 				else
 				{
-					double ratio=rou[k]/rou[k-1];
-					p1.Add(r1,p1,ratio);
-					p2.Add(r2,p2,ratio);
+					T ratio=rou[k]/rou[k-1];
+					addScaled(p1,r1,p1,ratio);
+					addScaled(p2,r2,p2,ratio);
 				}
 				// go through the large linear system
-				foo1.Multiply(A11,p1);
-				foo2.Multiply(A12,p2);
-				q1.Add(foo1,foo2);
-				Laplacian(foo1,p1,Phi_1st);
-				q1.Add(foo1,alpha);
-
-				foo1.Multiply(A12,p1);
-				foo2.Multiply(A22,p2);
-				q2.Add(foo1,foo2);
-				Laplacian(foo2,p2,Phi_1st);
-				q2.Add(foo2,alpha);
-
-				double beta;
-				beta=rou[k]/(p1.innerproduct(q1)+p2.innerproduct(q2));
+				T beta;
+				beta=rou[k]/MultiplyA(q1,q2,p1,p2,A11,A12,A22,Phi_1st,alpha);
 				
-				du.Add(p1,beta);
-				dv.Add(p2,beta);
+				addScaled(du,p1,beta);
+				addScaled(dv,p2,beta);
+
+				addScaled(r1,q1,-beta);
+				addScaled(r2,q2,-beta);
 
-				r1.Add(q1,-beta);
-				r2.Add(q2,-beta);
+				// stop once the relative update of the increments drops below the
+				// tolerance (the residual itself decreases too slowly to be used)
+				if(tolerance>0 && beta*beta*(norm2(p1)+norm2(p2))<=tolerance2*(norm2(du)+norm2(dv)))
+					break;
 			}
 			//-----------------------------------------------------------------------
 			// end of conjugate gradient algorithm
@@ -345,31 +391,93 @@ void cg::OpticalFlow::SmoothFlowPDE(const cg::DImage &Im1, const cg::DImage &Im2
 		// the following procedure is merely for debugging
 		//cout<<"du "<<du.norm2()<<" dv "<<dv.norm2()<<endl;
 		// update the flow field
+		ProfileTimer warpTimer(profile,"warp");
 		u.Add(du,1);
 		v.Add(dv,1);
 		warpFL(warpIm2,Im1,Im2,u,v);
 	}// end of outer fixed point iteration
 	
 	
-	delete[] rou;
+	return nIterations;
 }
 
-void cg::OpticalFlow::Laplacian(cg::DImage &output, const cg::DImage &input, const cg::DImage& weight)
+//--------------------------------------------------------------------------------------
+// the weighted Laplacian (see Laplacian()) of input at pixel offset, for a
+// pixel with or without left, right, upper and lower neighbours. The terms
+// are accumulated in the same order as in the original four pass filtering,
+// so results do not change. With constant neighbour flags, the expression is
+// branchless
+//--------------------------------------------------------------------------------------
+template <class T>
+static inline T weightedLaplacian(const T* input,const T* weight,int offset,int width,bool left,bool right,bool up,bool down)
+{
+	T lap=0;
+	if(right)
+		lap-=(input[offset+1]-input[offset])*weight[offset];
+	if(left)
+		lap+=(input[offset]-input[offset-1])*weight[offset-1];
+	if(down)
+		lap-=(input[offset+width]-input[offset])*weight[offset];
+	if(up)
+		lap+=(input[offset]-input[offset-width])*weight[offset-width];
+	return lap;
+}
+
+template <class T>
+void cg::OpticalFlowT<T>::Laplacian(TImage &output, const TImage &input, const TImage& weight)
 {
 	if(output.matchDimension(input)==false)
 		output.allocate(input);
-	output.reset();
 
 	if(input.matchDimension(weight)==false)
 	{
+		output.reset();
 		cout<<"Error in image dimension matching cg::OpticalFlow::Laplacian()!"<<endl;
 		return;
 	}
+
+	// a single pass over the image, without temporary image: the borders of
+	// each row are handled apart from its (branchless) interior
+	const T *inputData=input.data(),*weightData=weight.data();
+	T *outputData=output.data();
+	int width=input.width(),height=input.height();
+	for(int i=0;i<height;i++)
+	{
+		bool up=(i>0),down=(i<height-1);
+		int offset=i*width;
+		if(width==1)
+		{
+			outputData[offset]=weightedLaplacian(inputData,weightData,offset,width,false,false,up,down);
+			continue;
+		}
+		outputData[offset]=weightedLaplacian(inputData,weightData,offset,width,false,true,up,down);
+		if(up && down)
+			for(int j=1;j<width-1;j++)
+				outputData[offset+j]=weightedLaplacian(inputData,weightData,offset+j,width,true,true,true,true);
+		else
+			for(int j=1;j<width-1;j++)
+				outputData[offset+j]=weightedLaplacian(inputData,weightData,offset+j,width,true,true,up,down);
+		outputData[offset+width-1]=weightedLaplacian(inputData,weightData,offset+width-1,width,true,false,up,down);
+	}
+}
+
+template <class T>
+void cg::OpticalFlowT<T>::LaplacianReference(TImage &output, const TImage &input, const TImage& weight)
+{
+	if(output.matchDimension(input)==false)
+		output.allocate(input);
+	output.reset();
+
+	if(input.matchDimension(weight)==false)
+	{
+		cout<<"Error in image dimension matching cg::OpticalFlow::LaplacianReference()!"<<endl;
+		return;
+	}
 	
-	const double *inputData=input.data(),*weightData=weight.data();
+	const T *inputData=input.data(),*weightData=weight.data();
 	int width=input.width(),height=input.height();
-	cg::DImage foo(width,height);
-	double *fooData=foo.data(),*outputData=output.data();
+	TImage foo(width,height);
+	T *fooData=foo.data(),*outputData=output.data();
 
 	// horizontal filtering
 	for(int i=0;i<height;i++)
@@ -406,17 +514,103 @@ void cg::OpticalFlow::Laplacian(cg::DImage &output, const cg::DImage &input, con
 		}
 }
 
-void cg::OpticalFlow::testLaplacian(int dim)
+template <class T>
+static inline void multiplyAPixel(T* q1,T* q2,const T* p1,const T* p2,const T* A11,const T* A12,const T* A22,const T* weight,
+    T alpha,int offset,int width,bool left,bool right,bool up,bool down)
+{
+	T lap1=weightedLaplacian(p1,weight,offset,width,left,right,up,down);
+	T lap2=weightedLaplacian(p2,weight,offset,width,left,right,up,down);
+	T s1=A11[offset]*p1[offset],s2=A12[offset]*p2[offset];
+	q1[offset]=s1+s2;
+	q1[offset]+=lap1*alpha;
+	s1=A12[offset]*p1[offset];
+	s2=A22[offset]*p2[offset];
+	q2[offset]=s1+s2;
+	q2[offset]+=lap2*alpha;
+}
+
+//--------------------------------------------------------------------------------------
+// q1 = A11*p1 + A12*p2 + alpha*L(p1) and q2 = A12*p1 + A22*p2 + alpha*L(p2), where
+// L is the weighted Laplacian, in a single pass. Operations are carried out in
+// the same order as in MultiplyAReference(), so both give the same results on
+// double images (on float images, products are not computed in double)
+//--------------------------------------------------------------------------------------
+template <class T>
+double cg::OpticalFlowT<T>::MultiplyA(TImage& q1,TImage& q2,const TImage& p1,const TImage& p2,const TImage& A11,const TImage& A12,
+    const TImage& A22,const TImage& weight,double alphaD)
+{
+	const T alpha=alphaD;
+	if(p1.matchDimension(p2)==false || p1.matchDimension(A11)==false || p1.matchDimension(A12)==false ||
+		p1.matchDimension(A22)==false || p1.matchDimension(weight)==false || p1.nchannels()!=1)
+	{
+		cout<<"Error in image dimension matching cg::OpticalFlow::MultiplyA()!"<<endl;
+		return 0;
+	}
+	if(q1.matchDimension(p1)==false)
+		q1.allocate(p1);
+	if(q2.matchDimension(p1)==false)
+		q2.allocate(p1);
+
+	const T *p1Data=p1.data(),*p2Data=p2.data(),*weightData=weight.data();
+	const T *A11Data=A11.data(),*A12Data=A12.data(),*A22Data=A22.data();
+	T *q1Data=q1.data(),*q2Data=q2.data();
+	int width=p1.width(),height=p1.height();
+	double pq1=0,pq2=0;
+	for(int i=0;i<height;i++)
+	{
+		bool up=(i>0),down=(i<height-1);
+		int offset=i*width;
+		if(width==1)
+			multiplyAPixel(q1Data,q2Data,p1Data,p2Data,A11Data,A12Data,A22Data,weightData,alpha,offset,width,false,false,up,down);
+		else
+		{
+			multiplyAPixel(q1Data,q2Data,p1Data,p2Data,A11Data,A12Data,A22Data,weightData,alpha,offset,width,false,true,up,down);
+			if(up && down)
+				for(int j=1;j<width-1;j++)
+					multiplyAPixel(q1Data,q2Data,p1Data,p2Data,A11Data,A12Data,A22Data,weightData,alpha,offset+j,width,true,true,true,true);
+			else
+				for(int j=1;j<width-1;j++)
+					multiplyAPixel(q1Data,q2Data,p1Data,p2Data,A11Data,A12Data,A22Data,weightData,alpha,offset+j,width,true,true,up,down);
+			multiplyAPixel(q1Data,q2Data,p1Data,p2Data,A11Data,A12Data,A22Data,weightData,alpha,offset+width-1,width,true,false,up,down);
+		}
+	}
+	// the reductions are kept apart, as in innerproduct()
+	pq1=dotProduct(p1Data,q1Data,width*height);
+	pq2=dotProduct(p2Data,q2Data,width*height);
+	return pq1+pq2;
+}
+
+template <class T>
+double cg::OpticalFlowT<T>::MultiplyAReference(TImage& q1,TImage& q2,const TImage& p1,const TImage& p2,const TImage& A11,const TImage& A12,
+    const TImage& A22,const TImage& weight,double alpha)
+{
+	TImage foo1,foo2;
+	foo1.Multiply(A11,p1);
+	foo2.Multiply(A12,p2);
+	q1.Add(foo1,foo2);
+	LaplacianReference(foo1,p1,weight);
+	q1.Add(foo1,alpha);
+
+	foo1.Multiply(A12,p1);
+	foo2.Multiply(A22,p2);
+	q2.Add(foo1,foo2);
+	LaplacianReference(foo2,p2,weight);
+	q2.Add(foo2,alpha);
+	return p1.innerproduct(q1)+p2.innerproduct(q2);
+}
+
+template <class T>
+void cg::OpticalFlowT<T>::testLaplacian(int dim)
 {
 	// generate the random weight
-	cg::DImage weight(dim,dim);
+	TImage weight(dim,dim);
 	for(int i=0;i<dim;i++)
 		for(int j=0;j<dim;j++)
 			//weight.data()[i*dim+j]=(double)rand()/RAND_MAX+1;
 			weight.data()[i*dim+j]=1;
 	// go through the linear system;
-	cg::DImage sysMatrix(dim*dim,dim*dim);
-	cg::DImage u(dim,dim),du(dim,dim);
+	TImage sysMatrix(dim*dim,dim*dim);
+	TImage u(dim,dim),du(dim,dim);
 	for(int i=0;i<dim*dim;i++)
 	{
 		u.reset();
@@ -441,32 +635,75 @@ void cg::OpticalFlow::testLaplacian(int dim)
 //--------------------------------------------------------------------------------------
 // function to perfomr coarse to fine optical flow estimation
 //--------------------------------------------------------------------------------------
-void cg::OpticalFlow::Coarse2FineFlow(cg::DImage &vx, cg::DImage &vy, cg::DImage &warpI2,const cg::DImage &Im1, const cg::DImage &Im2, double alpha, double ratio, int minWidth, 
-																	 int nOuterFPIterations, int nInnerFPIterations, int nCGIterations)
+template <class T>
+void cg::OpticalFlowT<T>::Coarse2FineFlow(TImage &vx, TImage &vy, TImage &warpI2,const TImage &Im1, const TImage &Im2, double alpha, double ratio, int minWidth, 
+																	 int nOuterFPIterations, int nInnerFPIterations, int nCGIterations, bool warmStart,
+																	 double tolerance, std::vector<int>* iterations, bool warp, Workspace* workspace,
+																	 bool fastPyramid, int stopLevel, std::vector<TImage>* flows, Profile* profile)
 {
 	// first build the pyramid of the two images
-	GaussianPyramid GPyramid1;
-	GaussianPyramid GPyramid2;
+	FeaturePyramid localPyramid1;
+	FeaturePyramid localPyramid2;
+	FeaturePyramid& GPyramid1=(workspace!=NULL)?workspace->pyramid1:localPyramid1;
+	FeaturePyramid& GPyramid2=(workspace!=NULL)?workspace->pyramid2:localPyramid2;
 	//if(IsDisplay)
 	//	cout<<"Constructing pyramid...";
-	GPyramid1.ConstructPyramid(Im1,ratio,minWidth);
-	GPyramid2.ConstructPyramid(Im2,ratio,minWidth);
+	GPyramid1.ConstructPyramid(Im1,ratio,minWidth,fastPyramid,profile);
+	GPyramid2.ConstructPyramid(Im2,ratio,minWidth,fastPyramid,profile);
 	//if(IsDisplay)
 	//	cout<<"done!"<<endl;
-	
-	// now iterate from the top level to the bottom
-	cg::DImage Image1,Image2,WarpImage2;
 
-	for(int k=GPyramid1.nlevels()-1;k>=0;k--)
+	Coarse2FineFlow(vx,vy,warpI2,Im1,Im2,GPyramid1,GPyramid2,alpha,ratio,nOuterFPIterations,nInnerFPIterations,nCGIterations,warmStart,tolerance,iterations,warp,workspace,stopLevel,flows,profile);
+}
+
+//--------------------------------------------------------------------------------------
+// function to perform coarse to fine optical flow estimation on pre-computed
+// pyramids (e.g. shared between consecutive frame pairs of a video)
+//--------------------------------------------------------------------------------------
+template <class T>
+void cg::OpticalFlowT<T>::Coarse2FineFlow(TImage &vx, TImage &vy, TImage &warpI2,const TImage &Im1, const TImage &Im2, FeaturePyramid& GPyramid1, FeaturePyramid& GPyramid2,
+																	 double alpha, double ratio, int nOuterFPIterations, int nInnerFPIterations, int nCGIterations, bool warmStart,
+																	 double tolerance, std::vector<int>* iterations, bool warp, Workspace* workspace,
+																	 int stopLevel, std::vector<TImage>* flows, Profile* profile)
+{
+	// now iterate from the top level to the bottom
+	TImage localWarpImage2;
+	stopLevel=__min(__max(stopLevel,0),GPyramid1.nlevels()-1);
+	if(iterations!=NULL)
+		iterations->assign(GPyramid1.nlevels(),0);
+	if(workspace!=NULL)
+		workspace->levels.resize(GPyramid1.nlevels());
+	if(flows!=NULL)
+		flows->resize(2*(GPyramid1.nlevels()-stopLevel));
+
+	for(int k=GPyramid1.nlevels()-1;k>=stopLevel;k--)
 	{
 		//if(IsDisplay)
 		//	cout<<"Pyramid level "<<k;
 		int width=GPyramid1.Image(k).width();
 		int height=GPyramid1.Image(k).height();
-		im2feature(Image1,GPyramid1.Image(k));
-		im2feature(Image2,GPyramid2.Image(k));
-
-		if(k==GPyramid1.nlevels()-1) // if at the top level
+		const TImage& Image1=GPyramid1.Feature(k);
+		const TImage& Image2=GPyramid2.Feature(k);
+		LevelBuffers* buffers=(workspace!=NULL)?&workspace->levels[k]:NULL;
+		TImage& WarpImage2=(buffers!=NULL)?buffers->warpIm2:localWarpImage2;
+		if(profile!=NULL)
+			profile->level=k;
+
+		// the initial flow of the level, and frame 2 warped by it
+		ProfileTimer initTimer(profile,"init");
+		if(k==GPyramid1.nlevels()-1 && warmStart) // top level, initial flow given
+		{
+			// downsample the initial flow as the images were downsampled
+			GaussianPyramidT<T> GFlow;
+			GFlow.ConstructPyramidLevels(vx,ratio,GPyramid1.nlevels());
+			vx.copyData(GFlow.Image(k));
+			vx.Multiplywith(pow(ratio,k));
+			GFlow.ConstructPyramidLevels(vy,ratio,GPyramid1.nlevels());
+			vy.copyData(GFlow.Image(k));
+			vy.Multiplywith(pow(ratio,k));
+			warpFL(WarpImage2,Image1,Image2,vx,vy);
+		}
+		else if(k==GPyramid1.nlevels()-1) // if at the top level
 		{
 			vx.allocate(width,height);
 			vy.allocate(width,height);
@@ -483,18 +720,53 @@ void cg::OpticalFlow::Coarse2FineFlow(cg::DImage &vx, cg::DImage &vy, cg::DImage
 			//warpFL(warpI2,GPyramid1.Image(k),GPyramid2.Image(k),vx,vy);
 			warpFL(WarpImage2,Image1,Image2,vx,vy);
 		}
+		initTimer.stop();
 		//SmoothFlowPDE(GPyramid1.Image(k),GPyramid2.Image(k),warpI2,vx,vy,alpha,nOuterFPIterations,nInnerFPIterations,nCGIterations);
 		//SmoothFlowPDE(Image1,Image2,WarpImage2,vx,vy,alpha*pow((1/ratio),k),nOuterFPIterations,nInnerFPIterations,nCGIterations);
-		SmoothFlowPDE(Image1,Image2,WarpImage2,vx,vy,alpha,nOuterFPIterations,nInnerFPIterations,nCGIterations);
+		int nIterations=SmoothFlowPDE(Image1,Image2,WarpImage2,vx,vy,alpha,nOuterFPIterations,nInnerFPIterations,nCGIterations,tolerance,buffers,profile);
+		if(iterations!=NULL)
+			(*iterations)[k]=nIterations;
+		if(flows!=NULL)
+		{
+			(*flows)[2*(k-stopLevel)].copyData(vx);
+			(*flows)[2*(k-stopLevel)+1].copyData(vy);
+		}
 		//if(IsDisplay) cout<<endl;
 	}
-	warpFL(warpI2,Im1,Im2,vx,vy);
+	if(profile!=NULL)
+		profile->level=-1;
+	if(!warp)
+		return;
+	// when stopping early, the images of the stop level are warped
+	ProfileTimer warpTimer(profile,"final_warp");
+	const TImage& Level1=(stopLevel>0)?GPyramid1.Image(stopLevel):Im1;
+	const TImage& Level2=(stopLevel>0)?GPyramid2.Image(stopLevel):Im2;
+	warpFL(warpI2,Level1,Level2,vx,vy);
+}
+
+//---------------------------------------------------------------------------------------
+// function to construct the pyramid of an image and of its feature images
+//---------------------------------------------------------------------------------------
+template <class T>
+void cg::FeaturePyramidT<T>::ConstructPyramid(const TImage &image, double ratio, int minWidth, bool fast,
+																	 bob::ip::optflow::liu::Profile* profile)
+{
+	ProfileTimer pyramidTimer(profile,"pyramid",-1);
+	pyramid.ConstructPyramid(image,ratio,minWidth,fast);
+	pyramidTimer.stop();
+	features.resize(pyramid.nlevels());
+	for(int k=0;k<pyramid.nlevels();k++)
+	{
+		ProfileTimer featureTimer(profile,"im2feature",k);
+		OpticalFlowT<T>::im2feature(features[k],pyramid.Image(k));
+	}
 }
 
 //---------------------------------------------------------------------------------------
 // function to convert image to feature image
 //---------------------------------------------------------------------------------------
-void cg::OpticalFlow::im2feature(cg::DImage &imfeature, const cg::DImage &im)
+template <class T>
+void cg::OpticalFlowT<T>::im2feature(TImage &imfeature, const TImage &im)
 {
 	int width=im.width();
 	int height=im.height();
@@ -502,10 +774,10 @@ void cg::OpticalFlow::im2feature(cg::DImage &imfeature, const cg::DImage &im)
 	if(nchannels==1)
 	{
 		imfeature.allocate(im.width(),im.height(),3);
-		cg::DImage imdx,imdy;
+		TImage imdx,imdy;
 		im.dx(imdx,true);
 		im.dy(imdy,true);
-		double* data=imfeature.data();
+		T* data=imfeature.data();
 		for(int i=0;i<height;i++)
 			for(int j=0;j<width;j++)
 			{
@@ -517,14 +789,14 @@ void cg::OpticalFlow::im2feature(cg::DImage &imfeature, const cg::DImage &im)
 	}
 	else if(nchannels==3)
 	{
-		cg::DImage grayImage;
+		TImage grayImage;
 		im.desaturate(grayImage);
 
 		imfeature.allocate(im.width(),im.height(),5);
-		cg::DImage imdx,imdy;
+		TImage imdx,imdy;
 		grayImage.dx(imdx,true);
 		grayImage.dy(imdy,true);
-		double* data=imfeature.data();
+		T* data=imfeature.data();
 		for(int i=0;i<height;i++)
 			for(int j=0;j<width;j++)
 			{
@@ -539,3 +811,9 @@ void cg::OpticalFlow::im2feature(cg::DImage &imfeature, const cg::DImage &im)
 	else
 		imfeature.copyData(im);
 }
+
+// the solver is compiled for double (the reference) and single precision
+template class cg::OpticalFlowT<double>;
+template class cg::OpticalFlowT<float>;
+template class cg::FeaturePyramidT<double>;
+template class cg::FeaturePyramidT<float>;
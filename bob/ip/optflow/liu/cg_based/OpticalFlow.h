@@ -2,34 +2,146 @@
 #define _OpticalFlow_h
 
 #include "Image.h"
+#include "GaussianPyramid.h"
+#include "../profile.h"
+#include <vector>
 
 namespace cg {
 
-  class OpticalFlow
+  template <class T> class FeaturePyramidT;
+  template <class T> struct LevelBuffersT;
+  template <class T> class WorkspaceT;
+
+  // the solver, working on images of type T (double or float)
+  template <class T>
+  class OpticalFlowT
   {
+    public:
+      typedef cg::Image<T> TImage;
+      typedef FeaturePyramidT<T> FeaturePyramid;
+      typedef LevelBuffersT<T> LevelBuffers;
+      typedef WorkspaceT<T> Workspace;
+      typedef bob::ip::optflow::liu::Profile Profile;
     private:
       static bool IsDisplay;
     public:
-      OpticalFlow(void);
-      ~OpticalFlow(void);
+      OpticalFlowT(void);
+      ~OpticalFlowT(void);
     public:
-      static void getDxs(DImage& imdx,DImage& imdy,DImage& imdt,const DImage& im1,const DImage& im2);
-      static void SanityCheck(const DImage& imdx,const DImage& imdy,const DImage& imdt,double du,double dv);
-      static void warpFL(DImage& warpIm2,const DImage& Im1,const DImage& Im2,const DImage& vx,const DImage& vy);
-      static void genConstFlow(DImage& flow,double value,int width,int height);
-      static void genInImageMask(DImage& mask,const DImage& vx,const DImage& vy);
-      static void SmoothFlowPDE(const DImage& Im1,const DImage& Im2, DImage& warpIm2,DImage& vx,DImage& vy,
-          double alpha,int nOuterFPIterations,int nInnerFPIterations,int nCGIterations);
-      static void Laplacian(DImage& output,const DImage& input,const DImage& weight);
+      // if buffers is given, its images are used for the smoothed frames
+      static void getDxs(TImage& imdx,TImage& imdy,TImage& imdt,const TImage& im1,const TImage& im2,LevelBuffers* buffers=NULL);
+      static void SanityCheck(const TImage& imdx,const TImage& imdy,const TImage& imdt,double du,double dv);
+      static void warpFL(TImage& warpIm2,const TImage& Im1,const TImage& Im2,const TImage& vx,const TImage& vy);
+      static void genConstFlow(TImage& flow,double value,int width,int height);
+      static void genInImageMask(TImage& mask,const TImage& vx,const TImage& vy);
+      // returns the total number of CG iterations run. If tolerance is
+      // positive, each CG loop stops as soon as the relative residual drops
+      // below it. If buffers is given, its images are used instead of
+      // temporary ones. If profile is given, the time of every stage is
+      // added to it (see Coarse2FineFlow())
+      static int SmoothFlowPDE(const TImage& Im1,const TImage& Im2, TImage& warpIm2,TImage& vx,TImage& vy,
+          double alpha,int nOuterFPIterations,int nInnerFPIterations,int nCGIterations,double tolerance=0,
+          LevelBuffers* buffers=NULL,Profile* profile=NULL);
+      static void Laplacian(TImage& output,const TImage& input,const TImage& weight);
+      static void LaplacianReference(TImage& output,const TImage& input,const TImage& weight);
       static void testLaplacian(int dim=3);
 
-      // function of coarse to fine optical flow
-      static void Coarse2FineFlow(DImage& vx,DImage& vy,DImage &warpI2,const DImage& Im1,const DImage& Im2,double alpha,double ratio,int minWidth,
-          int nOuterFPIterations,int nInnerFPIterations,int nCGIterations);
+      // the product q=A*p of the system matrix of SmoothFlowPDE() with the
+      // search direction p=(p1,p2), computed in a single pass over the images.
+      // Returns the inner product of p and q. MultiplyAReference() is the
+      // (slower) original implementation, kept for comparison
+      static double MultiplyA(TImage& q1,TImage& q2,const TImage& p1,const TImage& p2,const TImage& A11,const TImage& A12,
+          const TImage& A22,const TImage& weight,double alpha);
+      static double MultiplyAReference(TImage& q1,TImage& q2,const TImage& p1,const TImage& p2,const TImage& A11,const TImage& A12,
+          const TImage& A22,const TImage& weight,double alpha);
+
+      // function of coarse to fine optical flow. If warmStart is set, vx and
+      // vy hold an initial flow estimate (at the resolution of Im1), which is
+      // used instead of a zero flow at the coarsest level. If iterations is
+      // given, it is filled with the number of CG iterations run at every
+      // pyramid level (finest first). If warp is not set, the final warping
+      // of Im2 into warpI2 is skipped (and warpI2 is left untouched). If
+      // workspace is given, its pyramids and buffers are used (see Workspace).
+      // If stopLevel is positive, the estimation stops at that pyramid level
+      // (or at the coarsest one, if there are fewer levels): vx, vy and warpI2
+      // are then at the resolution of that level, and velocities in its
+      // pixels. If flows is given, it is filled with the velocities vx and vy
+      // estimated at every level, from the stop level (first) to the coarsest
+      // one, i.e. flows[2*k] and flows[2*k+1] hold the ones of level
+      // stopLevel+k.
+      // If fastPyramid is set, the image pyramids are built recursively, which
+      // is faster but gives slightly different results (see GaussianPyramid).
+      // If profile is given, the wall time of every stage of the estimation
+      // (and its number of calls) is added to it, per pyramid level
+      static void Coarse2FineFlow(TImage& vx,TImage& vy,TImage &warpI2,const TImage& Im1,const TImage& Im2,double alpha,double ratio,int minWidth,
+          int nOuterFPIterations,int nInnerFPIterations,int nCGIterations,bool warmStart=false,
+          double tolerance=0,std::vector<int>* iterations=NULL,bool warp=true,Workspace* workspace=NULL,
+          bool fastPyramid=false,int stopLevel=0,std::vector<TImage>* flows=NULL,Profile* profile=NULL);
+      // same as above, but using pre-computed pyramids of the two images
+      static void Coarse2FineFlow(TImage& vx,TImage& vy,TImage &warpI2,const TImage& Im1,const TImage& Im2,FeaturePyramid& Pyramid1,FeaturePyramid& Pyramid2,
+          double alpha,double ratio,int nOuterFPIterations,int nInnerFPIterations,int nCGIterations,bool warmStart=false,
+          double tolerance=0,std::vector<int>* iterations=NULL,bool warp=true,Workspace* workspace=NULL,
+          int stopLevel=0,std::vector<TImage>* flows=NULL,Profile* profile=NULL);
       // function to convert image to features
-      static void im2feature(DImage& imfeature,const DImage& im);
+      static void im2feature(TImage& imfeature,const TImage& im);
+  };
+
+  // the Gaussian pyramid of an image together with the feature images (see
+  // OpticalFlow::im2feature()) of all of its levels, so they can be re-used
+  // by consecutive frame pairs of a video
+  template <class T>
+  class FeaturePyramidT
+  {
+    public:
+      typedef cg::Image<T> TImage;
+    private:
+      GaussianPyramidT<T> pyramid;
+      std::vector<TImage> features;
+    public:
+      // if profile is given, the time of the construction of the pyramid and
+      // of the feature images of every level is added to it
+      void ConstructPyramid(const TImage& image,double ratio,int minWidth,bool fast=false,
+          bob::ip::optflow::liu::Profile* profile=NULL);
+      inline int nlevels() const {return pyramid.nlevels();};
+      inline TImage& Image(int index) {return pyramid.Image(index);};
+      inline TImage& Feature(int index) {return features[index];};
   };
 
+  // the temporary images of OpticalFlow::SmoothFlowPDE() (and of
+  // OpticalFlow::Coarse2FineFlow()) for one pyramid level
+  template <class T>
+  struct LevelBuffersT
+  {
+    typedef cg::Image<T> TImage;
+    TImage mask,imdx,imdy,imdt;
+    TImage du,dv,uu,vv,ux,uy,vx,vy,Phi_1st;
+    TImage imdxy,imdx2,imdy2,imdtdx,imdtdy;
+    TImage foo1,foo2;
+    TImage warpIm2;
+    TImage smooth1,smooth2,smooth,filter;
+    TImage A11,A12,A22,b1,b2;
+    TImage r1,r2,p1,p2,q1,q2;
+    std::vector<double> rou;
+  };
+
+  // all the buffers of a coarse to fine estimation: the pyramids of the two
+  // images and the temporary images of every pyramid level. Estimations on
+  // images of the same size (and with the same pyramid settings) re-use the
+  // memory of the previous estimation passed the same workspace instead of
+  // allocating their own. A workspace must not be used by concurrent
+  // estimations
+  template <class T>
+  class WorkspaceT
+  {
+    public:
+      FeaturePyramidT<T> pyramid1,pyramid2;
+      std::vector<LevelBuffersT<T> > levels;
+  };
+
+  typedef OpticalFlowT<double> OpticalFlow;
+  typedef FeaturePyramidT<double> FeaturePyramid;
+  typedef WorkspaceT<double> Workspace;
+
 }
 
 #endif
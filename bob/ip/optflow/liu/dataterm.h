@@ -0,0 +1,140 @@
+/**
+ * @date Sun 18 Oct 2026 23:12:48 CEST
+ *
+ * @brief Fused assembly of the data term of the linear system solved at each
+ * inner fixed point iteration, shared by the SOR and CG solvers. The robust
+ * weight of every channel and the channel averages of the system coefficients
+ * are computed in a single pass over the derivatives, specialized per robust
+ * weight (noise model) and number of feature channels.
+ */
+
+#ifndef BOB_IP_OPTFLOW_LIU_DATATERM_H
+#define BOB_IP_OPTFLOW_LIU_DATATERM_H
+
+#include <cmath>
+
+namespace bob { namespace ip { namespace optflow { namespace liu {
+
+  /**
+   * The robust weight ``1/(2*sqrt(x+epsilon))`` of a squared residual ``x``,
+   * the same for all channels
+   */
+  struct L1Weight {
+
+    double epsilon;
+
+    L1Weight(double epsilon): epsilon(epsilon) {}
+
+    template <typename T>
+    T operator()(T residual2, int) const {
+      return 1/(2*std::sqrt(residual2+(T)epsilon));
+    }
+
+  };
+
+  /**
+   * Assembles the data term for images with ``NC`` channels (any number of
+   * channels, given by ``nChannels``, if ``NC`` is 0). For each pixel, the
+   * residual ``imdt+imdx*du+imdy*dv`` of each channel gives its robust weight
+   * ``psi=weight(residual*residual, channel)``, and the products
+   * ``psi*imdx*imdy``, ``psi*imdx*imdx``, ``psi*imdy*imdy``,
+   * ``psi*imdx*imdt`` and ``psi*imdy*imdt``, averaged over channels, are
+   * written to ``dxy``, ``dx2``, ``dy2``, ``dtdx`` and ``dtdy``.
+   *
+   * If ``lapu`` and ``lapv`` are given, ``dtdx`` and ``dtdy`` receive the
+   * right-hand side of the system instead, ``-dtdx-alpha*lapu`` and
+   * ``-dtdy-alpha*lapv``.
+   *
+   * Operations are the ones (and in the same order) of computing the weights,
+   * the products and their averages in separate passes, so results do not
+   * change. They are carried out in the precision of the images, so float
+   * images are not converted to double at every access.
+   */
+  template <int NC, typename T, typename Weight>
+  void assemble_data_term_channels(int nPixels, int nChannels, const T* imdx,
+      const T* imdy, const T* imdt, const T* du, const T* dv,
+      const Weight& weight, T* dxy, T* dx2, T* dy2, T* dtdx, T* dtdy,
+      const T* lapu, const T* lapv, double alpha) {
+
+    const int nc = (NC > 0) ? NC : nChannels;
+    const T alphaT = alpha;
+
+    for (int i = 0; i < nPixels; ++i) {
+
+      T cxy, cx2, cy2, ctx, cty;
+
+      if (nc == 1) {
+        T residual = imdt[i]+imdx[i]*du[i]+imdy[i]*dv[i];
+        const T psi = weight(residual*residual, 0);
+        cxy = psi*imdx[i]*imdy[i];
+        cx2 = psi*imdx[i]*imdx[i];
+        cy2 = psi*imdy[i]*imdy[i];
+        ctx = psi*imdx[i]*imdt[i];
+        cty = psi*imdy[i]*imdt[i];
+      }
+      else {
+        T sxy = 0, sx2 = 0, sy2 = 0, stx = 0, sty = 0;
+        for (int k = 0; k < nc; ++k) {
+          const int offset = i*nc+k;
+          T residual = imdt[offset]+imdx[offset]*du[i]+imdy[offset]*dv[i];
+          const T psi = weight(residual*residual, k);
+          sxy += (T)(psi*imdx[offset]*imdy[offset]);
+          sx2 += (T)(psi*imdx[offset]*imdx[offset]);
+          sy2 += (T)(psi*imdy[offset]*imdy[offset]);
+          stx += (T)(psi*imdx[offset]*imdt[offset]);
+          sty += (T)(psi*imdy[offset]*imdt[offset]);
+        }
+        cxy = sxy/nc;
+        cx2 = sx2/nc;
+        cy2 = sy2/nc;
+        ctx = stx/nc;
+        cty = sty/nc;
+      }
+
+      dxy[i] = cxy;
+      dx2[i] = cx2;
+      dy2[i] = cy2;
+      if (lapu) {
+        dtdx[i] = -ctx-alphaT*lapu[i];
+        dtdy[i] = -cty-alphaT*lapv[i];
+      }
+      else {
+        dtdx[i] = ctx;
+        dtdy[i] = cty;
+      }
+    }
+  }
+
+  /**
+   * Assembles the data term (see assemble_data_term_channels()), with
+   * specialized kernels for gray-scale images and for the features of
+   * gray-scale (3 channels) and color (5 channels) images
+   */
+  template <typename T, typename Weight>
+  void assemble_data_term(int nPixels, int nChannels, const T* imdx,
+      const T* imdy, const T* imdt, const T* du, const T* dv,
+      const Weight& weight, T* dxy, T* dx2, T* dy2, T* dtdx, T* dtdy,
+      const T* lapu=0, const T* lapv=0, double alpha=0) {
+
+    switch (nChannels) {
+      case 1:
+        assemble_data_term_channels<1>(nPixels, nChannels, imdx, imdy, imdt,
+            du, dv, weight, dxy, dx2, dy2, dtdx, dtdy, lapu, lapv, alpha);
+        break;
+      case 3:
+        assemble_data_term_channels<3>(nPixels, nChannels, imdx, imdy, imdt,
+            du, dv, weight, dxy, dx2, dy2, dtdx, dtdy, lapu, lapv, alpha);
+        break;
+      case 5:
+        assemble_data_term_channels<5>(nPixels, nChannels, imdx, imdy, imdt,
+            du, dv, weight, dxy, dx2, dy2, dtdx, dtdy, lapu, lapv, alpha);
+        break;
+      default:
+        assemble_data_term_channels<0>(nPixels, nChannels, imdx, imdy, imdt,
+            du, dv, weight, dxy, dx2, dy2, dtdx, dtdy, lapu, lapv, alpha);
+    }
+  }
+
+}}}}
+
+#endif /* BOB_IP_OPTFLOW_LIU_DATATERM_H */
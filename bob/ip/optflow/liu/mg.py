@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Multigrid based estimation of Liu's Optical Flow
+
+The energy, the image pyramid and the fixed point iterations are the ones of
+:py:func:`bob.ip.optflow.liu.sor.flow`, but the linear system of every inner
+fixed point iteration is solved by conjugate gradients, preconditioned by a
+multigrid V-cycle (a red-black, block Gauss-Seidel smoother on a hierarchy of
+coarser systems, built by aggregating 2x2 pixels), instead of SOR sweeps.
+
+Each SOR sweep only propagates information to neighbouring pixels, so the
+default 20 sweeps leave the systems of large images far from solved. A
+V-cycle reduces the residual of all frequencies at once: 3 to 5 of them reach
+residuals that many hundreds of SOR sweeps do not, at a cost of a few sweeps
+each.
+"""
+
+from . import sor
+
+N_VCYCLES = 5
+"""The default number of V-cycles per inner fixed point iteration"""
+
+def flow(i1, i2, alpha=1.0, ratio=0.5, min_width=40, n_outer_fp_iterations=4,
+    n_inner_fp_iterations=1, n_vcycles=N_VCYCLES, **kwargs):
+  """Estimates the optical flow leading ``i1`` into ``i2``
+
+  Parameters and returned values are the ones of
+  :py:func:`bob.ip.optflow.liu.sor.flow` (which is called with
+  ``solver='multigrid'``), except for:
+
+  n_vcycles
+    [optional] The largest number of (preconditioned) V-cycles run at every
+    inner fixed point iteration, instead of ``n_sor_iterations`` (more cycles
+    are run at coarser levels of the pyramid, as SOR sweeps are). If ``tol``
+    is positive, cycles stop as soon as the residual norm of the system (in
+    the metric of the preconditioner) drops below ``tol`` times its initial
+    value.
+
+  n_threads
+    [optional] The number of native threads of the (red-black) smoothing
+    sweeps of every V-cycle, all cores if smaller than 1 (the default). Levels
+    of the multigrid hierarchy smaller than 16384 pixels (including all levels
+    of small images) are swept by a single thread. ``ordering`` is not used.
+
+  Iterations (if ``return_iterations`` is set) count V-cycles.
+  """
+
+  for name in ('n_sor_iterations', 'solver'):
+    if name in kwargs:
+      raise TypeError("flow() got an unexpected keyword argument `%s'" % name)
+
+  return sor.flow(i1, i2, alpha, ratio, min_width, n_outer_fp_iterations,
+      n_inner_fp_iterations, n_vcycles, solver='multigrid', **kwargs)
+
+def flow_bidirectional(i1, i2, alpha=1.0, ratio=0.5, min_width=40,
+    n_outer_fp_iterations=4, n_inner_fp_iterations=1, n_vcycles=N_VCYCLES,
+    **kwargs):
+  """Estimates the optical flows leading ``i1`` into ``i2`` and ``i2`` into
+  ``i1``
+
+  Parameters and returned values are the ones of
+  :py:func:`bob.ip.optflow.liu.sor.flow_bidirectional` (which is called with
+  ``solver='multigrid'``), with ``n_vcycles`` (see :py:func:`flow`) instead of
+  ``n_sor_iterations``.
+  """
+
+  for name in ('n_sor_iterations', 'solver'):
+    if name in kwargs:
+      raise TypeError("flow_bidirectional() got an unexpected keyword argument `%s'" % name)
+
+  return sor.flow_bidirectional(i1, i2, alpha, ratio, min_width,
+      n_outer_fp_iterations, n_inner_fp_iterations, n_vcycles,
+      solver='multigrid', **kwargs)
@@ -0,0 +1,396 @@
+/**
+ * @date Mon 19 Oct 2026 09:41:05 CEST
+ *
+ * @brief Multigrid solver of the linear system of the flow increments solved
+ * at each inner fixed point iteration (see sor::OpticalFlow::SmoothFlowSOR()).
+ * Unlike SOR sweeps, whose convergence slows down as images get larger,
+ * multigrid V-cycles reduce the residual by about the same factor whatever
+ * the size of the image.
+ */
+
+#ifndef BOB_IP_OPTFLOW_LIU_MULTIGRID_H
+#define BOB_IP_OPTFLOW_LIU_MULTIGRID_H
+
+#include <algorithm>
+#include <vector>
+
+#include "parallel.h"
+
+namespace bob { namespace ip { namespace optflow { namespace liu {
+
+  /**
+   * Solves, for the increments ``(du, dv)`` of the flow at every pixel ``i``:
+   *
+   *   a11[i]*du[i] + a12[i]*dv[i] + sum_j w[i,j]*(du[i]-du[j]) = b1[i]
+   *   a12[i]*du[i] + a22[i]*dv[i] + sum_j w[i,j]*(dv[i]-dv[j]) = b2[i]
+   *
+   * where ``j`` are the (up to four) neighbours of ``i``. The system is
+   * symmetric and positive definite, and is solved by conjugate gradients
+   * preconditioned by a multigrid V-cycle. Coarse levels aggregate 2x2
+   * pixels, their operator being the Galerkin projection of the one of the
+   * finer level: coefficients of aggregated pixels and weights of the edges
+   * between aggregates are summed. Levels are smoothed by red-black block
+   * Gauss-Seidel sweeps (each half sweep split over threads), in reverse
+   * order after the coarse grid correction, so the preconditioner is
+   * symmetric. Results do not depend on the number of threads.
+   *
+   * The buffers of all levels are kept between calls, so solving systems of
+   * the same size over and over does not allocate memory.
+   */
+  class Multigrid {
+
+    public:
+
+      /// The system (and buffers) of one level
+      struct Level {
+        int width, height;
+        std::vector<double> a11, a12, a22; ///< pixel coefficients
+        std::vector<double> wx, wy; ///< weights of the right and lower edges
+        std::vector<double> u, v; ///< the solution (or correction)
+        std::vector<double> b1, b2; ///< the right-hand side
+        std::vector<double> r1, r2; ///< the residual
+      };
+
+      /// number of threads of the smoothing sweeps (all cores if < 1)
+      int nThreads;
+
+      /// smallest number of pixels per block of a (threaded) sweep: smaller
+      /// levels are swept by the calling thread alone, as they would not pay
+      /// for starting threads
+      static const int MinPixelsPerBlock = 16384;
+
+      /// number of smoothing sweeps before and after the coarse correction
+      int nSmooth;
+
+      /// number of (symmetric) sweeps solving the coarsest level
+      int nCoarsest;
+
+      /// size of the smallest side of the coarsest level
+      int minSize;
+
+      Multigrid(): nThreads(1), nSmooth(2), nCoarsest(10), minSize(8) {}
+
+      /**
+       * Sets up the levels of the system of an image of ``width x height``
+       * pixels, given the data coefficients ``imdx2``, ``imdxy`` and
+       * ``imdy2``, the smoothness weights ``phi`` (of the right and lower
+       * edges of each pixel) scaled by ``alpha``, and a ``regularizer`` added
+       * to the diagonal coefficients
+       */
+      template <typename T>
+      void setup(int width, int height, const T* imdx2, const T* imdxy,
+          const T* imdy2, const T* phi, double alpha, double regularizer) {
+
+        int n = 1;
+        for (int w = width, h = height; std::min(w, h) >= 2*minSize;
+            w = (w+1)/2, h = (h+1)/2) ++n;
+        levels.resize(n);
+
+        Level& fine = levels[0];
+        allocate(fine, width, height);
+        for (int i = 0; i < height; ++i) {
+          for (int j = 0; j < width; ++j) {
+            int offset = i*width+j;
+            fine.a11[offset] = imdx2[offset] + regularizer;
+            fine.a12[offset] = imdxy[offset];
+            fine.a22[offset] = imdy2[offset] + regularizer;
+            fine.wx[offset] = (j < width-1) ? alpha*phi[offset] : 0.;
+            fine.wy[offset] = (i < height-1) ? alpha*phi[offset] : 0.;
+          }
+        }
+
+        for (int l = 1; l < n; ++l) coarsen(levels[l-1], levels[l]);
+      }
+
+      /**
+       * Solves the system set up by setup() for the right-hand side ``b1``
+       * and ``b2``, starting from zero, writing the solution to ``du`` and
+       * ``dv``. Runs ``nIterations`` preconditioned conjugate gradient
+       * iterations (one V-cycle each), or stops earlier once the residual
+       * vanishes or, if ``tolerance`` is positive, once its norm in the metric
+       * of the preconditioner (``sqrt(r'z)``, which, unlike the euclidean
+       * one, decreases steadily) drops below ``tolerance`` times the one of
+       * the right-hand side. Returns the number of iterations run.
+       */
+      template <typename T>
+      int solve(T* du, T* dv, const T* b1, const T* b2, int nIterations,
+          double tolerance) {
+
+        const Level& fine = levels[0];
+        const int n = fine.width*fine.height;
+        x1.assign(n, 0.); x2.assign(n, 0.);
+        r1.assign(b1, b1+n); r2.assign(b2, b2+n);
+        z1.resize(n); z2.resize(n);
+        p1.resize(n); p2.resize(n);
+        q1.resize(n); q2.resize(n);
+
+        double rz0 = 0.;
+        double rz = 0.;
+        int k = 0;
+
+        for (; k < nIterations; ++k) {
+          if (dot(r1, r2, r1, r2) < 1e-20) break;
+
+          precondition(r1, r2, z1, z2);
+          double rz_new = dot(r1, r2, z1, z2);
+          if (k == 0) {
+            rz0 = rz_new;
+            p1 = z1;
+            p2 = z2;
+          }
+          else {
+            if (tolerance > 0 && rz_new <= tolerance*tolerance*rz0) break;
+            double beta = rz_new/rz;
+            for (int i = 0; i < n; ++i) {
+              p1[i] = z1[i] + beta*p1[i];
+              p2[i] = z2[i] + beta*p2[i];
+            }
+          }
+          rz = rz_new;
+
+          multiply(fine, p1, p2, q1, q2);
+          double pq = dot(p1, p2, q1, q2);
+          if (pq <= 0) break;
+          double step = rz/pq;
+          for (int i = 0; i < n; ++i) {
+            x1[i] += step*p1[i];
+            x2[i] += step*p2[i];
+            r1[i] -= step*q1[i];
+            r2[i] -= step*q2[i];
+          }
+        }
+
+        for (int i = 0; i < n; ++i) {
+          du[i] = x1[i];
+          dv[i] = x2[i];
+        }
+        return k;
+      }
+
+    private:
+
+      std::vector<Level> levels;
+      std::vector<double> x1, x2, r1, r2, z1, z2, p1, p2, q1, q2;
+
+      static void allocate(Level& level, int width, int height) {
+        const int n = width*height;
+        level.width = width;
+        level.height = height;
+        level.a11.resize(n); level.a12.resize(n); level.a22.resize(n);
+        level.wx.resize(n); level.wy.resize(n);
+        level.u.resize(n); level.v.resize(n);
+        level.b1.resize(n); level.b2.resize(n);
+        level.r1.resize(n); level.r2.resize(n);
+      }
+
+      static double dot(const std::vector<double>& a1,
+          const std::vector<double>& a2, const std::vector<double>& b1,
+          const std::vector<double>& b2) {
+        double retval = 0.;
+        for (size_t i = 0; i < a1.size(); ++i)
+          retval += a1[i]*b1[i] + a2[i]*b2[i];
+        return retval;
+      }
+
+      /**
+       * Builds the Galerkin projection of the system of ``fine`` over its
+       * aggregates of 2x2 pixels
+       */
+      static void coarsen(const Level& fine, Level& coarse) {
+
+        const int fw = fine.width, fh = fine.height;
+        const int w = (fw+1)/2, h = (fh+1)/2;
+        allocate(coarse, w, h);
+
+        for (int i = 0; i < h; ++i) {
+          for (int j = 0; j < w; ++j) {
+            int offset = i*w+j;
+            double a11 = 0., a12 = 0., a22 = 0., wx = 0., wy = 0.;
+            for (int y = 2*i; y < std::min(2*i+2, fh); ++y) {
+              for (int x = 2*j; x < std::min(2*j+2, fw); ++x) {
+                int f = y*fw+x;
+                a11 += fine.a11[f];
+                a12 += fine.a12[f];
+                a22 += fine.a22[f];
+              }
+              // edges crossing to the aggregate on the right
+              if (j < w-1) wx += fine.wx[y*fw+2*j+1];
+            }
+            // edges crossing to the aggregate below
+            if (i < h-1)
+              for (int x = 2*j; x < std::min(2*j+2, fw); ++x)
+                wy += fine.wy[(2*i+1)*fw+x];
+            coarse.a11[offset] = a11;
+            coarse.a12[offset] = a12;
+            coarse.a22[offset] = a22;
+            coarse.wx[offset] = wx;
+            coarse.wy[offset] = wy;
+          }
+        }
+      }
+
+      /**
+       * Computes ``(q1, q2)``, the product of the system of ``level`` with
+       * ``(p1, p2)``
+       */
+      static void multiply(const Level& level, const std::vector<double>& p1,
+          const std::vector<double>& p2, std::vector<double>& q1,
+          std::vector<double>& q2) {
+
+        const int w = level.width, h = level.height;
+        for (int i = 0; i < h; ++i) {
+          for (int j = 0; j < w; ++j) {
+            int offset = i*w+j;
+            double s1 = level.a11[offset]*p1[offset] + level.a12[offset]*p2[offset];
+            double s2 = level.a12[offset]*p1[offset] + level.a22[offset]*p2[offset];
+            if (j > 0) {
+              double weight = level.wx[offset-1];
+              s1 += weight*(p1[offset]-p1[offset-1]);
+              s2 += weight*(p2[offset]-p2[offset-1]);
+            }
+            if (j < w-1) {
+              double weight = level.wx[offset];
+              s1 += weight*(p1[offset]-p1[offset+1]);
+              s2 += weight*(p2[offset]-p2[offset+1]);
+            }
+            if (i > 0) {
+              double weight = level.wy[offset-w];
+              s1 += weight*(p1[offset]-p1[offset-w]);
+              s2 += weight*(p2[offset]-p2[offset-w]);
+            }
+            if (i < h-1) {
+              double weight = level.wy[offset];
+              s1 += weight*(p1[offset]-p1[offset+w]);
+              s2 += weight*(p2[offset]-p2[offset+w]);
+            }
+            q1[offset] = s1;
+            q2[offset] = s2;
+          }
+        }
+      }
+
+      /**
+       * Solves the 2x2 system of every pixel of one color (``(i+j)%2`` equal
+       * to ``color``) of ``level``, given the current values of its
+       * neighbours
+       */
+      void relax(Level& level, int color) {
+
+        const int w = level.width, h = level.height;
+        const int nBlocks = std::max(1, std::min(h, std::min(
+                4*effective_threads(nThreads, h), w*h/MinPixelsPerBlock)));
+
+        parallel_for(nBlocks, nThreads, [&](int b) {
+          for (int i = b*h/nBlocks; i < (b+1)*h/nBlocks; ++i) {
+            for (int j = (i+color)%2; j < w; j += 2) {
+              int offset = i*w+j;
+              double s1 = level.b1[offset], s2 = level.b2[offset], sum = 0.;
+              if (j > 0) {
+                double weight = level.wx[offset-1];
+                s1 += weight*level.u[offset-1];
+                s2 += weight*level.v[offset-1];
+                sum += weight;
+              }
+              if (j < w-1) {
+                double weight = level.wx[offset];
+                s1 += weight*level.u[offset+1];
+                s2 += weight*level.v[offset+1];
+                sum += weight;
+              }
+              if (i > 0) {
+                double weight = level.wy[offset-w];
+                s1 += weight*level.u[offset-w];
+                s2 += weight*level.v[offset-w];
+                sum += weight;
+              }
+              if (i < h-1) {
+                double weight = level.wy[offset];
+                s1 += weight*level.u[offset+w];
+                s2 += weight*level.v[offset+w];
+                sum += weight;
+              }
+              double m11 = level.a11[offset] + sum;
+              double m22 = level.a22[offset] + sum;
+              double m12 = level.a12[offset];
+              double det = m11*m22 - m12*m12;
+              if (det <= 0) continue;
+              level.u[offset] = (m22*s1 - m12*s2)/det;
+              level.v[offset] = (m11*s2 - m12*s1)/det;
+            }
+          }
+        });
+      }
+
+      /**
+       * Runs a V-cycle on level ``l`` and the coarser ones, starting from
+       * zero, for the right-hand side of the level
+       */
+      void vcycle(int l) {
+
+        Level& level = levels[l];
+        std::fill(level.u.begin(), level.u.end(), 0.);
+        std::fill(level.v.begin(), level.v.end(), 0.);
+
+        if (l == (int)levels.size()-1) {
+          for (int k = 0; k < nCoarsest; ++k) {
+            relax(level, 0); relax(level, 1);
+            relax(level, 1); relax(level, 0);
+          }
+          return;
+        }
+
+        for (int k = 0; k < nSmooth; ++k) {
+          relax(level, 0);
+          relax(level, 1);
+        }
+
+        // restricts the residual to the coarser level
+        multiply(level, level.u, level.v, level.r1, level.r2);
+        Level& coarse = levels[l+1];
+        std::fill(coarse.b1.begin(), coarse.b1.end(), 0.);
+        std::fill(coarse.b2.begin(), coarse.b2.end(), 0.);
+        const int w = level.width, h = level.height, cw = coarse.width;
+        for (int i = 0; i < h; ++i) {
+          for (int j = 0; j < w; ++j) {
+            int offset = i*w+j, c = (i/2)*cw+j/2;
+            coarse.b1[c] += level.b1[offset] - level.r1[offset];
+            coarse.b2[c] += level.b2[offset] - level.r2[offset];
+          }
+        }
+
+        vcycle(l+1);
+
+        // and adds its correction
+        for (int i = 0; i < h; ++i) {
+          for (int j = 0; j < w; ++j) {
+            int offset = i*w+j, c = (i/2)*cw+j/2;
+            level.u[offset] += coarse.u[c];
+            level.v[offset] += coarse.v[c];
+          }
+        }
+
+        for (int k = 0; k < nSmooth; ++k) {
+          relax(level, 1);
+          relax(level, 0);
+        }
+      }
+
+      /**
+       * Applies the preconditioner (a V-cycle) to ``(r1, r2)``
+       */
+      void precondition(const std::vector<double>& r1,
+          const std::vector<double>& r2, std::vector<double>& z1,
+          std::vector<double>& z2) {
+        Level& fine = levels[0];
+        fine.b1 = r1;
+        fine.b2 = r2;
+        vcycle(0);
+        z1 = fine.u;
+        z2 = fine.v;
+      }
+
+  };
+
+}}}}
+
+#endif /* BOB_IP_OPTFLOW_LIU_MULTIGRID_H */
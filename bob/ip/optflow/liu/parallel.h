@@ -0,0 +1,70 @@
+/**
+ * @date Sun 18 Oct 2026 10:12:37 CEST
+ *
+ * @brief A minimal native worker pool shared by the SOR and CG bindings. All
+ * functions in here are meant to be called without holding the GIL.
+ */
+
+#ifndef BOB_IP_OPTFLOW_LIU_PARALLEL_H
+#define BOB_IP_OPTFLOW_LIU_PARALLEL_H
+
+#include <atomic>
+#include <exception>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+namespace bob { namespace ip { namespace optflow { namespace liu {
+
+  /**
+   * Returns the effective number of threads to use for ``n_jobs`` jobs, given
+   * the user request ``n_threads``. Values smaller than 1 mean "use as many
+   * threads as there are cores available".
+   */
+  inline int effective_threads(int n_threads, int n_jobs) {
+    if (n_threads < 1) n_threads = std::thread::hardware_concurrency();
+    if (n_threads < 1) n_threads = 1;
+    if (n_threads > n_jobs) n_threads = n_jobs;
+    return n_threads < 1 ? 1 : n_threads;
+  }
+
+  /**
+   * Calls ``fn(i)`` for every ``i`` in ``[0, n_jobs)``, distributing the
+   * indexes dynamically over ``n_threads`` native threads. The calling thread
+   * takes part in the work. If any of the calls throws, remaining jobs are
+   * skipped and the first exception is re-thrown once all threads joined.
+   */
+  template <typename Function>
+  void parallel_for(int n_jobs, int n_threads, Function fn) {
+
+    if (n_jobs <= 0) return;
+    n_threads = effective_threads(n_threads, n_jobs);
+
+    std::atomic<int> next(0);
+    std::exception_ptr error;
+    std::mutex error_mutex;
+
+    auto worker = [&]() {
+      for (int i = next++; i < n_jobs; i = next++) {
+        try {
+          fn(i);
+        }
+        catch (...) {
+          std::lock_guard<std::mutex> lock(error_mutex);
+          if (!error) error = std::current_exception();
+          next = n_jobs; //stops all workers
+        }
+      }
+    };
+
+    std::vector<std::thread> threads;
+    for (int t = 1; t < n_threads; ++t) threads.emplace_back(worker);
+    worker();
+    for (auto& t : threads) t.join();
+
+    if (error) std::rethrow_exception(error);
+  }
+
+}}}}
+
+#endif /* BOB_IP_OPTFLOW_LIU_PARALLEL_H */
@@ -0,0 +1,108 @@
+/**
+ * @date Sun 18 Oct 2026 21:05:37 CEST
+ *
+ * @brief Low-overhead wall time profiling of the stages of a coarse to fine
+ * estimation, shared by the SOR and CG solvers. A null profile disables all
+ * timers, which then do not even read the clock.
+ */
+
+#ifndef BOB_IP_OPTFLOW_LIU_PROFILE_H
+#define BOB_IP_OPTFLOW_LIU_PROFILE_H
+
+#include <algorithm>
+#include <chrono>
+#include <map>
+#include <string>
+#include <vector>
+
+namespace bob { namespace ip { namespace optflow { namespace liu {
+
+  /**
+   * Returns the current time of a monotonic clock, in seconds
+   */
+  inline double profile_clock() {
+    return std::chrono::duration<double>(
+        std::chrono::steady_clock::now().time_since_epoch()).count();
+  }
+
+  /**
+   * The cumulative wall time and number of calls of every stage of an
+   * estimation, per pyramid level. Stages that do not run at a given level
+   * (e.g. the construction of the pyramids) are recorded at level ``-1``.
+   * The solver sets ``level`` to the pyramid level being estimated, which is
+   * the one timers record to by default.
+   */
+  class Profile {
+
+    public:
+
+      struct Entry {
+        double time; ///< cumulative wall time, in seconds
+        long calls; ///< number of calls
+        Entry(): time(0.), calls(0) {}
+      };
+
+      /// the entries of every stage, at index ``level+1``
+      std::map<std::string, std::vector<Entry> > stages;
+
+      /// the level being estimated
+      int level;
+
+      Profile(): level(-1) {}
+
+      void add(const char* stage, int level, double seconds) {
+        std::vector<Entry>& entries = stages[stage];
+        if ((int)entries.size() < level+2) entries.resize(level+2);
+        entries[level+1].time += seconds;
+        entries[level+1].calls += 1;
+      }
+
+      /**
+       * The number of pyramid levels with recorded stages
+       */
+      int nlevels() const {
+        int retval = 0;
+        for (auto it = stages.begin(); it != stages.end(); ++it)
+          retval = std::max(retval, (int)it->second.size()-1);
+        return retval;
+      }
+
+  };
+
+  /**
+   * Adds the wall time elapsed between its construction and its destruction
+   * (or the call to stop()) to a stage of a profile, if any
+   */
+  class ProfileTimer {
+
+    public:
+
+      ProfileTimer(Profile* profile, const char* stage):
+        m_profile(profile), m_stage(stage),
+        m_level(profile ? profile->level : -1),
+        m_start(profile ? profile_clock() : 0.) {}
+
+      ProfileTimer(Profile* profile, const char* stage, int level):
+        m_profile(profile), m_stage(stage), m_level(level),
+        m_start(profile ? profile_clock() : 0.) {}
+
+      ~ProfileTimer() { stop(); }
+
+      void stop() {
+        if (!m_profile) return;
+        m_profile->add(m_stage, m_level, profile_clock() - m_start);
+        m_profile = 0;
+      }
+
+    private:
+
+      Profile* m_profile;
+      const char* m_stage;
+      int m_level;
+      double m_start;
+
+  };
+
+}}}}
+
+#endif /* BOB_IP_OPTFLOW_LIU_PROFILE_H */
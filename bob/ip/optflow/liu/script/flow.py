@@ -17,6 +17,35 @@ the input is composed of a set of input images, the images **must** be of the
 same size. The output is an HDF5 file that contains the flow estimations
 between every 2 consecutive images in the input data.
 
+Frames are read and processed lazily, and each flow estimation is appended to
+the output file as soon as it is available. Memory usage does not depend on the
+length of the input video or image sequence. Frames are decoded, converted,
+estimated and written by a pipeline of threads, so the next frames are decoded
+while the current ones are estimated: --prefetch sets how many frames may be
+decoded ahead, and --workers how many threads estimate frame pairs. With
+--verbose, the throughput of every stage is printed once done.
+
+Many inputs may be processed in a single run, by listing them in a manifest
+file (option --manifest). Each non-empty line of the manifest lists the input
+file(s) of a video or image sequence followed by its output file, separated by
+white spaces (use quotes for file names containing spaces). Lines starting with
+'#' are ignored. Outputs are written under a temporary name and renamed once
+complete, so an interrupted run may be resumed (option --resume) by skipping
+all outputs that already exist. Inputs with a single frame have no flows, and
+are skipped (with a warning) unless outputs are indexed. With --jobs, frame
+pairs are estimated by a pool of worker processes, while frames are decoded
+once (by the main process) into shared memory. With --cache, estimations are
+kept on disk, and frame pairs that were already estimated with the same
+parameters are loaded from there. With --profile, the time taken by every stage
+of the estimation is printed once all inputs are processed.
+
+Outputs may be made smaller by storing velocities as 32-bit floats (option
+--dtype), by quantizing them to 16-bit integers (option --quantize) and by
+compressing each flow (option --compression). With --indexed, flows are saved
+into a memory-mappable file instead (see bob.ip.optflow.liu.FlowReader), so any
+flow of the output is read in constant time. 16-bit floats are only available
+for indexed outputs.
+
 If you use the results of this script, please consider citing Liu's thesis and
 Bob, as the core framework for this port:
 
@@ -41,14 +70,42 @@ __epilog__ = """examples:
 
   $ %(prog)s cg image1.jpg image2.jpg flow.hdf5
 
-3. Get help for a specific variant (and see defaults for that variant):
+3. Estimate the OF of all inputs listed in a manifest, using 8 processes and
+   skipping the outputs of a previous run:
+
+  $ %(prog)s sor --jobs=8 --resume --manifest=dataset.txt
+
+4. Estimate the OF in a video, storing velocities as multiples of 1/100th of
+   a pixel, into compressed flows:
+
+  $ %(prog)s sor --quantize=0.01 --compression=6 myvideo.avi myflow.hdf5
+
+5. Estimate the OF in a video with 4 threads, decoding up to 16 frames ahead,
+   and print the throughput of every stage of the pipeline:
+
+  $ %(prog)s -v sor --workers=4 --prefetch=16 myvideo.avi myflow.hdf5
+
+6. Get help for a specific variant (and see defaults for that variant):
 
   $ %(prog)s sor -h
 """
 
 import os
 import sys
+import time
+import shlex
+import shutil
 import argparse
+import itertools
+import threading
+import collections
+import multiprocessing
+import tempfile
+import numpy
+try:
+  import queue
+except ImportError: #python 2.x
+  import Queue as queue
 import bob.io.base
 import bob.io.image
 import bob.io.video
@@ -89,12 +146,14 @@ class AliasedSubParsersAction(argparse._SubParsersAction):
     return parser
 
 def add_options(parser, alpha, ratio, min_width, outer, inner, iterations,
-    method, variant):
+    estimator, variant):
 
   if variant.lower() == 'cg':
     parser.add_argument('-g', '--gray-scale', dest='gray', default=False, action='store_true', help="Gray-scales input data before feeding it to the flow estimation. This uses Bob's gray scale conversion instead of the Liu's built-in conversion and may lead to slightly different results.")
   else:
     parser.set_defaults(gray=True)
+    parser.add_argument('--ordering', dest='ordering', default='lexicographic', choices=('lexicographic', 'redblack'), help="Order in which SOR sweeps visit pixels. The red-black ordering splits each sweep over multiple threads, but gives slightly different results (defaults to %(default)s)")
+    parser.add_argument('--threads', dest='threads', default=0, type=int, metavar='N', help="Number of threads used by the red-black ordering. If smaller than 1, use one thread per available core (defaults to %(default)s)")
 
   parser.add_argument('-a', '--alpha', dest='alpha', default=alpha, type=float, metavar='FLOAT', help="Regularization weight (defaults to %(default)s)")
 
@@ -109,53 +168,103 @@ def add_options(parser, alpha, ratio, min_width, outer, inner, iterations,
 
   parser.add_argument('-x', '--iterations', metavar='N', dest='iterations', default=iterations, type=int, help="The number of %s (error-minimization) iterations (defaults to %%(default)s)" % variant)
 
-  parser.add_argument('input', metavar='INPUT', type=str, nargs='+',
-      help="Input file(s) to load")
+  parser.add_argument('-t', '--tolerance', metavar='FLOAT', dest='tol', default=0., type=float, help="If positive, stops each %s loop as soon as it converged to this (relative) tolerance, instead of always running all iterations (defaults to %%(default)s)" % variant)
+
+  parser.add_argument('-w', '--warm-start', dest='warm_start', default=False, action='store_true', help="Starts the estimation of each pair of frames from the flow estimated for the previous pair, instead of starting from zero. Use it with fewer outer (and %s) iterations to speed-up the processing of videos with slowly varying motion" % variant)
+
+  parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int, metavar='N', help="Number of worker processes estimating frame pairs. If smaller than 1, use one process per available core (defaults to %(default)s)")
+
+  parser.add_argument('--workers', dest='workers', default=1, type=int, metavar='N', help="Number of threads estimating frame pairs, while other threads decode and convert the next frames, and write the flows. With more than one, frame pairs are estimated independently, so every frame is smoothed and downsampled twice. If smaller than 1, use one thread per available core (defaults to %(default)s)")
+
+  parser.add_argument('--prefetch', dest='prefetch', default=4, type=int, metavar='N', help="Number of frames decoded (and converted) ahead of the estimation, and of flows waiting to be written. Not used with --jobs (defaults to %(default)s)")
+
+  parser.add_argument('--manifest', dest='manifest', metavar='FILE', help="A file listing, on each line, the input file(s) of a video or image sequence followed by its output file. If given, no input and output files may be given on the command line")
+
+  parser.add_argument('--resume', dest='resume', default=False, action='store_true', help="Skips inputs whose output file already exists (outputs are only created once complete)")
 
-  parser.add_argument('output', metavar='OUTPUT', type=str,
-      help="Where to place the output")
+  parser.add_argument('--cache', dest='cache', metavar='DIR', help="A directory caching flow estimations (see bob.ip.optflow.liu.FlowCache), so frame pairs already estimated with the same parameters are loaded instead of estimated again")
 
-  parser.set_defaults(flow=method)
+  parser.add_argument('--cache-size', dest='cache_size', type=float, metavar='MB', help="Largest size of the cache, in megabytes. If set, the least recently used estimations are removed from the cache once it gets larger (by default, the cache is not limited)")
+
+  parser.add_argument('--profile', dest='profile', default=False, action='store_true', help="Prints the wall time taken by every stage of the estimation (and by every pyramid level), summed over all frame pairs. Frames are then not streamed, so every frame is smoothed and downsampled twice")
+
+  parser.add_argument('--dtype', dest='dtype', default='float64', choices=('float64', 'float32', 'float16'), help="Data type of stored velocities. float16 is only available with --indexed (defaults to %(default)s)")
+
+  parser.add_argument('--quantize', dest='step', type=float, metavar='STEP', help="Stores velocities as 16-bit integers, multiples of STEP pixels (e.g. 0.01), instead of floats. Velocities are then clipped to 32767*STEP pixels")
+
+  parser.add_argument('--compression', dest='compression', default=0, type=int, choices=range(10), metavar='LEVEL', help="Compression level of each flow, from 0 (no compression) to 9 (defaults to %(default)s)")
+
+  parser.add_argument('--indexed', dest='indexed', default=False, action='store_true', help="Saves flows into an indexed (memory-mappable) file instead of an HDF5 one, so any flow is read in constant time (see bob.ip.optflow.liu.FlowReader). Indexed files are not compressed")
+
+  parser.add_argument('files', metavar='FILE', type=str, nargs='*',
+      help="Input file(s) to load, followed by where to place the output")
+
+  parser.set_defaults(estimator=estimator)
   parser.set_defaults(variant=variant)
 
-def main(user_input=None):
+def read_frames(input, frames=None):
+  """Lazily yields the input frames, as decoded
 
-  from .. import cg, sor
+  Parameters:
 
-  parser = argparse.ArgumentParser(description=__doc__, epilog=__epilog__,
-      formatter_class=argparse.RawDescriptionHelpFormatter)
-  # part of the hack to support aliases in subparsers
-  parser.register('action', 'parsers', AliasedSubParsersAction)
+  input
+    A list with either a single video file name or the file names of all
+    images in the sequence
 
-  parser.add_argument('-v', '--verbose', default=False, action='store_true',
-      help="Increases the output verbosity level")
+  frames
+    If set, the maximum number of frames to yield
+  """
 
-  from ..version import module as __version__
-  name = os.path.basename(os.path.splitext(sys.argv[0])[0])
-  parser.add_argument('-V', '--version', action='version',
-      version='Optical Flow Estimation Tool v%s (%s)' % (__version__, name))
+  if len(input) == 1: #assume this is a video sequence
+    sequence = bob.io.video.reader(input[0])
+  else: #assume the user passed a sequence of images
+    sequence = (bob.io.base.load(k) for k in input)
 
-  # secret option to limit the number of video frames to run for (test option)
-  parser.add_argument('--video-frames', dest='frames', type=int, help=argparse.SUPPRESS)
+  if frames: sequence = itertools.islice(sequence, frames)
 
-  # The variants
-  variants_parser = parser.add_subparsers(title='variants', help='Method variants implemented. Note different variants will have different defaults for input parameters following the content available on the original Matlab bindings and demonstrators.')
+  return iter(sequence)
 
-  sor_based = variants_parser.add_parser('sor', aliases=['new'],
-      help='Executes the "newer" variant using Successive Over-Relaxation (SOR) instead of Conjugate Gradient (CG).')
-  add_options(sor_based, 1.0, 0.5, 40, 4, 1, 20, sor.flow, 'SOR')
+def convert_frame(frame, gray=False):
+  """Converts a decoded frame to double-precision in the range [0, 1] (and,
+  if ``gray`` is set, color frames to gray-scale, with
+  :py:func:`bob.ip.color.rgb_to_gray`)"""
 
-  cg_based = variants_parser.add_parser('cg', aliases=['old'],
-      help='Executes the "older" variant using Conjugate Gradient (CG). This was the only available implementation until 11.08.2011 on Ce Liu\'s website.')
-  add_options(cg_based, 0.02, 0.75, 30, 20, 1, 50, cg.flow, 'CG')
+  frame = frame.astype('float64')/255.
+  if gray and len(frame.shape) != 2:
+    frame = bob.ip.color.rgb_to_gray(frame)
+  return frame
 
-  args = parser.parse_args(args=user_input)
+def load_frames(input, frames=None, gray=False):
+  """Lazily yields the input frames, converted by :py:func:`convert_frame`
+  (see :py:func:`read_frames` for the parameters)"""
 
-  for i in args.input:
-    if not os.path.exists(i):
-      parser.error("Input file '%s' cannot be read" % i)
+  for frame in read_frames(input, frames):
+    yield convert_frame(frame, gray)
 
-  dirname = os.path.dirname(args.output)
+def load_manifest(filename):
+  """Reads a manifest, returning a list of tuples ``(inputs, output)``, with
+  the list of input file names and the output file name of every line
+
+  Each (non-empty) line of the manifest lists the input file(s) of a video or
+  image sequence followed by its output file, separated by white spaces, and
+  quoted as in a shell. Lines starting with ``#`` are ignored.
+  """
+
+  jobs = []
+  with open(filename, 'rt') as f:
+    for number, line in enumerate(f, 1):
+      if line.lstrip().startswith('#'): continue
+      files = shlex.split(line)
+      if not files: continue
+      if len(files) < 2:
+        raise ValueError("line %d of manifest '%s' should list at least an input and an output file" % (number, filename))
+      jobs.append((files[:-1], files[-1]))
+  return jobs
+
+def create_directory(filename):
+  """Creates the directory of a file, if it does not exist yet"""
+
+  dirname = os.path.dirname(filename)
 
   if dirname and not os.path.exists(dirname):
     try:
@@ -165,81 +274,642 @@ def main(user_input=None):
       if exc.errno == errno.EEXIST: pass
       else: raise
 
-  flows = []
-  if len(args.input) == 1: #assume this is a video sequence
+class Output(object):
+  """An output file, to which flows are appended as they are estimated
+
+  The file is written (by a :py:class:`bob.ip.optflow.liu.FlowWriter`, with
+  the given ``storage`` options) under a temporary name (the output name, with
+  the suffix ``.part``) and renamed once closed, so existing outputs are always
+  complete (or removed if the file cannot be closed, see
+  :py:meth:`bob.ip.optflow.liu.FlowWriter.close`, or if the run fails, see
+  :py:meth:`abort`). ``pending`` and ``loaded``
+  keep track of the flows still being estimated by worker processes (see
+  :py:func:`run_pool`).
+  """
+
+  def __init__(self, filename, attributes, storage):
+    from ..storage import FlowWriter
+    create_directory(filename)
+    self.filename = filename
+    self.partial = filename + '.part'
+    self.file = FlowWriter(self.partial, attributes, **storage)
+    self.pending = 0
+    self.loaded = False
 
-    if args.frames:
+  def append(self, u, v):
+    self.file.append(u, v)
 
-      if args.verbose:
-        sys.stdout.write('Loading only %d frames from %s...' % \
-            (args.frames, args.input[0]))
-        sys.stdout.flush()
-        sys.stdout.write('Ok\n')
-        sys.stdout.flush()
+  def close(self):
+    try:
+      self.file.close()
+    except ValueError:
+      os.unlink(self.partial)
+      raise
+    os.rename(self.partial, self.filename)
 
-      input = bob.io.video.reader(args.input[0])[:args.frames]
+  def abort(self):
+    """Closes the file, ignoring errors, and removes it (the output is not
+    saved)"""
 
+    try:
+      self.file.close()
+    except Exception:
+      pass
+    if os.path.exists(self.partial): os.unlink(self.partial)
+
+def close_output(output):
+  """Closes an output, returning ``True`` if it was saved, or ``False`` (with a
+  warning) if it was skipped, as HDF5 outputs of inputs with a single frame
+  are"""
+
+  try:
+    output.close()
+  except ValueError as e:
+    sys.stderr.write('Skipped %s: %s\n' % (output.filename, e))
+    sys.stderr.flush()
+    return False
+  return True
+
+class FrameSlots(object):
+  """Shared memory for decoded frames
+
+  Each frame is stored into a slot, a memory-mapped file (under ``/dev/shm``,
+  where available) that worker processes map by name (see
+  :py:func:`slot_frame`).
+  A slot is re-used for another frame of the same shape once released by all
+  of its users. Slots must be released as many times as they were acquired,
+  plus one (for :py:meth:`store`).
+  """
+
+  def __init__(self):
+    shm = '/dev/shm'
+    self.directory = tempfile.mkdtemp(prefix='bob_of_liu',
+        dir=shm if os.path.isdir(shm) else None)
+    self.free = []
+    self.users = {}
+    self.count = 0
+
+  def store(self, frame):
+    """Copies a frame into a free slot, returning its description ``(filename,
+    shape)``"""
+
+    slot = None
+    for k, (filename, shape) in enumerate(self.free):
+      if shape == frame.shape:
+        slot = self.free.pop(k)
+        break
+
+    if slot is None:
+      #frames of another shape will not come back
+      for filename, shape in self.free: os.unlink(filename)
+      del self.free[:]
+      self.count += 1
+      filename = os.path.join(self.directory, '%d.bin' % self.count)
+      slot = (filename, frame.shape)
+      array = numpy.memmap(filename, dtype='float64', mode='w+',
+          shape=frame.shape)
     else:
+      array = numpy.memmap(slot[0], dtype='float64', mode='r+',
+          shape=frame.shape)
+
+    array[:] = frame
+    del array
+    self.users[slot[0]] = 1
+    return slot
+
+  def acquire(self, slot):
+    self.users[slot[0]] += 1
+
+  def release(self, slot):
+    self.users[slot[0]] -= 1
+    if not self.users[slot[0]]:
+      del self.users[slot[0]]
+      self.free.append(slot)
+
+  def close(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+# frames mapped by the current worker process, by file name
+_frames = collections.OrderedDict()
+
+def slot_frame(slot, cache=16):
+  """Returns the frame stored in a slot of :py:class:`FrameSlots`, mapping
+  (and keeping) the slots used last"""
+
+  filename, shape = slot
+  array = _frames.pop(filename, None)
+  if array is None or array.shape != shape:
+    array = numpy.memmap(filename, dtype='float64', mode='r', shape=shape)
+  _frames[filename] = array
+  while len(_frames) > cache: _frames.popitem(last=False)
+  return array
+
+# flow caches opened by the current process, by directory
+_caches = {}
+
+def open_cache(directory, max_size):
+  """Returns the :py:class:`bob.ip.optflow.liu.FlowCache` of a directory,
+  opening it once per process"""
+
+  from ..cache import FlowCache
+  if directory not in _caches:
+    _caches[directory] = FlowCache(directory, max_size)
+  return _caches[directory]
+
+def estimate(variant, i1, i2, kwargs, cache=None):
+  """Estimates the flow between two frames, returning ``(u, v)`` (and the
+  profile of the estimation, if ``kwargs`` asks for it). If ``cache`` is
+  given, it is a tuple ``(directory, max_size)`` of the flow cache to use (see
+  :py:func:`open_cache`)"""
+
+  from .. import cg, sor
+  method = sor.flow if variant == 'SOR' else cg.flow
+  if cache is None:
+    return method(i1, i2, return_warped=False, **kwargs)
+  return open_cache(*cache).flow(method, i1, i2, return_warped=False,
+      **kwargs)
+
+def estimate_pair(variant, slot1, slot2, kwargs, cache=None):
+  """Estimates the flow between the frames of two slots (in a worker process),
+  returning ``(u, v)`` (see :py:func:`estimate`)"""
+
+  return tuple(numpy.array(k) if isinstance(k, numpy.ndarray) else k
+      for k in estimate(variant, slot_frame(slot1), slot_frame(slot2), kwargs,
+        cache))
+
+def merge_profile(total, profile):
+  """Adds the profile of an estimation (see :py:func:`bob.ip.optflow.liu.sor.flow`)
+  to ``total``, the sum of the profiles of previous estimations (an empty
+  dictionary, at first)"""
+
+  def add(stages, other):
+    for name, entry in other.items():
+      stage = stages.setdefault(name, dict(time=0., calls=0))
+      stage['time'] += entry['time']
+      stage['calls'] += entry['calls']
+
+  total['pairs'] = total.get('pairs', 0) + 1
+  total['total'] = total.get('total', 0.) + profile['total']
+  add(total.setdefault('stages', {}), profile['stages'])
+  levels = total.setdefault('levels', [])
+  for k, level in enumerate(profile['levels']):
+    if k == len(levels): levels.append({})
+    add(levels[k], level)
+
+def print_profile(total):
+  """Prints the sum of the profiles of all estimations (see
+  :py:func:`merge_profile`)"""
+
+  if not total:
+    sys.stdout.write('No frame pairs were estimated\n')
+    return
+
+  sys.stdout.write('Estimated %d frame pairs in %.3fs (%.3fs per pair)\n' %
+      (total['pairs'], total['total'], total['total']/total['pairs']))
+  levels = total['levels']
+  sys.stdout.write('%-12s %10s %7s %8s' % ('stage', 'time [s]', 'share',
+    'calls') + ''.join(' %9s' % ('level %d' % k) for k in range(len(levels))) +
+    '\n')
+  stages = sorted(total['stages'].items(), key=lambda k: -k[1]['time'])
+  for name, stage in stages:
+    sys.stdout.write('%-12s %10.3f %6.1f%% %8d' % (name, stage['time'],
+      100*stage['time']/total['total'], stage['calls']))
+    for level in levels:
+      if name in level: sys.stdout.write(' %9.3f' % level[name]['time'])
+      else: sys.stdout.write(' %9s' % '-')
+    sys.stdout.write('\n')
+
+def run_pool(jobs, args, kwargs, attributes, storage, cache=None,
+    profile=None):
+  """Estimates the flows of all jobs ``(inputs, output)``, spreading frame
+  pairs over ``args.jobs`` worker processes. Frames are decoded by the calling
+  process, once, into shared memory. Up to two pairs per worker are queued at
+  any time, and flows are written to their outputs (see :py:class:`Output`)
+  in order. If the run fails, outputs that are not complete are removed (see
+  :py:meth:`Output.abort`). ``cache`` is
+  passed to :py:func:`estimate_pair`. If ``profile`` is given, the profiles of
+  all estimations are added to it (see :py:func:`merge_profile`)."""
+
+  n_jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+  slots = FrameSlots()
+  pool = multiprocessing.Pool(n_jobs)
+  pending = collections.deque()
+  outputs = set() #the ones not closed yet
+
+  def collect():
+    output, slot1, slot2, result = pending.popleft()
+    flows = result.get()
+    output.append(*flows[:2])
+    if profile is not None: merge_profile(profile, flows[2])
+    slots.release(slot1)
+    slots.release(slot2)
+    output.pending -= 1
+    if not output.pending and output.loaded: finish(output)
+
+  def finish(output):
+    outputs.remove(output)
+    if close_output(output) and args.verbose:
+      sys.stdout.write('Saved flows to %s\n' % output.filename)
+      sys.stdout.flush()
 
+  try:
+    for inputs, filename in jobs:
+      output = Output(filename, attributes, storage)
+      outputs.add(output)
+      previous = None
+      for image in load_frames(inputs, args.frames, args.gray):
+        current = slots.store(image)
+        if previous is not None:
+          while len(pending) >= 2*n_jobs: collect()
+          slots.acquire(previous)
+          slots.acquire(current)
+          result = pool.apply_async(estimate_pair, (args.variant, previous,
+            current, kwargs, cache))
+          pending.append((output, previous, current, result))
+          output.pending += 1
+          slots.release(previous)
+        previous = current
+      if previous is not None: slots.release(previous)
+      output.loaded = True
+      if not output.pending: finish(output)
+
+    while pending: collect()
+    pool.close()
+
+  except:
+    pool.terminate()
+    for output in outputs: output.abort()
+    raise
+
+  finally:
+    pool.join()
+    slots.close()
+
+class Stopped(Exception):
+  """Raised by :py:meth:`Pipeline.get` and :py:meth:`Pipeline.put` once the
+  pipeline is stopped"""
+  pass
+
+class Pipeline(object):
+  """Stages running in threads of their own, connected by bounded queues
+
+  Queues hold at most a given number of items, so a stage running ahead of the
+  following ones blocks until they catch up. Once a stage fails, all others
+  stop (see :py:meth:`get` and :py:meth:`put`) and :py:meth:`join` raises the
+  error again. ``stats`` holds, for every stage (in the given order), the
+  number of items it processed and the time it spent processing them (see
+  :py:meth:`add`).
+  """
+
+  def __init__(self, stages):
+    self.stopped = threading.Event()
+    self.error = None
+    self.threads = []
+    self.lock = threading.Lock()
+    self.stats = collections.OrderedDict((k, [0, 0.]) for k in stages)
+
+  def start(self, target, *args):
+    """Runs ``target(*args)`` in a new thread"""
+
+    def run():
+      try:
+        target(*args)
+      except Stopped:
+        pass
+      except BaseException as e:
+        self.stop(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    self.threads.append(thread)
+
+  def stop(self, error=None):
+    """Stops all stages, keeping the first ``error``"""
+
+    with self.lock:
+      if self.error is None: self.error = error
+    self.stopped.set()
+
+  def put(self, items, item):
+    """Puts an item into a queue, waiting for room while it is full"""
+
+    while not self.stopped.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+    raise Stopped()
+
+  def get(self, items):
+    """Returns the next item of a queue, waiting for it while it is empty"""
+
+    while not self.stopped.is_set():
+      try:
+        return items.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    raise Stopped()
+
+  def add(self, stage, start, items=1):
+    """Accounts for ``items`` processed by ``stage`` since ``start`` (see
+    :py:func:`time.time`)"""
+
+    elapsed = time.time() - start
+    with self.lock:
+      self.stats[stage][0] += items
+      self.stats[stage][1] += elapsed
+
+  def join(self):
+    """Waits for all threads, raising the error of the first stage that
+    failed, if any"""
+
+    for thread in self.threads: thread.join()
+    if self.error is not None: raise self.error
+
+def print_stages(stats, elapsed):
+  """Prints the number of items processed by every stage of a
+  :py:class:`Pipeline`, its busy time (over all of its threads) and its
+  throughput, and the wall time of the whole pipeline"""
+
+  sys.stdout.write('%-10s %8s %10s %10s\n' % ('stage', 'items', 'busy [s]',
+    'items/s'))
+  for name, (items, busy) in stats.items():
+    sys.stdout.write('%-10s %8d %10.3f %10.2f\n' % (name, items, busy,
+      items/busy if busy else 0.))
+  pairs = stats['write'][0]
+  sys.stdout.write('Wrote %d frame pairs in %.3fs (%.2f pairs/s)\n' % (pairs,
+    elapsed, pairs/elapsed if elapsed else 0.))
+
+def run_pipeline(jobs, args, kwargs, extra, attributes, storage, cache=None,
+    profile=None):
+  """Estimates the flows of all jobs ``(inputs, output)`` with a pipeline of
+  threads (see :py:class:`Pipeline`): a thread decodes the frames of all
+  inputs, one after the other, another one converts them (see
+  :py:func:`convert_frame`), ``args.workers`` threads estimate the flows of
+  consecutive frames and the calling thread writes them to their outputs (see
+  :py:class:`Output`), in order. At most ``args.prefetch`` items wait between
+  two stages. If a stage fails, outputs that are not complete are removed (see
+  :py:meth:`Output.abort`).
+
+  With a single worker, frames are pushed to the streaming estimator of the
+  variant (``args.estimator``, built with ``extra``), unless ``cache`` or
+  ``profile`` are given (see :py:func:`estimate` and
+  :py:func:`merge_profile`), in which case frame pairs are estimated one after
+  the other (starting, with ``args.warm_start``, from the previous flow). With
+  more workers, frame pairs are estimated independently."""
+
+  n_workers = args.workers if args.workers > 0 else multiprocessing.cpu_count()
+  streaming = n_workers == 1 and cache is None and profile is None
+  pipeline = Pipeline(('decode', 'convert', 'estimate', 'write'))
+  decoded = queue.Queue(args.prefetch)
+  frames = queue.Queue(args.prefetch)
+  results = queue.Queue(args.prefetch)
+
+  def decode():
+    # frames of every input, then ``None`` (the end of the input)
+    for n, (inputs, output) in enumerate(jobs):
+      sequence = read_frames(inputs, args.frames)
+      while True:
+        start = time.time()
+        try:
+          frame = next(sequence)
+        except StopIteration:
+          break
+        pipeline.add('decode', start)
+        pipeline.put(decoded, (n, frame))
+      pipeline.put(decoded, (n, None))
+    pipeline.put(decoded, None)
+
+  def convert():
+    # numbered frames, together with the previous frame of the same input
+    index = 0
+    previous = None
+    for n, frame in iter(lambda: pipeline.get(decoded), None):
+      if frame is not None:
+        start = time.time()
+        frame = convert_frame(frame, args.gray)
+        pipeline.add('convert', start)
+      pipeline.put(frames, (index, n, previous, frame))
+      previous = frame
+      index += 1
+    for k in range(n_workers): pipeline.put(frames, None)
+
+  def work():
+    # the flow of every frame (``None`` for the first frame of each input)
+    estimator = result = None
+    for index, n, previous, frame in iter(lambda: pipeline.get(frames), None):
+      flows = None
+      if frame is None: #end of the input
+        estimator = result = None
+      elif streaming:
+        # the estimator keeps the pyramid of the previous frame, so that each
+        # frame is only smoothed and downsampled once. Warped frames are not
+        # saved, so they are not computed either
+        if estimator is None:
+          estimator = args.estimator(args.alpha, args.ratio, args.min_width,
+              args.outer, args.inner, args.iterations,
+              warm_start=args.warm_start, tol=args.tol, return_warped=False,
+              **extra)
+        start = time.time()
+        flows = estimator.push(frame)
+        pipeline.add('estimate', start, int(flows is not None))
+      elif previous is not None:
+        # cached (or profiled) estimations are keyed on both frames (and on
+        # the initial flow), so the pyramid of the previous frame is not
+        # re-used
+        start = time.time()
+        init_flow = result[:2] if args.warm_start and result else None
+        result = flows = estimate(args.variant, previous, frame,
+            dict(kwargs, init_flow=init_flow), cache)
+        pipeline.add('estimate', start)
+      pipeline.put(results, (index, n, frame is None, flows))
+    pipeline.put(results, None)
+
+  def write(n, last, flows):
+    inputs, filename = jobs[n]
+    if n not in outputs:
+      outputs[n] = Output(filename, attributes, storage)
       if args.verbose:
-        sys.stdout.write('Loading all frames from %s...' % args.input[0])
+        sys.stdout.write('Processing %s' % (inputs[0] if len(inputs) == 1
+          else '%d images' % len(inputs)))
+        sys.stdout.flush()
+    if last:
+      if args.verbose:
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+      if close_output(outputs.pop(n)) and args.verbose:
+        sys.stdout.write('Saved flows to %s\n' % filename)
+        sys.stdout.flush()
+    elif flows is not None:
+      start = time.time()
+      outputs[n].append(*flows[:2])
+      if profile is not None: merge_profile(profile, flows[2])
+      pipeline.add('write', start)
+      if args.verbose:
+        sys.stdout.write('.')
         sys.stdout.flush()
 
-      input = bob.io.base.load(args.input[0])
-
-  else: #assume the user passed a sequence of images
+  start = time.time()
+  pipeline.start(decode)
+  pipeline.start(convert)
+  for k in range(n_workers): pipeline.start(work)
+
+  # flows are written in the order of their frames, so the ones estimated
+  # ahead of others wait here
+  outputs = {}
+  waiting = {}
+  index = 0
+  running = n_workers
+  try:
+    while running:
+      item = pipeline.get(results)
+      if item is None:
+        running -= 1
+        continue
+      waiting[item[0]] = item[1:]
+      while index in waiting:
+        write(*waiting.pop(index))
+        index += 1
+  except Stopped:
+    pass #raised again by join()
+  except BaseException as e:
+    pipeline.stop(e)
+
+  try:
+    pipeline.join()
+  except BaseException:
+    for output in outputs.values(): output.abort()
+    raise
+
+  if args.verbose: print_stages(pipeline.stats, time.time() - start)
 
-    input = [bob.io.base.load(k) for k in args.input]
+def main(user_input=None):
 
-  if args.verbose:
-    sys.stdout.write('Converting %d frames to double...' % len(input))
-    sys.stdout.flush()
+  from .. import cg, sor
 
-  input = [k.astype('float64')/255. for k in input]
+  parser = argparse.ArgumentParser(description=__doc__, epilog=__epilog__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  # part of the hack to support aliases in subparsers
+  parser.register('action', 'parsers', AliasedSubParsersAction)
 
-  if args.verbose:
-    sys.stdout.write('Ok\n')
-    sys.stdout.flush()
+  parser.add_argument('-v', '--verbose', default=False, action='store_true',
+      help="Increases the output verbosity level")
 
-  if args.gray and len(input[0].shape) != 2:
+  from ..version import module as __version__
+  name = os.path.basename(os.path.splitext(sys.argv[0])[0])
+  parser.add_argument('-V', '--version', action='version',
+      version='Optical Flow Estimation Tool v%s (%s)' % (__version__, name))
 
-    if args.verbose:
-      sys.stdout.write('Converting %d frames to grayscale...' % len(input))
-      sys.stdout.flush()
+  # secret option to limit the number of video frames to run for (test option)
+  parser.add_argument('--video-frames', dest='frames', type=int, help=argparse.SUPPRESS)
 
-    input = [bob.ip.color.rgb_to_gray(k) for k in input]
+  # The variants
+  variants_parser = parser.add_subparsers(title='variants', help='Method variants implemented. Note different variants will have different defaults for input parameters following the content available on the original Matlab bindings and demonstrators.')
 
-    if args.verbose:
-      sys.stdout.write('Ok\n')
-      sys.stdout.flush()
+  sor_based = variants_parser.add_parser('sor', aliases=['new'],
+      help='Executes the "newer" variant using Successive Over-Relaxation (SOR) instead of Conjugate Gradient (CG).')
+  add_options(sor_based, 1.0, 0.5, 40, 4, 1, 20, sor.VideoFlow, 'SOR')
 
-  if args.verbose:
-    sys.stdout.write('Processing %d frames' % len(input))
-    sys.stdout.flush()
+  cg_based = variants_parser.add_parser('cg', aliases=['old'],
+      help='Executes the "older" variant using Conjugate Gradient (CG). This was the only available implementation until 11.08.2011 on Ce Liu\'s website.')
+  add_options(cg_based, 0.02, 0.75, 30, 20, 1, 50, cg.VideoFlow, 'CG')
 
-  for index, (i1, i2) in enumerate(zip(input[:-1], input[1:])):
-    if args.verbose:
-      sys.stdout.write('.')
-      sys.stdout.flush()
-    flows.append(args.flow(i1, i2, args.alpha, args.ratio, args.min_width,
-      args.outer, args.inner, args.iterations)[0:2])
+  args = parser.parse_args(args=user_input)
 
-  if args.verbose:
-    sys.stdout.write('\n')
-    sys.stdout.flush()
-
-  if args.verbose:
-    sys.stdout.write('Saving flows to %s\n' % args.output)
-    sys.stdout.flush()
-
-  out = bob.io.base.HDF5File(args.output, 'w')
-  out.set('uv', flows)
-  out.set_attribute('method', args.variant, 'uv')
-  out.set_attribute('alpha', args.alpha, 'uv')
-  out.set_attribute('ratio', args.ratio, 'uv')
-  out.set_attribute('min_width', args.min_width, 'uv')
-  out.set_attribute('n_outer_fp_iterations', args.outer, 'uv')
-  out.set_attribute('n_inner_fp_iterations', args.inner, 'uv')
-  out.set_attribute('n_iterations', args.iterations, 'uv')
+  if args.manifest:
+    if args.files:
+      parser.error("Input and output files cannot be given together with a manifest")
+    try:
+      jobs = load_manifest(args.manifest)
+    except (IOError, ValueError) as e:
+      parser.error(str(e))
+  else:
+    if len(args.files) < 2:
+      parser.error("At least an input and an output file should be given")
+    jobs = [(args.files[:-1], args.files[-1])]
+
+  for inputs, output in jobs:
+    for i in inputs:
+      if not os.path.exists(i):
+        parser.error("Input file '%s' cannot be read" % i)
+
+  if args.jobs != 1 and args.warm_start:
+    parser.error("Warm starts need the frame pairs of each input to be estimated in order, so --warm-start cannot be used with --jobs")
+
+  if args.workers != 1 and args.warm_start:
+    parser.error("Warm starts need the frame pairs of each input to be estimated in order, so --warm-start cannot be used with --workers")
+
+  if args.jobs != 1 and args.workers != 1:
+    parser.error("Frame pairs are either estimated by processes or by threads, so --jobs cannot be used with --workers")
+
+  if args.prefetch < 1:
+    parser.error("--prefetch must be at least 1")
+
+  if args.profile and args.cache:
+    parser.error("Cached estimations are not profiled, so --profile cannot be used with --cache")
+
+  if args.dtype == 'float16' and not args.indexed:
+    parser.error("HDF5 outputs do not support 16-bit floats, so --dtype=float16 needs --indexed")
+
+  if args.step is not None:
+    if args.step <= 0: parser.error("--quantize must be positive")
+    if args.dtype != 'float64':
+      parser.error("Quantized velocities are stored as integers, so --quantize cannot be used with --dtype")
+
+  if args.indexed and args.compression:
+    parser.error("Indexed outputs are not compressed, so --compression cannot be used with --indexed")
+
+  if args.resume:
+    jobs = [k for k in jobs if not os.path.exists(k[1])]
+
+  extra = {}
+  if args.variant == 'SOR':
+    extra = dict(ordering=args.ordering, n_threads=args.threads)
+
+  attributes = [
+      ('method', args.variant),
+      ('alpha', args.alpha),
+      ('ratio', args.ratio),
+      ('min_width', args.min_width),
+      ('n_outer_fp_iterations', args.outer),
+      ('n_inner_fp_iterations', args.inner),
+      ('n_iterations', args.iterations),
+      ('warm_start', int(args.warm_start)),
+      ('tol', args.tol),
+      ] + sorted(extra.items())
+
+  kwargs = dict(alpha=args.alpha, ratio=args.ratio, min_width=args.min_width,
+      n_outer_fp_iterations=args.outer, n_inner_fp_iterations=args.inner,
+      tol=args.tol, **extra)
+  name = 'n_sor_iterations' if args.variant == 'SOR' else 'n_cg_iterations'
+  kwargs[name] = args.iterations
+
+  storage = dict(dtype=args.dtype, compression=args.compression,
+      indexed=args.indexed)
+  if args.step is not None: storage.update(dtype='int16', step=args.step)
+
+  # the sum of the profiles of all estimations
+  profile = None
+  if args.profile:
+    kwargs['profile'] = True
+    profile = {}
+
+  cache = None
+  if args.cache:
+    max_size = None
+    if args.cache_size is not None: max_size = int(args.cache_size * 2**20)
+    cache = (args.cache, max_size)
+
+  if args.jobs != 1:
+    run_pool(jobs, args, kwargs, attributes, storage, cache, profile)
+    if profile is not None: print_profile(profile)
+    return 0
+
+  # flows are appended to the outputs as they are estimated, so only a few
+  # frames and flows are kept in memory
+  run_pipeline(jobs, args, kwargs, extra, attributes, storage, cache, profile)
+  if profile is not None: print_profile(profile)
 
   return 0
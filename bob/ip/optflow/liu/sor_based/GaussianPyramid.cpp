@@ -1,12 +1,16 @@
 #include "GaussianPyramid.h"
 #include "math.h"
+#include <vector>
 
-sor::GaussianPyramid::GaussianPyramid(void)
+template <class T>
+sor::GaussianPyramidT<T>::GaussianPyramidT(void)
 {
 	ImPyramid=NULL;
+	nLevels=0;
 }
 
-sor::GaussianPyramid::~GaussianPyramid(void)
+template <class T>
+sor::GaussianPyramidT<T>::~GaussianPyramidT(void)
 {
 	if(ImPyramid!=NULL)
 		delete []ImPyramid;
@@ -41,23 +45,34 @@ sor::GaussianPyramid::~GaussianPyramid(void)
 // function to construct the pyramid
 // this is the fast way
 //---------------------------------------------------------------------------------------
-void sor::GaussianPyramid::ConstructPyramid(const sor::DImage &image, double ratio, int minWidth)
+template <class T>
+void sor::GaussianPyramidT<T>::ConstructPyramid(const TImage &image, double ratio, int minWidth, bool fast)
 {
 	// the ratio cannot be arbitrary numbers
 	if(ratio>0.98 || ratio<0.4)
 		ratio=0.75;
 	// first decide how many levels
+	int oldLevels=nLevels;
 	nLevels=log((double)minWidth/image.width())/log(ratio);
-	if(ImPyramid!=NULL)
-		delete []ImPyramid;
-	ImPyramid=new sor::DImage[nLevels];
+	// the levels of a previous pyramid are re-used if their number matches
+	if(ImPyramid==NULL || nLevels!=oldLevels)
+	{
+		if(ImPyramid!=NULL)
+			delete []ImPyramid;
+		ImPyramid=new TImage[nLevels];
+	}
+	if(fast)
+	{
+		ConstructPyramidFast(image,ratio);
+		return;
+	}
 	ImPyramid[0].copyData(image);
 	double baseSigma=(1/ratio-1);
 	int n=log(0.25)/log(ratio);
 	double nSigma=baseSigma*n;
+	TImage foo;
 	for(int i=1;i<nLevels;i++)
 	{
-		sor::DImage foo;
 		if(i<=n)
 		{
 			double sigma=baseSigma*i;
@@ -73,22 +88,63 @@ void sor::GaussianPyramid::ConstructPyramid(const sor::DImage &image, double rat
 	}
 }
 
-void sor::GaussianPyramid::ConstructPyramidLevels(const sor::DImage &image, double ratio, int _nLevels)
+//---------------------------------------------------------------------------------------
+// function to construct the pyramid recursively: each level is smoothed and
+// downsampled from the previous one, in a single separable pass, so the full
+// resolution image is filtered once only. The smoothing of each level is
+// chosen so that, composed with the smoothing of the previous levels, it
+// matches the one of ConstructPyramid(). Results are close, but not equal:
+// with ratios above 0.5, the levels of ConstructPyramid() are not smoothed
+// enough to avoid aliasing, which cannot be reproduced from the previous level
+//---------------------------------------------------------------------------------------
+template <class T>
+void sor::GaussianPyramidT<T>::ConstructPyramidFast(const TImage &image, double ratio)
+{
+	ImPyramid[0].copyData(image);
+	double baseSigma=(1/ratio-1);
+	int n=log(0.25)/log(ratio);
+	double nSigma=baseSigma*n;
+	// the smoothing of each level, relative to the full resolution image
+	vector<double> fullSigma(nLevels,0);
+	TImage foo;
+	for(int i=1;i<nLevels;i++)
+	{
+		if(i<=n)
+			fullSigma[i]=baseSigma*i;
+		else
+		{
+			double sigma=nSigma/pow(ratio,i-n);
+			fullSigma[i]=sqrt(fullSigma[i-n]*fullSigma[i-n]+sigma*sigma);
+		}
+		// the remaining smoothing, relative to the size of the previous level
+		double sigma=sqrt(fullSigma[i]*fullSigma[i]-fullSigma[i-1]*fullSigma[i-1])*pow(ratio,i-1);
+		double rate=pow(ratio,i);
+		int width=(double)image.width()*rate;
+		int height=(double)image.height()*rate;
+		ImPyramid[i-1].GaussianSmoothingResize(ImPyramid[i],sigma,sigma*3,width,height,foo);
+	}
+}
+
+template <class T>
+void sor::GaussianPyramidT<T>::ConstructPyramidLevels(const TImage &image, double ratio, int _nLevels)
 {
 	// the ratio cannot be arbitrary numbers
 	if(ratio>0.98 || ratio<0.4)
 		ratio=0.75;
+	if(ImPyramid==NULL || _nLevels!=nLevels)
+	{
+		if(ImPyramid!=NULL)
+			delete []ImPyramid;
+		ImPyramid=new TImage[_nLevels];
+	}
 	nLevels = _nLevels;
-	if(ImPyramid!=NULL)
-		delete []ImPyramid;
-	ImPyramid=new sor::DImage[nLevels];
 	ImPyramid[0].copyData(image);
 	double baseSigma=(1/ratio-1);
 	int n=log(0.25)/log(ratio);
 	double nSigma=baseSigma*n;
+	TImage foo;
 	for(int i=1;i<nLevels;i++)
 	{
-		sor::DImage foo;
 		if(i<=n)
 		{
 			double sigma=baseSigma*i;
@@ -110,3 +166,6 @@ void sor::GaussianPyramid::displayTop(const char *filename)
 	ImPyramid[nLevels-1].imwrite(filename);
 }
 **/
+
+template class sor::GaussianPyramidT<double>;
+template class sor::GaussianPyramidT<float>;
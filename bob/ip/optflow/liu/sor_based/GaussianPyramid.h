@@ -5,21 +5,31 @@
 
 namespace sor {
 
-  class GaussianPyramid
+  template <class T>
+  class GaussianPyramidT
   {
+    public:
+      typedef sor::Image<T> TImage;
     private:
-      DImage* ImPyramid;
+      TImage* ImPyramid;
       int nLevels;
     public:
-      GaussianPyramid(void);
-      ~GaussianPyramid(void);
-      void ConstructPyramid(const DImage& image,double ratio=0.8,int minWidth=30);
-      void ConstructPyramidLevels(const DImage& image,double ratio =0.8,int _nLevels = 2);
+      GaussianPyramidT(void);
+      ~GaussianPyramidT(void);
+      // if fast is set, each level is smoothed and downsampled from the
+      // previous one (see ConstructPyramidFast())
+      void ConstructPyramid(const TImage& image,double ratio=0.8,int minWidth=30,bool fast=false);
+      void ConstructPyramidLevels(const TImage& image,double ratio =0.8,int _nLevels = 2);
       //void displayTop(const char* filename);
+    private:
+      void ConstructPyramidFast(const TImage& image,double ratio);
+    public:
       inline int nlevels() const {return nLevels;};
-      inline DImage& Image(int index) {return ImPyramid[index];};
+      inline TImage& Image(int index) {return ImPyramid[index];};
   };
 
+  typedef GaussianPyramidT<double> GaussianPyramid;
+
 }
 
 #endif
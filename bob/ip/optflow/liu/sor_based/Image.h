@@ -150,6 +150,11 @@ namespace sor {
         template <class T1>
           void GaussianSmoothing(Image<T1>& image,double sigma,int fsize) const;
 
+        // Gaussian smoothing followed by resizing to dstWidth x dstHeight, in
+        // a single (separable) pass. temp is used for the intermediate result
+        template <class T1>
+          void GaussianSmoothingResize(Image<T1>& image,double sigma,int fsize,int dstWidth,int dstHeight,Image<T1>& temp) const;
+
         template <class T1>
           void GaussianSmoothing_transpose(Image<T1>& image,double sigma,int fsize) const;
 
@@ -180,6 +185,11 @@ namespace sor {
         template <class T1>
           void imfilter_hv(Image<T1>& image,const double* hfilter,int hfsize,const double* vfilter,int vfsize) const;
 
+        // same as above, using temp for the intermediate (horizontally
+        // filtered) image instead of a temporary buffer
+        template <class T1>
+          void imfilter_hv(Image<T1>& image,const double* hfilter,int hfsize,const double* vfilter,int vfsize,Image<T1>& temp) const;
+
         template<class T1>
           void imfilter_hv(Image<T1>& image,const Image<double>& hfilter,const Image<double>& vfilter) const;
 
@@ -334,6 +344,11 @@ namespace sor {
         template <class T1,class T2>
           void warpImageBicubic(Image<T>& output,const Image<T1>& coeff,const Image<T2>& vx,const Image<T2>& vy) const;
 
+        // the derivatives bicubic warps interpolate with, to warp the image
+        // several times without computing them again
+        template <class T1>
+          void bicubicDerivatives(Image<T1>& imdx,Image<T1>& imdy,Image<T1>& imdxdy) const;
+
         template <class T1,class T2>
           void warpImageBicubicRef(const Image<T>& ref,Image<T>& output,const Image<T1>& imdx,const Image<T1>& imdy, const Image<T1>& imdxdy,const Image<T2>& vx,const Image<T2>& vy) const;
 
@@ -446,6 +461,7 @@ namespace sor {
       pData=NULL;
       imWidth=imHeight=nChannels=nPixels=nElements=0;
       IsDerivativeImage=false;
+      colorType=RGB;
     }
 
   //------------------------------------------------------------------------------------------
@@ -463,12 +479,14 @@ namespace sor {
       if(nElements>0)
         memset(pData,0,sizeof(T)*nElements);
       IsDerivativeImage=false;
+      colorType=RGB;
     }
 
   template <class T>
     Image<T>::Image(const T& value,int _width,int _height,int _nchannels)
     {
       pData=NULL;
+      colorType=RGB;
       allocate(_width,_height,_nchannels);
       setValue(value);
     }
@@ -485,6 +503,18 @@ namespace sor {
   template <class T>
     void Image<T>::allocate(int width,int height,int nchannels)
     {
+      // re-uses the current buffer if it holds as many elements, so images
+      // that are re-allocated over and over (e.g. the temporary images of a
+      // workspace) keep the same memory
+      if(pData!=NULL && nElements>0 && width*height*nchannels==nElements)
+      {
+        imWidth=width;
+        imHeight=height;
+        nChannels=nchannels;
+        computeDimension();
+        memset(pData,0,sizeof(T)*nElements);
+        return;
+      }
       clear();
       imWidth=width;
       imHeight=height;
@@ -743,7 +773,7 @@ namespace sor {
   template <class T>
     void Image<T>::imresize(int dstWidth,int dstHeight)
     {
-      DImage foo(dstWidth,dstHeight,nChannels);
+      Image<T> foo(dstWidth,dstHeight,nChannels);
       ImageProcessing::ResizeImage(pData,foo.data(),imWidth,imHeight,nChannels,dstWidth,dstHeight);
       copyData(foo);
     }
@@ -1104,6 +1134,32 @@ namespace sor {
       delete[] gFilter;
     }
 
+  template <class T>
+    template <class T1>
+    void Image<T>::GaussianSmoothingResize(Image<T1>& image,double sigma,int fsize,int dstWidth,int dstHeight,Image<T1>& temp) const
+    {
+      // constructing the 1D gaussian filter
+      double* gFilter;
+      gFilter=new double[fsize*2+1];
+      double sum=0;
+      sigma=sigma*sigma*2;
+      for(int i=-fsize;i<=fsize;i++)
+      {
+        gFilter[i+fsize]=exp(-(double)(i*i)/sigma);
+        sum+=gFilter[i+fsize];
+      }
+      for(int i=0;i<2*fsize+1;i++)
+        gFilter[i]/=sum;
+
+      if(image.width()!=dstWidth || image.height()!=dstHeight || image.nchannels()!=nChannels)
+        image.allocate(dstWidth,dstHeight,nChannels);
+      if(temp.width()!=dstWidth || temp.height()!=imHeight || temp.nchannels()!=nChannels)
+        temp.allocate(dstWidth,imHeight,nChannels);
+      ImageProcessing::SmoothResizeImage(pData,image.data(),imWidth,imHeight,nChannels,dstWidth,dstHeight,gFilter,fsize,temp.data());
+
+      delete[] gFilter;
+    }
+
   //------------------------------------------------------------------------------------------
   // function to do Gaussian smoothing
   //------------------------------------------------------------------------------------------
@@ -1235,6 +1291,18 @@ namespace sor {
       delete[] pTempBuffer;
     }
 
+  template <class T>
+    template <class T1>
+    void Image<T>::imfilter_hv(Image<T1> &image, const double *hfilter, int hfsize, const double *vfilter, int vfsize, Image<T1> &temp) const
+    {
+      if(matchDimension(image)==false)
+        image.allocate(imWidth,imHeight,nChannels);
+      if(matchDimension(temp)==false)
+        temp.allocate(imWidth,imHeight,nChannels);
+      ImageProcessing::hfiltering(pData,temp.data(),imWidth,imHeight,nChannels,hfilter,hfsize);
+      ImageProcessing::vfiltering(temp.data(),image.data(),imWidth,imHeight,nChannels,vfilter,vfsize);
+    }
+
   template <class T>
     template <class T1>
     void Image<T>::imfilter_hv(Image<T1>& image,const Image<double>& hfilter,const Image<double>& vfilter) const
@@ -2268,7 +2336,7 @@ namespace sor {
             // save the coefficients
             for(int ii = 0;ii<4;ii++)
               for(int jj=0;jj<4;jj++)
-                a[ii][jj] = coeff.pData[(offset*nChannels+k)*16+ii*4+jj];
+                a[ii][jj] = coeff.pData[((y0*imWidth+x0)*nChannels+k)*16+ii*4+jj];
 
 
             // set the sampling coefficients
@@ -2377,12 +2445,19 @@ namespace sor {
     template <class T1>
     void Image<T>::warpImageBicubicRef(const Image<T>& ref,Image<T>& output,const Image<T1>& vx,const Image<T1>& vy) const
     {
-      double dfilter[3] = {-0.5,0,0.5};
       DImage imdx,imdy,imdxdy;
+      bicubicDerivatives(imdx,imdy,imdxdy);
+      warpImageBicubicRef(ref,output,imdx,imdy,imdxdy,vx,vy);
+    }
+
+  template <class T>
+    template <class T1>
+    void Image<T>::bicubicDerivatives(Image<T1>& imdx,Image<T1>& imdy,Image<T1>& imdxdy) const
+    {
+      double dfilter[3] = {-0.5,0,0.5};
       imfilter_h(imdx,dfilter,1);
       imfilter_v(imdy,dfilter,1);
       imdx.imfilter_v(imdxdy,dfilter,1);
-      warpImageBicubicRef(ref,output,imdx,imdy,imdxdy,vx,vy);
     }
 
   template <class T>
@@ -2409,12 +2484,19 @@ namespace sor {
       }
     }
 
+  //-----------------------------------------------------------------------------------------------------------------------
+  // bicubic warp, given the derivatives of the image (see bicubicDerivatives()). Rows are warped in two passes. First, in
+  // a loop without branches, the patch each pixel of the row moves to is found, with the weights of the values and of the
+  // derivatives at its corners: the cubic Hermite basis functions at dx and dy, the same for all channels. Then, the
+  // sample of every channel is the weighted sum of its corners, the polynomial of BicubicCoeff() evaluated in another
+  // order (results only differ by rounding)
+  //-----------------------------------------------------------------------------------------------------------------------
   template <class T>
     template <class T1,class T2>
     void Image<T>::warpImageBicubicRef(const Image<T>& ref,Image<T>& output,const Image<T1>& imdx,const Image<T1>& imdy,const Image<T1>& imdxdy,
         const Image<T2>& vx,const Image<T2>& vy) const
     {
-      T* pIm = pData;
+      const T* pIm = pData;
       const T1* pImDx = imdx.data();
       const T1* pImDy = imdy.data();
       const T1* pImDxDy = imdxdy.data();
@@ -2422,67 +2504,72 @@ namespace sor {
       int height = vx.height();
       if(!output.matchDimension(width,height,nChannels))
         output.allocate(width,height,nChannels);
-      double a[4][4];
-      int offsets[2][2];
-
-      /**
-      T ImgMax;
-      if(IsFloat())
-        ImgMax = 1;
-      else
-        ImgMax = 255;
-      **/
+      vector<int> inside(width),corners(4*width);
+      // the weights and the samples are in the precision of the image
+      vector<T> weights(8*width);
 
       for(int i  = 0; i<height; i++)
+      {
+        const T2* pVx = vx.pData+i*width;
+        const T2* pVy = vy.pData+i*width;
         for(int j = 0;j<width;j++)
         {
-          int offset = i*width+j;
-          double x = j + vx.pData[offset];
-          double y = i + vy.pData[offset];
-          if(x<0 || x>imWidth-1 || y<0 || y>imHeight-1)
-          {
-            for(int k = 0; k<nChannels;k++)
-              output.pData[offset*nChannels+k] = ref.pData[offset*nChannels+k];
-            continue;
-          }
-          int x0 = x;
-          int y0 = y;
-          int x1 = x0+1;
-          int y1 = y0+1;
-          x0 = __min(__max(x0,0),imWidth-1);
-          x1 = __min(__max(x1,0),imWidth-1);
-          y0 = __min(__max(y0,0),imHeight-1);
-          y1 = __min(__max(y1,0),imHeight-1);
+          double x = j + pVx[j];
+          double y = i + pVy[j];
+          inside[j] = (x>=0) & (x<=imWidth-1) & (y>=0) & (y<=imHeight-1);
+          // pixels moving out of the image sample themselves, and are replaced by the reference below
+          x = inside[j]?x:j;
+          y = inside[j]?y:i;
+          int x0 = __min(__max((int)x,0),imWidth-1);
+          int y0 = __min(__max((int)y,0),imHeight-1);
+          int x1 = __min(x0+1,imWidth-1);
+          int y1 = __min(y0+1,imHeight-1);
+          corners[4*j] = (y0*imWidth+x0)*nChannels;
+          corners[4*j+1] = (y0*imWidth+x1)*nChannels;
+          corners[4*j+2] = (y1*imWidth+x0)*nChannels;
+          corners[4*j+3] = (y1*imWidth+x1)*nChannels;
 
           double dx = x - x0;
-          double dy = y- y0;
+          double dy = y - y0;
           double dx2 = dx*dx;
           double dy2 = dy*dy;
           double dx3 = dx*dx2;
           double dy3 = dy*dy2;
+          T* w = &weights[8*j];
+          w[0] = 2*dx3 - 3*dx2 + 1; // value at x0
+          w[1] = -2*dx3 + 3*dx2;    // value at x1
+          w[2] = dx3 - 2*dx2 + dx;  // derivative at x0
+          w[3] = dx3 - dx2;         // derivative at x1
+          w[4] = 2*dy3 - 3*dy2 + 1;
+          w[5] = -2*dy3 + 3*dy2;
+          w[6] = dy3 - 2*dy2 + dy;
+          w[7] = dy3 - dy2;
+        }
 
-
+        for(int j = 0;j<width;j++)
+        {
+          int offset = (i*width+j)*nChannels;
+          if(!inside[j])
+          {
+            for(int k = 0; k<nChannels;k++)
+              output.pData[offset+k] = ref.pData[offset+k];
+            continue;
+          }
+          const int* c = &corners[4*j];
+          const T* wx = &weights[8*j];
+          const T* wy = wx+4;
           for(int k = 0;k<nChannels;k++)
           {
-            offsets[0][0] = (y0*imWidth+x0)*nChannels + k;
-            offsets[1][0] = (y0*imWidth+x1)*nChannels + k;
-            offsets[0][1] = (y1*imWidth+x0)*nChannels + k;
-            offsets[1][1] = (y1*imWidth+x1)*nChannels + k;
-
-            // set the sampling coefficients
-            BicubicCoeff(a,pIm,pImDx,pImDy,pImDxDy,offsets);
-
-            // now use the coefficients for interpolation
-            output.pData[offset*nChannels+k] = a[0][0] +          a[0][1]*dy +          a[0][2]*dy2 +           a[0][3]*dy3+
-              a[1][0]*dx +   a[1][1]*dx*dy   + a[1][2]*dx*dy2   + a[1][3]*dx*dy3 +
-              a[2][0]*dx2 + a[2][1]*dx2*dy + a[2][2]*dx2*dy2 + a[2][3]*dx2*dy3+
-              a[3][0]*dx3 + a[3][1]*dx3*dy + a[3][2]*dx3*dy2 + a[3][3]*dx3*dy3;
-            //output.pData[offset*nChannels+k] = __max(__min(output.pData[offset*nChannels+k],ImgMax),0);
-            //if(!(output.pData[offset*nChannels+k]<100000 && output.pData[offset*nChannels+k]>-100000)) // bound the values
-            //	output.pData[offset*nChannels+k] = ref.pData[offset*nChannels+k];
-
+            const int o00 = c[0]+k, o10 = c[1]+k, o01 = c[2]+k, o11 = c[3]+k;
+            // interpolate the values and the vertical derivatives along rows y0 and y1, then along the column
+            T f0 = wx[0]*pIm[o00] + wx[1]*pIm[o10] + wx[2]*pImDx[o00] + wx[3]*pImDx[o10];
+            T f1 = wx[0]*pIm[o01] + wx[1]*pIm[o11] + wx[2]*pImDx[o01] + wx[3]*pImDx[o11];
+            T fy0 = wx[0]*pImDy[o00] + wx[1]*pImDy[o10] + wx[2]*pImDxDy[o00] + wx[3]*pImDxDy[o10];
+            T fy1 = wx[0]*pImDy[o01] + wx[1]*pImDy[o11] + wx[2]*pImDxDy[o01] + wx[3]*pImDxDy[o11];
+            output.pData[offset+k] = wy[0]*f0 + wy[1]*f1 + wy[2]*fy0 + wy[3]*fy1;
           }
         }
+      }
     }
 
   template <class T>
@@ -2537,7 +2624,7 @@ namespace sor {
             // load the coefficients
             for(int ii = 0;ii<4;ii++)
               for(int jj=0;jj<4;jj++)
-                a[ii][jj] = coeff.pData[(offset*nChannels+k)*16+ii*4+jj];
+                a[ii][jj] = coeff.pData[((y0*imWidth+x0)*nChannels+k)*16+ii*4+jj];
 
 
             // now use the coefficients for interpolation
@@ -2736,6 +2823,7 @@ namespace sor {
     {
       if(imWidth!=_width || imHeight!=_height || nChannels!=_nchannels)
         allocate(_width,_height,_nchannels);
+      colorType = RGB; // the color is RGB when we use matlab to load the image
       int offset=0;
       for(int i=0;i<imHeight;i++)
         for(int j=0;j<imWidth;j++)
@@ -5,6 +5,7 @@
 #include "stdio.h"
 #include "stdlib.h"
 #include <typeinfo>
+#include <vector>
 
 //----------------------------------------------------------------------------------
 // class to handle basic image processing functions
@@ -14,6 +15,13 @@
 
 namespace sor {
 
+  // the precision in which filters and interpolation weights are applied to
+  // images of type T: float images are processed in single precision, so their
+  // pixels are not converted to double (and back) for every tap, all others in
+  // double
+  template <class T> struct FilterPrecision { typedef double type; };
+  template <> struct FilterPrecision<float> { typedef float type; };
+
   class ImageProcessing
   {
     public:
@@ -46,6 +54,13 @@ namespace sor {
       template <class T1,class T2>
         static void ResizeImage(const T1* pSrcImage,T2* pDstImage,int SrcWidth,int SrcHeight,int nChannels,int DstWidth,int DstHeight);
 
+      // same as filtering the image with pfilter1D (along both directions)
+      // and then resizing it, in two (separable) passes. pTemp must hold
+      // DstWidth*SrcHeight*nChannels elements
+      template <class T1,class T2>
+        static void SmoothResizeImage(const T1* pSrcImage,T2* pDstImage,int SrcWidth,int SrcHeight,int nChannels,int DstWidth,int DstHeight,
+            const double* pfilter1D,int fsize,T2* pTemp);
+
       //---------------------------------------------------------------------------------
       // functions for 1D filtering
       //---------------------------------------------------------------------------------
@@ -241,6 +256,80 @@ namespace sor {
         }
     }
 
+  //------------------------------------------------------------------------------------------------------------
+  // the taps of 1D filtering followed by (bilinear) interpolation at (j+1)/Ratio-1, for all output pixels j.
+  // pIndex and pWeight must hold DstSize*(4*fsize+2) elements
+  //------------------------------------------------------------------------------------------------------------
+  template <class T>
+    static void smoothResizeTaps(int* pIndex,double* pWeight,int SrcSize,int DstSize,const T* pfilter1D,int fsize)
+    {
+      double Ratio=(double)DstSize/SrcSize;
+      int nTaps=4*fsize+2;
+      for(int j=0;j<DstSize;j++)
+      {
+        double x=(double)(j+1)/Ratio-1;
+        int xx=x;
+        double dx=__max(__min(x-xx,1),0);
+        int t=j*nTaps;
+        for(int m=0;m<=1;m++)
+        {
+          int u=ImageProcessing::EnforceRange(xx+m,SrcSize);
+          double s=fabs(1-m-dx);
+          for(int l=-fsize;l<=fsize;l++,t++)
+          {
+            pIndex[t]=ImageProcessing::EnforceRange(u+l,SrcSize);
+            pWeight[t]=pfilter1D[l+fsize]*s;
+          }
+        }
+      }
+    }
+
+  template <class T1,class T2>
+    void ImageProcessing::SmoothResizeImage(const T1* pSrcImage,T2* pDstImage,int SrcWidth,int SrcHeight,int nChannels,int DstWidth,int DstHeight,
+        const double* pfilter1D,int fsize,T2* pTemp)
+    {
+      int nTaps=4*fsize+2;
+      int nMax=__max(DstWidth,DstHeight);
+      int* pIndex=new int[nMax*nTaps];
+      double* pWeight=new double[nMax*nTaps];
+
+      // horizontal pass, from SrcWidth to DstWidth columns
+      smoothResizeTaps(pIndex,pWeight,SrcWidth,DstWidth,pfilter1D,fsize);
+      memset(pTemp,0,sizeof(T2)*DstWidth*SrcHeight*nChannels);
+      for(int i=0;i<SrcHeight;i++)
+      {
+        const T1* pSrc=pSrcImage+i*SrcWidth*nChannels;
+        T2* pBuffer=pTemp+i*DstWidth*nChannels;
+        for(int j=0;j<DstWidth;j++,pBuffer+=nChannels)
+          for(int t=j*nTaps;t<(j+1)*nTaps;t++)
+          {
+            const T1* pPixel=pSrc+pIndex[t]*nChannels;
+            double w=pWeight[t];
+            for(int k=0;k<nChannels;k++)
+              pBuffer[k]+=pPixel[k]*w;
+          }
+      }
+
+      // vertical pass, from SrcHeight to DstHeight rows, over whole rows
+      smoothResizeTaps(pIndex,pWeight,SrcHeight,DstHeight,pfilter1D,fsize);
+      int lineWidth=DstWidth*nChannels;
+      memset(pDstImage,0,sizeof(T2)*lineWidth*DstHeight);
+      for(int i=0;i<DstHeight;i++)
+      {
+        T2* pBuffer=pDstImage+i*lineWidth;
+        for(int t=i*nTaps;t<(i+1)*nTaps;t++)
+        {
+          const T2* pRow=pTemp+pIndex[t]*lineWidth;
+          double w=pWeight[t];
+          for(int k=0;k<lineWidth;k++)
+            pBuffer[k]+=pRow[k]*w;
+        }
+      }
+
+      delete[] pIndex;
+      delete[] pWeight;
+    }
+
   //------------------------------------------------------------------------------------------------------------
   //  horizontal direction filtering
   //------------------------------------------------------------------------------------------------------------
@@ -249,12 +338,22 @@ namespace sor {
     {
       memset(pDstImage,0,sizeof(T2)*width*height*nChannels);
       T2* pBuffer;
-      double w;
+      typename FilterPrecision<T2>::type w;
       int i,j,l,k,offset,jj;
+      // pixels closer than fsize to the left or right border need clamping,
+      // the interior is filtered along the (contiguous) rows, tap by tap.
+      // Taps are accumulated in the same order for all pixels
+      int left=__min(fsize,width);
+      int right=__max(width-fsize,left);
       for(i=0;i<height;i++)
+      {
+        offset=i*width*nChannels;
         for(j=0;j<width;j++)
         {
-          offset=i*width*nChannels;
+          if(j==left)
+            j=right;
+          if(j>=width)
+            break;
           pBuffer=pDstImage+offset+j*nChannels;
           for(l=-fsize;l<=fsize;l++)
           {
@@ -264,6 +363,15 @@ namespace sor {
               pBuffer[k]+=pSrcImage[offset+jj*nChannels+k]*w;
           }
         }
+        pBuffer=pDstImage+offset;
+        for(l=-fsize;l<=fsize;l++)
+        {
+          w=pfilter1D[l+fsize];
+          const T1* pSrc=pSrcImage+offset+l*nChannels;
+          for(k=left*nChannels;k<right*nChannels;k++)
+            pBuffer[k]+=pSrc[k]*w;
+        }
+      }
     }
 
   //------------------------------------------------------------------------------------------------------------
@@ -274,7 +382,7 @@ namespace sor {
     {
       memset(pDstImage,0,sizeof(T2)*width*height*nChannels);
       const T1* pBuffer;
-      double w;
+      typename FilterPrecision<T2>::type w;
       int i,j,l,k,offset,jj;
       for(i=0;i<height;i++)
         for(j=0;j<width;j++)
@@ -339,20 +447,22 @@ namespace sor {
     {
       memset(pDstImage,0,sizeof(T2)*width*height*nChannels);
       T2* pBuffer;
-      double w;
-      int i,j,l,k,ii;
+      typename FilterPrecision<T2>::type w;
+      int i,l,k,ii;
+      // whole (contiguous) rows are accumulated, tap by tap
+      int lineWidth=width*nChannels;
       for(i=0;i<height;i++)
-        for(j=0;j<width;j++)
+      {
+        pBuffer=pDstImage+i*lineWidth;
+        for(l=-fsize;l<=fsize;l++)
         {
-          pBuffer=pDstImage+(i*width+j)*nChannels;
-          for(l=-fsize;l<=fsize;l++)
-          {
-            w=pfilter1D[l+fsize];
-            ii=EnforceRange(i+l,height);
-            for(k=0;k<nChannels;k++)
-              pBuffer[k]+=pSrcImage[(ii*width+j)*nChannels+k]*w;
-          }
+          w=pfilter1D[l+fsize];
+          ii=EnforceRange(i+l,height);
+          const T1* pSrc=pSrcImage+ii*lineWidth;
+          for(k=0;k<lineWidth;k++)
+            pBuffer[k]+=pSrc[k]*w;
         }
+      }
     }
 
   //------------------------------------------------------------------------------------------------------------
@@ -363,7 +473,7 @@ namespace sor {
     {
       memset(pDstImage,0,sizeof(T2)*width*height*nChannels);
       const T1* pBuffer;
-      double w;
+      typename FilterPrecision<T2>::type w;
       int i,j,l,k,offset,ii;
       for(i=0;i<height;i++)
         for(j=0;j<width;j++)
@@ -388,10 +498,10 @@ namespace sor {
   template <class T1,class T2>
     void ImageProcessing::filtering(const T1* pSrcImage,T2* pDstImage,int width,int height,int nChannels,const double* pfilter2D,int fsize)
     {
-      double w;
+      typename FilterPrecision<T2>::type w;
       int i,j,u,v,k,ii,jj,wsize,offset;
       wsize=fsize*2+1;
-      double* pBuffer=new double[nChannels];
+      typename FilterPrecision<T2>::type* pBuffer=new typename FilterPrecision<T2>::type[nChannels];
       for(i=0;i<height;i++)
         for(j=0;j<width;j++)
         {
@@ -420,7 +530,7 @@ namespace sor {
   template <class T1,class T2>
     void ImageProcessing::filtering_transpose(const T1* pSrcImage,T2* pDstImage,int width,int height,int nChannels,const double* pfilter2D,int fsize)
     {
-      double w;
+      typename FilterPrecision<T2>::type w;
       int i,j,u,v,k,ii,jj,wsize;
       wsize=fsize*2+1;
       memset(pDstImage,0,sizeof(T2)*width*height*nChannels);
@@ -465,27 +575,63 @@ namespace sor {
   //------------------------------------------------------------------------------------------------------------
   // function to warp an image with respect to flow field
   // pWarpIm2 has to be allocated before hands
+  // rows are warped in two passes: the sampling positions and weights of all pixels of the row are computed
+  // first, in a loop without branches nor calls, then the samples are gathered. Results are the ones of
+  // BilinearInterpolate()
   //------------------------------------------------------------------------------------------------------------
   template <class T1,class T2>
     void ImageProcessing::warpImage(T1 *pWarpIm2, const T1 *pIm1, const T1 *pIm2, const T2 *pVx, const T2 *pVy, int width, int height, int nChannels)
     {
-      memset(pWarpIm2,0,sizeof(T1)*width*height*nChannels);
+      std::vector<int> inside(width),col0(width),col1(width),row0(width),row1(width);
+      // the interpolation weights are in the precision of the image
+      typedef typename FilterPrecision<T1>::type W;
+      std::vector<W> dx(width),dy(width);
       for(int i=0;i<height;i++)
+      {
+        const T2* pRowVx=pVx+i*width;
+        const T2* pRowVy=pVy+i*width;
         for(int j=0;j<width;j++)
         {
-          int offset=i*width+j;
-          double x,y;
-          y=i+pVy[offset];
-          x=j+pVx[offset];
-          offset*=nChannels;
-          if(x<0 || x>width-1 || y<0 || y>height-1)
+          double x=j+pRowVx[j];
+          double y=i+pRowVy[j];
+          inside[j]=(x>=0) & (x<=width-1) & (y>=0) & (y<=height-1);
+          // pixels moving out of the image sample themselves, and are replaced below
+          x=inside[j]?x:j;
+          y=inside[j]?y:i;
+          int xx=x;
+          int yy=y;
+          dx[j]=x-xx;
+          dy[j]=y-yy;
+          col0[j]=xx*nChannels;
+          col1[j]=__min(xx+1,width-1)*nChannels;
+          row0[j]=yy*width*nChannels;
+          row1[j]=__min(yy+1,height-1)*width*nChannels;
+        }
+        for(int j=0;j<width;j++)
+        {
+          int offset=(i*width+j)*nChannels;
+          if(!inside[j])
           {
             for(int k=0;k<nChannels;k++)
               pWarpIm2[offset+k]=pIm1[offset+k];
             continue;
           }
-          BilinearInterpolate(pIm2,width,height,nChannels,x,y,pWarpIm2+offset);
+          const T1* p00=pIm2+row0[j]+col0[j];
+          const T1* p01=pIm2+row1[j]+col0[j];
+          const T1* p10=pIm2+row0[j]+col1[j];
+          const T1* p11=pIm2+row1[j]+col1[j];
+          W s00=(1-dx[j])*(1-dy[j]),s01=(1-dx[j])*dy[j],s10=dx[j]*(1-dy[j]),s11=dx[j]*dy[j];
+          for(int k=0;k<nChannels;k++)
+          {
+            T1 result=0;
+            result+=p00[k]*s00;
+            result+=p01[k]*s01;
+            result+=p10[k]*s10;
+            result+=p11[k]*s11;
+            pWarpIm2[offset+k]=result;
+          }
         }
+      }
     }
 
   template <class T1,class T2>
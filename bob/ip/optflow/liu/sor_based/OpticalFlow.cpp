@@ -3,52 +3,66 @@
 #include "GaussianPyramid.h"
 #include <cstdlib> 
 #include <iostream>
+#include <algorithm>
+#include <limits>
+#include "../parallel.h"
+#include "../dataterm.h"
 
 
 using namespace std;
+using bob::ip::optflow::liu::effective_threads;
+using bob::ip::optflow::liu::parallel_for;
+using bob::ip::optflow::liu::ProfileTimer;
+using bob::ip::optflow::liu::assemble_data_term;
 
 #ifndef _MATLAB
-	bool sor::OpticalFlow::IsDisplay=true;
+	bool sor::OpticalFlowBase::IsDisplay=true;
 #else
-	bool sor::OpticalFlow::IsDisplay=false;
+	bool sor::OpticalFlowBase::IsDisplay=false;
 #endif
 
-//sor::OpticalFlow::InterpolationMethod sor::OpticalFlow::interpolation = sor::OpticalFlow::Bicubic;
-sor::OpticalFlow::InterpolationMethod sor::OpticalFlow::interpolation = sor::OpticalFlow::Bilinear;
-sor::OpticalFlow::NoiseModel sor::OpticalFlow::noiseModel = sor::OpticalFlow::Lap;
-sor::GaussianMixture sor::OpticalFlow::GMPara;
-sor::Vector<double> sor::OpticalFlow::LapPara;
-
-
-sor::OpticalFlow::OpticalFlow(void)
+template <class T>
+sor::OpticalFlowT<T>::OpticalFlowT(void)
 {
+	//interpolation = Bicubic;
+	interpolation = Bilinear;
+	noiseModel = Lap;
+	ordering = Lexicographic;
+	solver = SORSolver;
+	nThreads = 0;
+	fastPyramid = false;
+	profile = NULL;
 }
 
-sor::OpticalFlow::~OpticalFlow(void)
+template <class T>
+sor::OpticalFlowT<T>::~OpticalFlowT(void)
 {
 }
 
 //--------------------------------------------------------------------------------------------------------
 //  function to compute dx, dy and dt for motion estimation
 //--------------------------------------------------------------------------------------------------------
-void sor::OpticalFlow::getDxs(sor::DImage &imdx, sor::DImage &imdy, sor::DImage &imdt, const sor::DImage &im1, const sor::DImage &im2)
+template <class T>
+void sor::OpticalFlowT<T>::getDxs(TImage &imdx, TImage &imdy, TImage &imdt, const TImage &im1, const TImage &im2, LevelBuffers* buffers)
 {
 	//double gfilter[5]={0.01,0.09,0.8,0.09,0.01};
 	double gfilter[5]={0.02,0.11,0.74,0.11,0.02};
 	//double gfilter[5]={0,0,1,0,0};
 	if(1)
 	{
-		//sor::DImage foo,Im;
+		//TImage foo,Im;
 		//Im.Add(im1,im2);
 		//Im.Multiplywith(0.5);
 		////foo.imfilter_hv(Im,gfilter,2,gfilter,2);
 		//Im.dx(imdx,true);
 		//Im.dy(imdy,true);
 		//imdt.Subtract(im2,im1);
-		sor::DImage Im1,Im2,Im;
+		LevelBuffers localBuffers;
+		LevelBuffers& b=(buffers!=NULL)?*buffers:localBuffers;
+		TImage &Im1=b.smooth1,&Im2=b.smooth2,&Im=b.smooth;
 		
-		im1.imfilter_hv(Im1,gfilter,2,gfilter,2);
-		im2.imfilter_hv(Im2,gfilter,2,gfilter,2);
+		im1.imfilter_hv(Im1,gfilter,2,gfilter,2,b.filter);
+		im2.imfilter_hv(Im2,gfilter,2,gfilter,2,b.filter);
 		Im.copyData(Im1);
 		Im.Multiplywith(0.4);
 		Im.Add(Im2,0.6);
@@ -63,7 +77,7 @@ void sor::OpticalFlow::getDxs(sor::DImage &imdx, sor::DImage &imdy, sor::DImage
 	else
 	{
 		// Im1 and Im2 are the smoothed version of im1 and im2
-		sor::DImage Im1,Im2;
+		TImage Im1,Im2;
 		
 		im1.imfilter_hv(Im1,gfilter,2,gfilter,2);
 		im2.imfilter_hv(Im2,gfilter,2,gfilter,2);
@@ -85,7 +99,8 @@ void sor::OpticalFlow::getDxs(sor::DImage &imdx, sor::DImage &imdy, sor::DImage
 //--------------------------------------------------------------------------------------------------------
 // function to do sanity check: imdx*du+imdy*dy+imdt=0
 //--------------------------------------------------------------------------------------------------------
-void sor::OpticalFlow::SanityCheck(const sor::DImage &imdx, const sor::DImage &imdy, const sor::DImage &imdt, double du, double dv)
+template <class T>
+void sor::OpticalFlowT<T>::SanityCheck(const TImage &imdx, const TImage &imdy, const TImage &imdt, double du, double dv)
 {
 	if(imdx.matchDimension(imdy)==false || imdx.matchDimension(imdt)==false)
 	{
@@ -112,14 +127,16 @@ void sor::OpticalFlow::SanityCheck(const sor::DImage &imdx, const sor::DImage &i
 //--------------------------------------------------------------------------------------------------------
 // function to warp image based on the flow field
 //--------------------------------------------------------------------------------------------------------
-void sor::OpticalFlow::warpFL(sor::DImage &warpIm2, const sor::DImage &Im1, const sor::DImage &Im2, const sor::DImage &vx, const sor::DImage &vy)
+template <class T>
+void sor::OpticalFlowT<T>::warpFL(TImage &warpIm2, const TImage &Im1, const TImage &Im2, const TImage &vx, const TImage &vy)
 {
 	if(warpIm2.matchDimension(Im2)==false)
 		warpIm2.allocate(Im2.width(),Im2.height(),Im2.nchannels());
 	sor::ImageProcessing::warpImage(warpIm2.data(),Im1.data(),Im2.data(),vx.data(),vy.data(),Im2.width(),Im2.height(),Im2.nchannels());
 }
 
-void sor::OpticalFlow::warpFL(sor::DImage &warpIm2, const sor::DImage &Im1, const sor::DImage &Im2, const sor::DImage &Flow)
+template <class T>
+void sor::OpticalFlowT<T>::warpFL(TImage &warpIm2, const TImage &Im1, const TImage &Im2, const TImage &Flow)
 {
 	if(warpIm2.matchDimension(Im2)==false)
 		warpIm2.allocate(Im2.width(),Im2.height(),Im2.nchannels());
@@ -130,7 +147,8 @@ void sor::OpticalFlow::warpFL(sor::DImage &warpIm2, const sor::DImage &Im1, cons
 //--------------------------------------------------------------------------------------------------------
 // function to generate mask of the pixels that move inside the image boundary
 //--------------------------------------------------------------------------------------------------------
-void sor::OpticalFlow::genInImageMask(sor::DImage &mask, const sor::DImage &vx, const sor::DImage &vy,int interval)
+template <class T>
+void sor::OpticalFlowT<T>::genInImageMask(TImage &mask, const TImage &vx, const TImage &vy,int interval)
 {
 	int imWidth,imHeight;
 	imWidth=vx.width();
@@ -156,7 +174,50 @@ void sor::OpticalFlow::genInImageMask(sor::DImage &mask, const sor::DImage &vx,
 		}
 }
 
-void sor::OpticalFlow::genInImageMask(sor::DImage &mask, const sor::DImage &flow,int interval)
+//--------------------------------------------------------------------------------------------------------
+// function to generate mask of the pixels whose forward flow is not consistent with the backward one
+//--------------------------------------------------------------------------------------------------------
+template <class T>
+void sor::OpticalFlowT<T>::genOcclusionMask(bool* mask, const TImage &vx, const TImage &vy, const TImage &bx, const TImage &by, double threshold)
+{
+	int imWidth,imHeight;
+	imWidth=vx.width();
+	imHeight=vx.height();
+	const T *pVx,*pVy,*pBx,*pBy;
+	pVx=vx.data();
+	pVy=vy.data();
+	pBx=bx.data();
+	pBy=by.data();
+	double threshold2=threshold*threshold;
+	double x,y;
+	for(int i=0;i<imHeight;i++)
+		for(int j=0;j<imWidth;j++)
+		{
+			int offset=i*imWidth+j;
+			x=j+pVx[offset];
+			y=i+pVy[offset];
+			// the pixel moves out of the image
+			if(x<0 || x>imWidth-1 || y<0 || y>imHeight-1)
+			{
+				mask[offset]=true;
+				continue;
+			}
+			// the backward flow where the pixel moves to (bilinearly
+			// interpolated) should bring it back
+			int x0=(int)x,y0=(int)y;
+			int x1=__min(x0+1,imWidth-1),y1=__min(y0+1,imHeight-1);
+			double dx=x-x0,dy=y-y0;
+			int o00=y0*imWidth+x0,o01=y0*imWidth+x1,o10=y1*imWidth+x0,o11=y1*imWidth+x1;
+			double bu=(pBx[o00]*(1-dx)+pBx[o01]*dx)*(1-dy)+(pBx[o10]*(1-dx)+pBx[o11]*dx)*dy;
+			double bv=(pBy[o00]*(1-dx)+pBy[o01]*dx)*(1-dy)+(pBy[o10]*(1-dx)+pBy[o11]*dx)*dy;
+			double eu=pVx[offset]+bu;
+			double ev=pVy[offset]+bv;
+			mask[offset]=(eu*eu+ev*ev>threshold2);
+		}
+}
+
+template <class T>
+void sor::OpticalFlowT<T>::genInImageMask(TImage &mask, const TImage &flow,int interval)
 {
 	int imWidth,imHeight;
 	imWidth=flow.width();
@@ -183,6 +244,40 @@ void sor::OpticalFlow::genInImageMask(sor::DImage &mask, const sor::DImage &flow
 		}
 }
 
+//--------------------------------------------------------------------------------------------------------
+// the robust weights of the data term (see assemble_data_term()) of the
+// Gaussian mixture and of the Laplacian noise models, for a squared residual
+// temp of channel k
+//--------------------------------------------------------------------------------------------------------
+struct GMixtureWeight
+{
+	const sor::GaussianMixture& GMPara;
+	GMixtureWeight(const sor::GaussianMixture& GMPara):GMPara(GMPara) {}
+	double operator()(double temp,int k) const
+	{
+		double prob1 = GMPara.Gaussian(temp,0,k)*GMPara.alpha[k];
+		double prob2 = GMPara.Gaussian(temp,1,k)*(1-GMPara.alpha[k]);
+		double prob11 = prob1/(2*GMPara.sigma_square[k]);
+		double prob22 = prob2/(2*GMPara.beta_square[k]);
+		return (prob11+prob22)/(prob1+prob2);
+	}
+};
+
+struct LapWeight
+{
+	const sor::Vector<double>& LapPara;
+	double varepsilon_psi;
+	LapWeight(const sor::Vector<double>& LapPara,double varepsilon_psi):LapPara(LapPara),varepsilon_psi(varepsilon_psi) {}
+	template <class T>
+	T operator()(T temp,int k) const
+	{
+		if(LapPara[k]<1E-20)
+			return 0;
+		//return 1/(2*sqrt(temp+varepsilon_psi)*LapPara[k]);
+		return 1/(2*std::sqrt(temp+(T)varepsilon_psi));
+	}
+};
+
 //--------------------------------------------------------------------------------------------------------
 // function to compute optical flow field using two fixed point iterations
 // Input arguments:
@@ -191,28 +286,63 @@ void sor::OpticalFlow::genInImageMask(sor::DImage &mask, const sor::DImage &flow
 //	u,v:									the current flow field, NOTICE that they are also output arguments
 //	
 //--------------------------------------------------------------------------------------------------------
-void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &Im2, sor::DImage &warpIm2, sor::DImage &u, sor::DImage &v, 
-																    double alpha, int nOuterFPIterations, int nInnerFPIterations, int nSORIterations)
+template <class T>
+int sor::OpticalFlowT<T>::SmoothFlowSOR(const TImage &Im1, const TImage &Im2, TImage &warpIm2, TImage &u, TImage &v, 
+																    double alpha, int nOuterFPIterations, int nInnerFPIterations, int nSORIterations, double tolerance,
+																    LevelBuffers* buffers, const BicubicDerivatives* derivatives2)
 {
-	sor::DImage mask,imdx,imdy,imdt;
+	int nIterations=0;
+	double tolerance2=tolerance*tolerance;
+
+	// the temporary images are either given or local to this call
+	LevelBuffers localBuffers;
+	LevelBuffers& b=(buffers!=NULL)?*buffers:localBuffers;
+
+	TImage &mask=b.mask,&imdx=b.imdx,&imdy=b.imdy,&imdt=b.imdt;
 	int imWidth,imHeight,nChannels,nPixels;
 	imWidth=Im1.width();
 	imHeight=Im1.height();
 	nChannels=Im1.nchannels();
 	nPixels=imWidth*imHeight;
 
-	sor::DImage du(imWidth,imHeight),dv(imWidth,imHeight);
-	sor::DImage uu(imWidth,imHeight),vv(imWidth,imHeight);
-	sor::DImage ux(imWidth,imHeight),uy(imWidth,imHeight);
-	sor::DImage vx(imWidth,imHeight),vy(imWidth,imHeight);
-	sor::DImage Phi_1st(imWidth,imHeight);
-	sor::DImage Psi_1st(imWidth,imHeight,nChannels);
-
-	sor::DImage imdxy,imdx2,imdy2,imdtdx,imdtdy;
-	sor::DImage ImDxy,ImDx2,ImDy2,ImDtDx,ImDtDy;
-	sor::DImage foo1,foo2;
+	// the derivatives of Im2 serve all the bicubic warps
+	if(interpolation == Bicubic && derivatives2 == NULL)
+	{
+		Im2.bicubicDerivatives(b.derivatives2.dx,b.derivatives2.dy,b.derivatives2.dxdy);
+		derivatives2=&b.derivatives2;
+	}
 
-	double prob1,prob2,prob11,prob22;
+	// for the red-black ordering, sweeps are split over blocks of rows. Small
+	// levels use fewer blocks, as they would not pay for the threads
+	int nBlocks=1;
+	if(ordering == RedBlack)
+		nBlocks=std::max(1,std::min(imHeight,std::min(4*effective_threads(nThreads,imHeight),nPixels/MinPixelsPerBlock)));
+	vector<double> &blockChange=b.blockChange,&blockNorm=b.blockNorm;
+	blockChange.assign(nBlocks,0);
+	blockNorm.assign(nBlocks,0);
+
+	TImage &du=b.du,&dv=b.dv;
+	TImage &uu=b.uu,&vv=b.vv;
+	TImage &ux=b.ux,&uy=b.uy;
+	TImage &vx=b.vx,&vy=b.vy;
+	TImage &Phi_1st=b.Phi_1st;
+	du.allocate(imWidth,imHeight);
+	dv.allocate(imWidth,imHeight);
+	uu.allocate(imWidth,imHeight);
+	vv.allocate(imWidth,imHeight);
+	ux.allocate(imWidth,imHeight);
+	uy.allocate(imWidth,imHeight);
+	vx.allocate(imWidth,imHeight);
+	vy.allocate(imWidth,imHeight);
+	Phi_1st.allocate(imWidth,imHeight);
+
+	TImage &imdxy=b.imdxy,&imdx2=b.imdx2,&imdy2=b.imdy2,&imdtdx=b.imdtdx,&imdtdy=b.imdtdy;
+	imdxy.allocate(imWidth,imHeight);
+	imdx2.allocate(imWidth,imHeight);
+	imdy2.allocate(imWidth,imHeight);
+	imdtdx.allocate(imWidth,imHeight);
+	imdtdy.allocate(imWidth,imHeight);
+	TImage &foo1=b.foo1,&foo2=b.foo2;
 
 	double varepsilon_phi=pow(0.001,2);
 	double varepsilon_psi=pow(0.001,2);
@@ -223,10 +353,12 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 	for(int count=0;count<nOuterFPIterations;count++)
 	{
 		// compute the gradient
-		getDxs(imdx,imdy,imdt,Im1,warpIm2);
+		ProfileTimer getDxsTimer(profile,"getDxs");
+		getDxs(imdx,imdy,imdt,Im1,warpIm2,&b);
 
 		// generate the mask to set the weight of the pxiels moving outside of the image boundary to be zero
 		genInImageMask(mask,u,v);
+		getDxsTimer.stop();
 
 		// set the derivative of the flow field to be zero
 		du.reset();
@@ -237,6 +369,9 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 		//--------------------------------------------------------------------------
 		for(int hh=0;hh<nInnerFPIterations;hh++)
 		{
+			// the robust weights and the linear system
+			ProfileTimer weightsTimer(profile,"weights");
+
 			// compute the derivatives of the current flow field
 			if(hh==0)
 			{
@@ -256,7 +391,8 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 			// compute the weight of phi
 			Phi_1st.reset();
 			_FlowPrecision* phiData=Phi_1st.data();
-			double temp;
+			_FlowPrecision temp;
+			const _FlowPrecision epsilonPhi=varepsilon_phi;
 			const _FlowPrecision *uxData,*uyData,*vxData,*vyData;
 			uxData=ux.data();
 			uyData=uy.data();
@@ -267,110 +403,45 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 			{
 				temp=uxData[i]*uxData[i]+uyData[i]*uyData[i]+vxData[i]*vxData[i]+vyData[i]*vyData[i];
 				//phiData[i]=power_alpha*pow(temp+varepsilon_phi,power_alpha-1);
-				phiData[i] = 0.5/sqrt(temp+varepsilon_phi);
+				phiData[i] = _FlowPrecision(0.5)/std::sqrt(temp+epsilonPhi);
 				//phiData[i] = 1/(power_alpha+temp);
 			}
 
-			// compute the nonlinear term of psi
-			Psi_1st.reset();
-			_FlowPrecision* psiData=Psi_1st.data();
-			const _FlowPrecision *imdxData,*imdyData,*imdtData;
-			const _FlowPrecision *duData,*dvData;
-			imdxData=imdx.data();
-			imdyData=imdy.data();
-			imdtData=imdt.data();
-			duData=du.data();
-			dvData=dv.data();
-		
-			//double _a  = 10000, _b = 0.1;
-			if(nChannels==1)
-				for(int i=0;i<nPixels;i++)
-				{
-					temp=imdtData[i]+imdxData[i]*duData[i]+imdyData[i]*dvData[i];
-					//if(temp*temp<0.04)
-					// psiData[i]=1/(2*sqrt(temp*temp+varepsilon_psi));
-					//psiData[i] = _a*_b/(1+_a*temp*temp);
-
-					// the following code is for log Gaussian mixture probability model
-					temp *= temp;
-					switch(noiseModel)
-					{
-					case GMixture:
-						prob1 = GMPara.Gaussian(temp,0,0)*GMPara.alpha[0];
-						prob2 = GMPara.Gaussian(temp,1,0)*(1-GMPara.alpha[0]);
-						prob11 = prob1/(2*GMPara.sigma_square[0]);
-						prob22 = prob2/(2*GMPara.beta_square[0]);
-						psiData[i] = (prob11+prob22)/(prob1+prob2);
-						break;
-					case Lap:
-						if(LapPara[0]<1E-20)
-							continue;
-						//psiData[i]=1/(2*sqrt(temp+varepsilon_psi)*LapPara[0]);
-                        psiData[i]=1/(2*sqrt(temp+varepsilon_psi));
-						break;
-					}
-				}
-			else
-				for(int i=0;i<nPixels;i++)
-					for(int k=0;k<nChannels;k++)
-					{
-						int offset=i*nChannels+k;
-						temp=imdtData[offset]+imdxData[offset]*duData[i]+imdyData[offset]*dvData[i];
-						//if(temp*temp<0.04)
-						 // psiData[offset]=1/(2*sqrt(temp*temp+varepsilon_psi));
-						//psiData[offset] =  _a*_b/(1+_a*temp*temp);
-						temp *= temp;
-						switch(noiseModel)
-						{
-						case GMixture:
-							prob1 = GMPara.Gaussian(temp,0,k)*GMPara.alpha[k];
-							prob2 = GMPara.Gaussian(temp,1,k)*(1-GMPara.alpha[k]);
-							prob11 = prob1/(2*GMPara.sigma_square[k]);
-							prob22 = prob2/(2*GMPara.beta_square[k]);
-							psiData[offset] = (prob11+prob22)/(prob1+prob2);
-							break;
-						case Lap:
-							if(LapPara[k]<1E-20)
-								continue;
-							//psiData[offset]=1/(2*sqrt(temp+varepsilon_psi)*LapPara[k]);
-                            psiData[offset]=1/(2*sqrt(temp+varepsilon_psi));
-							break;
-						}
-					}
-			// prepare the components of the large linear system
-			ImDxy.Multiply(Psi_1st,imdx,imdy);
-			ImDx2.Multiply(Psi_1st,imdx,imdx);
-			ImDy2.Multiply(Psi_1st,imdy,imdy);
-			ImDtDx.Multiply(Psi_1st,imdx,imdt);
-			ImDtDy.Multiply(Psi_1st,imdy,imdt);
-
-			if(nChannels>1)
-			{
-				ImDxy.collapse(imdxy);
-				ImDx2.collapse(imdx2);
-				ImDy2.collapse(imdy2);
-				ImDtDx.collapse(imdtdx);
-				ImDtDy.collapse(imdtdy);
-			}
-			else
-			{
-				imdxy.copyData(ImDxy);
-				imdx2.copyData(ImDx2);
-				imdy2.copyData(ImDy2);
-				imdtdx.copyData(ImDtDx);
-				imdtdy.copyData(ImDtDy);
-			}
 			// laplacian filtering of the current flow field
 		    Laplacian(foo1,u,Phi_1st);
 			Laplacian(foo2,v,Phi_1st);
 
-			for(int i=0;i<nPixels;i++)
+			// the nonlinear term of psi and the (channel averaged) components of
+			// the large linear system, in a single pass specialized per noise
+			// model and number of channels
+			switch(noiseModel)
 			{
-				imdtdx.data()[i] = -imdtdx.data()[i]-alpha*foo1.data()[i];
-				imdtdy.data()[i] = -imdtdy.data()[i]-alpha*foo2.data()[i];
+			case GMixture:
+				assemble_data_term(nPixels,nChannels,imdx.data(),imdy.data(),imdt.data(),du.data(),dv.data(),
+						GMixtureWeight(GMPara),imdxy.data(),imdx2.data(),imdy2.data(),imdtdx.data(),imdtdy.data(),
+						foo1.data(),foo2.data(),alpha);
+				break;
+			case Lap:
+				assemble_data_term(nPixels,nChannels,imdx.data(),imdy.data(),imdt.data(),du.data(),dv.data(),
+						LapWeight(LapPara,varepsilon_psi),imdxy.data(),imdx2.data(),imdy2.data(),imdtdx.data(),imdtdy.data(),
+						foo1.data(),foo2.data(),alpha);
+				break;
 			}
 
+			weightsTimer.stop();
+
 			// here we start SOR
+			ProfileTimer solverTimer(profile,"solver");
+
+			// or multigrid, each V-cycle preconditioning a conjugate gradient
+			// iteration
+			if(solver == MultigridSolver)
+			{
+				b.multigrid.nThreads = nThreads;
+				b.multigrid.setup(imWidth,imHeight,imdx2.data(),imdxy.data(),imdy2.data(),phiData,alpha,alpha*0.05);
+				nIterations += b.multigrid.solve(du.data(),dv.data(),imdtdx.data(),imdtdy.data(),nSORIterations,tolerance);
+				continue;
+			}
 
 			// set omega
 			double omega = 1.8;
@@ -378,67 +449,123 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 			du.reset();
 			dv.reset();
 
-			for(int k = 0; k<nSORIterations; k++)
-				for(int i = 0; i<imHeight; i++)
-					for(int j = 0; j<imWidth; j++)
-					{
+			// the sweeps compute in the precision of the images, so that float
+			// images are not converted to double (and back) at every access
+			_FlowPrecision *duData=du.data(),*dvData=dv.data();
+			const _FlowPrecision *imdxyData=imdxy.data(),*imdx2Data=imdx2.data(),*imdy2Data=imdy2.data();
+			const _FlowPrecision *imdtdxData=imdtdx.data(),*imdtdyData=imdtdy.data();
+			const _FlowPrecision alphaT=alpha,epsilon=alpha*0.05,omegaT=omega,omega1=1-omega;
+
+			// relaxes the velocity increments of pixel (i,j) and accumulates the
+			// squared norms of its update and of the increment
+			auto relax = [&](int i, int j, double& change, double& norm)
+			{
 						int offset = i * imWidth+j;
-						double sigma1 = 0, sigma2 = 0, coeff = 0;
-                        double _weight;
+						_FlowPrecision sigma1 = 0, sigma2 = 0, coeff = 0;
+                        _FlowPrecision _weight;
+						_FlowPrecision du0 = duData[offset], dv0 = dvData[offset];
 
 						
 						if(j>0)
 						{
                             _weight = phiData[offset-1];
-							sigma1  += _weight*du.data()[offset-1];
-							sigma2  += _weight*dv.data()[offset-1];
+							sigma1  += _weight*duData[offset-1];
+							sigma2  += _weight*dvData[offset-1];
 							coeff   += _weight;
 						}
 						if(j<imWidth-1)
 						{
                             _weight = phiData[offset];
-							sigma1 += _weight*du.data()[offset+1];
-							sigma2 += _weight*dv.data()[offset+1];
+							sigma1 += _weight*duData[offset+1];
+							sigma2 += _weight*dvData[offset+1];
 							coeff   += _weight;
 						}
 						if(i>0)
 						{
                             _weight = phiData[offset-imWidth];
-							sigma1 += _weight*du.data()[offset-imWidth];
-							sigma2 += _weight*dv.data()[offset-imWidth];
+							sigma1 += _weight*duData[offset-imWidth];
+							sigma2 += _weight*dvData[offset-imWidth];
 							coeff   += _weight;
 						}
 						if(i<imHeight-1)
 						{
                             _weight = phiData[offset];
-							sigma1  += _weight*du.data()[offset+imWidth];
-							sigma2  += _weight*dv.data()[offset+imWidth];
+							sigma1  += _weight*duData[offset+imWidth];
+							sigma2  += _weight*dvData[offset+imWidth];
 							coeff   += _weight;
 						}
-						sigma1 *= -alpha;
-						sigma2 *= -alpha;
-						coeff *= alpha;
+						sigma1 *= -alphaT;
+						sigma2 *= -alphaT;
+						coeff *= alphaT;
 						 // compute du
-						sigma1 += imdxy.data()[offset]*dv.data()[offset];
-						du.data()[offset] = (1-omega)*du.data()[offset] + omega/(imdx2.data()[offset] + alpha*0.05 + coeff)*(imdtdx.data()[offset] - sigma1);
+						sigma1 += imdxyData[offset]*dvData[offset];
+						duData[offset] = omega1*duData[offset] + omegaT/(imdx2Data[offset] + epsilon + coeff)*(imdtdxData[offset] - sigma1);
 						// compute dv
-						sigma2 += imdxy.data()[offset]*du.data()[offset];
-						dv.data()[offset] = (1-omega)*dv.data()[offset] + omega/(imdy2.data()[offset] + alpha*0.05 + coeff)*(imdtdy.data()[offset] - sigma2);
+						sigma2 += imdxyData[offset]*duData[offset];
+						dvData[offset] = omega1*dvData[offset] + omegaT/(imdy2Data[offset] + epsilon + coeff)*(imdtdyData[offset] - sigma2);
+
+						if(tolerance>0)
+						{
+							_FlowPrecision ddu = duData[offset]-du0, ddv = dvData[offset]-dv0;
+							change += ddu*ddu + ddv*ddv;
+							norm += duData[offset]*duData[offset] + dvData[offset]*dvData[offset];
+						}
+			};
+
+			for(int k = 0; k<nSORIterations; k++)
+			{
+				// squared norms of the update of this sweep and of the increment
+				double change = 0, norm = 0;
+				nIterations++;
+
+				if(ordering == RedBlack)
+				{
+					// pixels of one color only depend on pixels of the other
+					// color, so each half sweep is split over blocks of rows
+					for(int color = 0; color<2; color++)
+					{
+						parallel_for(nBlocks, nThreads, [&](int blk)
+						{
+							for(int i = blk*imHeight/nBlocks; i<(blk+1)*imHeight/nBlocks; i++)
+								for(int j = (i+color)%2; j<imWidth; j+=2)
+									relax(i,j,blockChange[blk],blockNorm[blk]);
+						});
 					}
+					for(int blk = 0; blk<nBlocks; blk++)
+					{
+						change += blockChange[blk];
+						norm += blockNorm[blk];
+						blockChange[blk] = blockNorm[blk] = 0;
+					}
+				}
+				else
+				{
+					for(int i = 0; i<imHeight; i++)
+						for(int j = 0; j<imWidth; j++)
+							relax(i,j,change,norm);
+				}
+
+				// stop once the relative update drops below the tolerance
+				if(tolerance>0 && change<=tolerance2*norm)
+					break;
+			}
 		}
+		ProfileTimer warpTimer(profile,"warp");
 		u.Add(du);
 		v.Add(dv);
 		if(interpolation == Bilinear)
 			warpFL(warpIm2,Im1,Im2,u,v);
 		else
 		{
-			Im2.warpImageBicubicRef(Im1,warpIm2,u,v);
+			Im2.warpImageBicubicRef(Im1,warpIm2,derivatives2->dx,derivatives2->dy,derivatives2->dxdy,u,v);
 			warpIm2.threshold();
 		}
+		warpTimer.stop();
 
 		//Im2.warpImageBicubicRef(Im1,warpIm2,BicubicCoeff,u,v);
 
 		// estimate noise level
+		ProfileTimer noiseTimer(profile,"noise");
 		switch(noiseModel)
 		{
 		case GMixture:
@@ -449,6 +576,7 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 		}
 	}
 
+	return nIterations;
 }
 
 
@@ -461,34 +589,36 @@ void sor::OpticalFlow::SmoothFlowSOR(const sor::DImage &Im1, const sor::DImage &
 //	u,v:									the current flow field, NOTICE that they are also output arguments
 //	
 //--------------------------------------------------------------------------------------------------------
-void sor::OpticalFlow::SmoothFlowPDE(const sor::DImage &Im1, const sor::DImage &Im2, sor::DImage &warpIm2, sor::DImage &u, sor::DImage &v, 
+template <class T>
+void sor::OpticalFlowT<T>::SmoothFlowPDE(const TImage &Im1, const TImage &Im2, TImage &warpIm2, TImage &u, TImage &v, 
 																    double alpha, int nOuterFPIterations, int nInnerFPIterations, int nCGIterations)
 {
-	sor::DImage mask,imdx,imdy,imdt;
+	TImage mask,imdx,imdy,imdt;
 	int imWidth,imHeight,nChannels,nPixels;
 	imWidth=Im1.width();
 	imHeight=Im1.height();
 	nChannels=Im1.nchannels();
 	nPixels=imWidth*imHeight;
 
-	sor::DImage du(imWidth,imHeight),dv(imWidth,imHeight);
-	sor::DImage uu(imWidth,imHeight),vv(imWidth,imHeight);
-	sor::DImage ux(imWidth,imHeight),uy(imWidth,imHeight);
-	sor::DImage vx(imWidth,imHeight),vy(imWidth,imHeight);
-	sor::DImage Phi_1st(imWidth,imHeight);
-	sor::DImage Psi_1st(imWidth,imHeight,nChannels);
-
-	sor::DImage imdxy,imdx2,imdy2,imdtdx,imdtdy;
-	sor::DImage ImDxy,ImDx2,ImDy2,ImDtDx,ImDtDy;
-	sor::DImage A11,A12,A22,b1,b2;
-	sor::DImage foo1,foo2;
-
-	// compute bicubic interpolation coeff
-	//sor::DImage BicubicCoeff;
-	//Im2.warpImageBicubicCoeff(BicubicCoeff);
+	TImage du(imWidth,imHeight),dv(imWidth,imHeight);
+	TImage uu(imWidth,imHeight),vv(imWidth,imHeight);
+	TImage ux(imWidth,imHeight),uy(imWidth,imHeight);
+	TImage vx(imWidth,imHeight),vy(imWidth,imHeight);
+	TImage Phi_1st(imWidth,imHeight);
+	TImage Psi_1st(imWidth,imHeight,nChannels);
+
+	TImage imdxy,imdx2,imdy2,imdtdx,imdtdy;
+	TImage ImDxy,ImDx2,ImDy2,ImDtDx,ImDtDy;
+	TImage A11,A12,A22,b1,b2;
+	TImage foo1,foo2;
+
+	// compute the derivatives of Im2 for bicubic interpolation, once
+	BicubicDerivatives derivatives2;
+	if(interpolation == Bicubic)
+		Im2.bicubicDerivatives(derivatives2.dx,derivatives2.dy,derivatives2.dxdy);
 	double prob1,prob2,prob11,prob22;
 	// variables for conjugate gradient
-	sor::DImage r1,r2,p1,p2,q1,q2;
+	TImage r1,r2,p1,p2,q1,q2;
 	double* rou;
 	rou=new double[nCGIterations];
 
@@ -740,12 +870,10 @@ void sor::OpticalFlow::SmoothFlowPDE(const sor::DImage &Im1, const sor::DImage &
 			warpFL(warpIm2,Im1,Im2,u,v);
 		else
 		{
-			Im2.warpImageBicubicRef(Im1,warpIm2,u,v);
+			Im2.warpImageBicubicRef(Im1,warpIm2,derivatives2.dx,derivatives2.dy,derivatives2.dxdy,u,v);
 			warpIm2.threshold();
 		}
 
-		//Im2.warpImageBicubicRef(Im1,warpIm2,BicubicCoeff,u,v);
-
 		// estimate noise level
 		switch(noiseModel)
 		{
@@ -760,10 +888,11 @@ void sor::OpticalFlow::SmoothFlowPDE(const sor::DImage &Im1, const sor::DImage &
 	delete[] rou;
 }
 
-void sor::OpticalFlow::estGaussianMixture(const sor::DImage& Im1,const sor::DImage& Im2,GaussianMixture& para,double prior)
+template <class T>
+void sor::OpticalFlowT<T>::estGaussianMixture(const TImage& Im1,const TImage& Im2,GaussianMixture& para,double prior)
 {
 	int nIterations = 3, nChannels = Im1.nchannels();
-	sor::DImage weight1(Im1),weight2(Im1);
+	TImage weight1(Im1),weight2(Im1);
 	double *total1,*total2;
 	total1 = new double[nChannels];
 	total2 = new double[nChannels];
@@ -814,7 +943,8 @@ void sor::OpticalFlow::estGaussianMixture(const sor::DImage& Im1,const sor::DIma
 	}
 }
 
-void sor::OpticalFlow::estLaplacianNoise(const sor::DImage& Im1,const sor::DImage& Im2,Vector<double>& para)
+template <class T>
+void sor::OpticalFlowT<T>::estLaplacianNoise(const TImage& Im1,const TImage& Im2,Vector<double>& para)
 {
 	int nChannels = Im1.nchannels();
 	if(para.dim()!=nChannels)
@@ -850,70 +980,78 @@ void sor::OpticalFlow::estLaplacianNoise(const sor::DImage& Im1,const sor::DImag
 	}
 }
 
-void sor::OpticalFlow::Laplacian(sor::DImage &output, const sor::DImage &input, const sor::DImage& weight)
+//--------------------------------------------------------------------------------------
+// the weighted Laplacian (see Laplacian()) of input at pixel offset, for a
+// pixel with or without left, right, upper and lower neighbours. The terms
+// are accumulated in the same order as in the original four pass filtering,
+// so results do not change. With constant neighbour flags, the expression is
+// branchless
+//--------------------------------------------------------------------------------------
+template <class T>
+static inline T weightedLaplacian(const T* input,const T* weight,int offset,int width,bool left,bool right,bool up,bool down)
+{
+	T lap=0;
+	if(right)
+		lap-=(input[offset+1]-input[offset])*weight[offset];
+	if(left)
+		lap+=(input[offset]-input[offset-1])*weight[offset-1];
+	if(down)
+		lap-=(input[offset+width]-input[offset])*weight[offset];
+	if(up)
+		lap+=(input[offset]-input[offset-width])*weight[offset-width];
+	return lap;
+}
+
+template <class T>
+void sor::OpticalFlowT<T>::Laplacian(TImage &output, const TImage &input, const TImage& weight)
 {
 	if(output.matchDimension(input)==false)
 		output.allocate(input);
-	output.reset();
 
 	if(input.matchDimension(weight)==false)
 	{
+		output.reset();
 		cout<<"Error in image dimension matching sor::OpticalFlow::Laplacian()!"<<endl;
 		return;
 	}
-	
+
+	// a single pass over the image, without temporary image: the borders of
+	// each row are handled apart from its (branchless) interior
 	const _FlowPrecision *inputData=input.data(),*weightData=weight.data();
+	_FlowPrecision *outputData=output.data();
 	int width=input.width(),height=input.height();
-	sor::DImage foo(width,height);
-	_FlowPrecision *fooData=foo.data(),*outputData=output.data();
-	
-
-	// horizontal filtering
-	for(int i=0;i<height;i++)
-		for(int j=0;j<width-1;j++)
-		{
-			int offset=i*width+j;
-			fooData[offset]=(inputData[offset+1]-inputData[offset])*weightData[offset];
-		}
-	for(int i=0;i<height;i++)
-		for(int j=0;j<width;j++)
-		{
-			int offset=i*width+j;
-			if(j<width-1)
-				outputData[offset]-=fooData[offset];
-			if(j>0)
-				outputData[offset]+=fooData[offset-1];
-		}
-	foo.reset();
-	// vertical filtering
-	for(int i=0;i<height-1;i++)
-		for(int j=0;j<width;j++)
-		{
-			int offset=i*width+j;
-			fooData[offset]=(inputData[offset+width]-inputData[offset])*weightData[offset];
-		}
 	for(int i=0;i<height;i++)
-		for(int j=0;j<width;j++)
+	{
+		bool up=(i>0),down=(i<height-1);
+		int offset=i*width;
+		if(width==1)
 		{
-			int offset=i*width+j;
-			if(i<height-1)
-				outputData[offset]-=fooData[offset];
-			if(i>0)
-				outputData[offset]+=fooData[offset-width];
+			outputData[offset]=weightedLaplacian(inputData,weightData,offset,width,false,false,up,down);
+			continue;
 		}
+		outputData[offset]=weightedLaplacian(inputData,weightData,offset,width,false,true,up,down);
+		if(up && down)
+			for(int j=1;j<width-1;j++)
+				outputData[offset+j]=weightedLaplacian(inputData,weightData,offset+j,width,true,true,true,true);
+		else
+			for(int j=1;j<width-1;j++)
+				outputData[offset+j]=weightedLaplacian(inputData,weightData,offset+j,width,true,true,up,down);
+		outputData[offset+width-1]=weightedLaplacian(inputData,weightData,offset+width-1,width,true,false,up,down);
+	}
 }
 
-void sor::OpticalFlow::testLaplacian(int dim)
+template <class T>
+void sor::OpticalFlowT<T>::testLaplacian(int dim)
 {
 	// generate the random weight
-	sor::DImage weight(dim,dim);
+	TImage weight(dim,dim);
 	for(int i=0;i<dim;i++)
 		for(int j=0;j<dim;j++)
 			//weight.data()[i*dim+j]=(double)rand()/RAND_MAX+1;
 			weight.data()[i*dim+j]=1;
 	// go through the linear system;
-	sor::DImage sysMatrix(dim*dim,dim*dim);
-	sor::DImage u(dim,dim),du(dim,dim);
+	TImage sysMatrix(dim*dim,dim*dim);
+	TImage u(dim,dim),du(dim,dim);
 	for(int i=0;i<dim*dim;i++)
 	{
 		u.reset();
@@ -938,19 +1076,45 @@ void sor::OpticalFlow::testLaplacian(int dim)
 //--------------------------------------------------------------------------------------
 // function to perfomr coarse to fine optical flow estimation
 //--------------------------------------------------------------------------------------
-void sor::OpticalFlow::Coarse2FineFlow(sor::DImage &vx, sor::DImage &vy, sor::DImage &warpI2,const sor::DImage &Im1, const sor::DImage &Im2, double alpha, double ratio, int minWidth, 
-																	 int nOuterFPIterations, int nInnerFPIterations, int nCGIterations)
+template <class T>
+void sor::OpticalFlowT<T>::Coarse2FineFlow(TImage &vx, TImage &vy, TImage &warpI2,const TImage &Im1, const TImage &Im2, double alpha, double ratio, int minWidth, 
+																	 int nOuterFPIterations, int nInnerFPIterations, int nCGIterations, bool warmStart,
+																	 double tolerance, vector<int>* iterations, bool warp, Workspace* workspace,
+																	 int stopLevel, vector<TImage>* flows)
 {
 	// first build the pyramid of the two images
-	GaussianPyramid GPyramid1;
-	GaussianPyramid GPyramid2;
+	FeaturePyramid localPyramid1;
+	FeaturePyramid localPyramid2;
+	FeaturePyramid& GPyramid1=(workspace!=NULL)?workspace->pyramid1:localPyramid1;
+	FeaturePyramid& GPyramid2=(workspace!=NULL)?workspace->pyramid2:localPyramid2;
 	//if(IsDisplay) cout<<"Constructing pyramid...";
-	GPyramid1.ConstructPyramid(Im1,ratio,minWidth);
-	GPyramid2.ConstructPyramid(Im2,ratio,minWidth);
+	GPyramid1.ConstructPyramid(Im1,ratio,minWidth,fastPyramid,profile);
+	GPyramid2.ConstructPyramid(Im2,ratio,minWidth,fastPyramid,profile);
 	//if(IsDisplay) cout<<"done!"<<endl;
-	
+
+	Coarse2FineFlow(vx,vy,warpI2,Im1,Im2,GPyramid1,GPyramid2,alpha,ratio,nOuterFPIterations,nInnerFPIterations,nCGIterations,warmStart,tolerance,iterations,warp,workspace,stopLevel,flows);
+}
+
+//--------------------------------------------------------------------------------------
+// function to perform coarse to fine optical flow estimation on pre-computed
+// pyramids (e.g. shared between consecutive frame pairs of a video)
+//--------------------------------------------------------------------------------------
+template <class T>
+void sor::OpticalFlowT<T>::Coarse2FineFlow(TImage &vx, TImage &vy, TImage &warpI2,const TImage &Im1, const TImage &Im2, FeaturePyramid& GPyramid1, FeaturePyramid& GPyramid2,
+																	 double alpha, double ratio, int nOuterFPIterations, int nInnerFPIterations, int nCGIterations, bool warmStart,
+																	 double tolerance, vector<int>* iterations, bool warp, Workspace* workspace,
+																	 int stopLevel, vector<TImage>* flows)
+{
 	// now iterate from the top level to the bottom
-	sor::DImage Image1,Image2,WarpImage2;
+	TImage localWarpImage2;
+	BicubicDerivatives localDerivatives2;
+	stopLevel=__min(__max(stopLevel,0),GPyramid1.nlevels()-1);
+	if(iterations!=NULL)
+		iterations->assign(GPyramid1.nlevels(),0);
+	if(workspace!=NULL)
+		workspace->levels.resize(GPyramid1.nlevels());
+	if(flows!=NULL)
+		flows->resize(2*(GPyramid1.nlevels()-stopLevel));
 	//GaussianMixture GMPara(Im1.nchannels()+2);
 
 	// initialize noise
@@ -965,15 +1129,41 @@ void sor::OpticalFlow::Coarse2FineFlow(sor::DImage &vx, sor::DImage &vy, sor::DI
 		break;
 	}
 
-	for(int k=GPyramid1.nlevels()-1;k>=0;k--)
+	for(int k=GPyramid1.nlevels()-1;k>=stopLevel;k--)
 	{
 		//if(IsDisplay) cout<<"Pyramid level "<<k;
 		int width=GPyramid1.Image(k).width();
 		int height=GPyramid1.Image(k).height();
-		im2feature(Image1,GPyramid1.Image(k));
-		im2feature(Image2,GPyramid2.Image(k));
-
-		if(k==GPyramid1.nlevels()-1) // if at the top level
+		const TImage& Image1=GPyramid1.Feature(k);
+		const TImage& Image2=GPyramid2.Feature(k);
+		LevelBuffers* buffers=(workspace!=NULL)?&workspace->levels[k]:NULL;
+		TImage& WarpImage2=(buffers!=NULL)?buffers->warpIm2:localWarpImage2;
+		BicubicDerivatives& Derivatives2=(buffers!=NULL)?buffers->derivatives2:localDerivatives2;
+		if(profile!=NULL)
+			profile->level=k;
+
+		// the initial flow of the level, and frame 2 warped by it. With
+		// bicubic interpolation, the derivatives of frame 2 serve all the
+		// warps of the level
+		ProfileTimer initTimer(profile,"init");
+		if(interpolation == Bicubic)
+			Image2.bicubicDerivatives(Derivatives2.dx,Derivatives2.dy,Derivatives2.dxdy);
+		if(k==GPyramid1.nlevels()-1 && warmStart) // top level, initial flow given
+		{
+			// downsample the initial flow as the images were downsampled
+			GaussianPyramidT<T> GFlow;
+			GFlow.ConstructPyramidLevels(vx,ratio,GPyramid1.nlevels());
+			vx.copyData(GFlow.Image(k));
+			vx.Multiplywith(pow(ratio,k));
+			GFlow.ConstructPyramidLevels(vy,ratio,GPyramid1.nlevels());
+			vy.copyData(GFlow.Image(k));
+			vy.Multiplywith(pow(ratio,k));
+			if(interpolation == Bilinear)
+				warpFL(WarpImage2,Image1,Image2,vx,vy);
+			else
+				Image2.warpImageBicubicRef(Image1,WarpImage2,Derivatives2.dx,Derivatives2.dy,Derivatives2.dxdy,vx,vy);
+		}
+		else if(k==GPyramid1.nlevels()-1) // if at the top level
 		{
 			vx.allocate(width,height);
 			vy.allocate(width,height);
@@ -991,30 +1181,90 @@ void sor::OpticalFlow::Coarse2FineFlow(sor::DImage &vx, sor::DImage &vy, sor::DI
 			if(interpolation == Bilinear)
 				warpFL(WarpImage2,Image1,Image2,vx,vy);
 			else
-				Image2.warpImageBicubicRef(Image1,WarpImage2,vx,vy);
+				Image2.warpImageBicubicRef(Image1,WarpImage2,Derivatives2.dx,Derivatives2.dy,Derivatives2.dxdy,vx,vy);
 		}
+		initTimer.stop();
 		//SmoothFlowPDE(GPyramid1.Image(k),GPyramid2.Image(k),warpI2,vx,vy,alpha,nOuterFPIterations,nInnerFPIterations,nCGIterations);
 		//SmoothFlowPDE(Image1,Image2,WarpImage2,vx,vy,alpha*pow((1/ratio),k),nOuterFPIterations,nInnerFPIterations,nCGIterations,GMPara);
 		
 		//SmoothFlowPDE(Image1,Image2,WarpImage2,vx,vy,alpha,nOuterFPIterations,nInnerFPIterations,nCGIterations);
-		SmoothFlowSOR(Image1,Image2,WarpImage2,vx,vy,alpha,nOuterFPIterations+k,nInnerFPIterations,nCGIterations+k*3);
+		int nIterations=SmoothFlowSOR(Image1,Image2,WarpImage2,vx,vy,alpha,nOuterFPIterations+k,nInnerFPIterations,nCGIterations+k*3,tolerance,buffers,
+			&Derivatives2);
+		if(iterations!=NULL)
+			(*iterations)[k]=nIterations;
+		if(flows!=NULL)
+		{
+			(*flows)[2*(k-stopLevel)].copyData(vx);
+			(*flows)[2*(k-stopLevel)+1].copyData(vy);
+		}
 
 		//GMPara.display();
 		//if(IsDisplay) cout<<endl;
 	}
+	if(profile!=NULL)
+		profile->level=-1;
 	//warpFL(warpI2,Im1,Im2,vx,vy);
-	Im2.warpImageBicubicRef(Im1,warpI2,vx,vy);
+	if(!warp)
+		return;
+	// when stopping early, the images of the stop level are warped
+	ProfileTimer warpTimer(profile,"final_warp");
+	const TImage& Level1=(stopLevel>0)?GPyramid1.Image(stopLevel):Im1;
+	const TImage& Level2=(stopLevel>0)?GPyramid2.Image(stopLevel):Im2;
+	Level2.warpImageBicubicRef(Level1,warpI2,vx,vy);
 	warpI2.threshold();
 }
 
-void sor::OpticalFlow::Coarse2FineFlowLevel(sor::DImage &vx, sor::DImage &vy, sor::DImage &warpI2,const sor::DImage &Im1, const sor::DImage &Im2, double alpha, double ratio, int nLevels, 
+//--------------------------------------------------------------------------------------
+// function to perform coarse to fine optical flow estimation in both directions,
+// on pyramids built once
+//--------------------------------------------------------------------------------------
+template <class T>
+void sor::OpticalFlowT<T>::Coarse2FineFlowBidirectional(TImage &vx, TImage &vy, TImage &warpI2, TImage &bx, TImage &by, TImage &warpI1,
+																	 const TImage &Im1, const TImage &Im2, double alpha, double ratio, int minWidth,
+																	 int nOuterFPIterations, int nInnerFPIterations, int nCGIterations,
+																	 double tolerance, bool warp)
+{
+	// first build the pyramid of the two images
+	FeaturePyramid GPyramid1;
+	FeaturePyramid GPyramid2;
+	GPyramid1.ConstructPyramid(Im1,ratio,minWidth,fastPyramid,profile);
+	GPyramid2.ConstructPyramid(Im2,ratio,minWidth,fastPyramid,profile);
+
+	// both directions only read the pyramids, so they run concurrently if
+	// there are at least two threads, sharing them. Otherwise, they run one
+	// after the other, on a single thread
+	int nTotal=effective_threads(nThreads,std::numeric_limits<int>::max());
+	int nShared[2]={(nTotal+1)/2,__max(nTotal/2,1)};
+
+	// each direction holds its own noise model
+	OpticalFlowT<T> solvers[2];
+	for(int d=0;d<2;d++)
+	{
+		solvers[d].interpolation=interpolation;
+		solvers[d].noiseModel=noiseModel;
+		solvers[d].ordering=ordering;
+		solvers[d].nThreads=nShared[d];
+		solvers[d].solver=solver;
+	}
+
+	parallel_for(2,nTotal,[&](int d)
+	{
+		if(d==0)
+			solvers[0].Coarse2FineFlow(vx,vy,warpI2,Im1,Im2,GPyramid1,GPyramid2,alpha,ratio,nOuterFPIterations,nInnerFPIterations,nCGIterations,false,tolerance,NULL,warp);
+		else
+			solvers[1].Coarse2FineFlow(bx,by,warpI1,Im2,Im1,GPyramid2,GPyramid1,alpha,ratio,nOuterFPIterations,nInnerFPIterations,nCGIterations,false,tolerance,NULL,warp);
+	});
+}
+
+template <class T>
+void sor::OpticalFlowT<T>::Coarse2FineFlowLevel(TImage &vx, TImage &vy, TImage &warpI2,const TImage &Im1, const TImage &Im2, double alpha, double ratio, int nLevels, 
 																	 int nOuterFPIterations, int nInnerFPIterations, int nCGIterations)
 {
 	// first build the pyramid of the two images
-	GaussianPyramid GPyramid1;
-	GaussianPyramid GPyramid2;
-	GaussianPyramid GFlow;
-	sor::DImage flow;
+	GaussianPyramidT<T> GPyramid1;
+	GaussianPyramidT<T> GPyramid2;
+	GaussianPyramidT<T> GFlow;
+	TImage flow;
 	AssembleFlow(vx,vy,flow);
 	//if(IsDisplay) cout<<"Constructing pyramid...";
 	GPyramid1.ConstructPyramidLevels(Im1,ratio,nLevels);
@@ -1027,7 +1277,7 @@ void sor::OpticalFlow::Coarse2FineFlowLevel(sor::DImage &vx, sor::DImage &vy, so
 	//if(IsDisplay) cout<<"done!"<<endl;
 	
 	// now iterate from the top level to the bottom
-	sor::DImage Image1,Image2,WarpImage2;
+	TImage Image1,Image2,WarpImage2;
 
 	// initialize noise
 	switch(noiseModel){
@@ -1073,10 +1323,29 @@ void sor::OpticalFlow::Coarse2FineFlowLevel(sor::DImage &vx, sor::DImage &vy, so
 	warpI2.threshold();
 }
 
+//---------------------------------------------------------------------------------------
+// function to construct the pyramid of an image and of its feature images
+//---------------------------------------------------------------------------------------
+template <class T>
+void sor::FeaturePyramidT<T>::ConstructPyramid(const TImage &image, double ratio, int minWidth, bool fast,
+																	 OpticalFlowBase::Profile* profile)
+{
+	ProfileTimer pyramidTimer(profile,"pyramid",-1);
+	pyramid.ConstructPyramid(image,ratio,minWidth,fast);
+	pyramidTimer.stop();
+	features.resize(pyramid.nlevels());
+	for(int k=0;k<pyramid.nlevels();k++)
+	{
+		ProfileTimer featureTimer(profile,"im2feature",k);
+		OpticalFlowT<T>::im2feature(features[k],pyramid.Image(k));
+	}
+}
+
 //---------------------------------------------------------------------------------------
 // function to convert image to feature image
 //---------------------------------------------------------------------------------------
-void sor::OpticalFlow::im2feature(sor::DImage &imfeature, const sor::DImage &im)
+template <class T>
+void sor::OpticalFlowT<T>::im2feature(TImage &imfeature, const TImage &im)
 {
 	int width=im.width();
 	int height=im.height();
@@ -1084,7 +1353,7 @@ void sor::OpticalFlow::im2feature(sor::DImage &imfeature, const sor::DImage &im)
 	if(nchannels==1)
 	{
 		imfeature.allocate(im.width(),im.height(),3);
-		sor::DImage imdx,imdy;
+		TImage imdx,imdy;
 		im.dx(imdx,true);
 		im.dy(imdy,true);
 		_FlowPrecision* data=imfeature.data();
@@ -1099,11 +1368,11 @@ void sor::OpticalFlow::im2feature(sor::DImage &imfeature, const sor::DImage &im)
 	}
 	else if(nchannels==3)
 	{
-		sor::DImage grayImage;
+		TImage grayImage;
 		im.desaturate(grayImage);
 
 		imfeature.allocate(im.width(),im.height(),5);
-		sor::DImage imdx,imdy;
+		TImage imdx,imdy;
 		grayImage.dx(imdx,true);
 		grayImage.dy(imdy,true);
 		_FlowPrecision* data=imfeature.data();
@@ -1122,7 +1391,8 @@ void sor::OpticalFlow::im2feature(sor::DImage &imfeature, const sor::DImage &im)
 		imfeature.copyData(im);
 }
 
-bool sor::OpticalFlow::LoadOpticalFlow(const char* filename,sor::DImage &flow)
+template <class T>
+bool sor::OpticalFlowT<T>::LoadOpticalFlow(const char* filename,TImage &flow)
 {
 	sor::Image<unsigned short int> foo;
 	if(foo.loadImage(filename) == false)
@@ -1137,7 +1407,8 @@ bool sor::OpticalFlow::LoadOpticalFlow(const char* filename,sor::DImage &flow)
 	return true;
 }
 
-bool sor::OpticalFlow::LoadOpticalFlow(ifstream& myfile,sor::DImage& flow)
+template <class T>
+bool sor::OpticalFlowT<T>::LoadOpticalFlow(ifstream& myfile,TImage& flow)
 {
 	sor::Image<unsigned short int> foo;
 	if(foo.loadImage(myfile) == false)
@@ -1152,7 +1423,8 @@ bool sor::OpticalFlow::LoadOpticalFlow(ifstream& myfile,sor::DImage& flow)
 	return true;
 }
 
-bool sor::OpticalFlow::SaveOpticalFlow(const sor::DImage& flow, const char* filename)
+template <class T>
+bool sor::OpticalFlowT<T>::SaveOpticalFlow(const TImage& flow, const char* filename)
 {
 	sor::Image<unsigned short int> foo;
 	foo.allocate(flow);
@@ -1164,7 +1436,8 @@ bool sor::OpticalFlow::SaveOpticalFlow(const sor::DImage& flow, const char* file
 	return foo.saveImage(filename);
 }
 
-bool sor::OpticalFlow::SaveOpticalFlow(const sor::DImage& flow,ofstream& myfile)
+template <class T>
+bool sor::OpticalFlowT<T>::SaveOpticalFlow(const TImage& flow,ofstream& myfile)
 {
 	sor::Image<unsigned short int> foo;
 	foo.allocate(flow);
@@ -1193,3 +1466,9 @@ bool sor::OpticalFlow::showFlow(const sor::DImage& flow,const char* filename)
 	foo.imwrite(filename);
 }
 **/
+
+// the solver is compiled for double (the reference) and single precision
+template class sor::OpticalFlowT<double>;
+template class sor::OpticalFlowT<float>;
+template class sor::FeaturePyramidT<double>;
+template class sor::FeaturePyramidT<float>;
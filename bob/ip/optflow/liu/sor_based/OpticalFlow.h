@@ -3,71 +3,165 @@
 #include "Image.h"
 #include "NoiseModel.h"
 #include "Vector.h"
+#include "GaussianPyramid.h"
+#include "../profile.h"
+#include "../multigrid.h"
 #include <vector>
 
 namespace sor {
 
   typedef double _FlowPrecision;
 
-  class OpticalFlow
+  template <class T> class FeaturePyramidT;
+  template <class T> struct LevelBuffersT;
+  struct BicubicDerivatives;
+  template <class T> class WorkspaceT;
+
+  // settings shared by the double and single precision solvers
+  class OpticalFlowBase
   {
     public:
       static bool IsDisplay;
+      typedef bob::ip::optflow::liu::Profile Profile;
     public:
       enum InterpolationMethod {Bilinear,Bicubic};
-      static InterpolationMethod interpolation;
       enum NoiseModel {GMixture,Lap};
-      OpticalFlow(void);
-      ~OpticalFlow(void);
-      static GaussianMixture GMPara;
-      static Vector<double> LapPara;
-      static NoiseModel noiseModel;
+      enum SOROrdering {Lexicographic,RedBlack};
+      enum LinearSolver {SORSolver,MultigridSolver};
+  };
+
+  // the solver, working on images of type T (double or float)
+  template <class T>
+  class OpticalFlowT : public OpticalFlowBase
+  {
     public:
-      static void getDxs(DImage& imdx,DImage& imdy,DImage& imdt,const DImage& im1,const DImage& im2);
-      static void SanityCheck(const DImage& imdx,const DImage& imdy,const DImage& imdt,double du,double dv);
-      static void warpFL(DImage& warpIm2,const DImage& Im1,const DImage& Im2,const DImage& vx,const DImage& vy);
-      static void warpFL(DImage& warpIm2,const DImage& Im1,const DImage& Im2,const DImage& flow);
+      typedef sor::Image<T> TImage;
+      typedef T _FlowPrecision;
+      typedef FeaturePyramidT<T> FeaturePyramid;
+      typedef LevelBuffersT<T> LevelBuffers;
+      typedef WorkspaceT<T> Workspace;
+      OpticalFlowT(void);
+      ~OpticalFlowT(void);
+    public:
+      // estimation state - kept per instance so that concurrent estimations
+      // (e.g. from multiple Python threads) do not share noise parameters.
+      // With bicubic interpolation, the derivatives of the second frame are
+      // computed once per pyramid level, for all the warps of the level
+      InterpolationMethod interpolation;
+      NoiseModel noiseModel;
+      GaussianMixture GMPara;
+      Vector<double> LapPara;
+      // order in which the SOR sweeps visit pixels. The red-black ordering
+      // splits each sweep over nThreads threads (all cores if smaller than 1),
+      // but converges to slightly different results than the (default)
+      // lexicographic one
+      SOROrdering ordering;
+      int nThreads;
+      // the solver of the linear system of each inner fixed point
+      // iteration: SOR sweeps (the default) or conjugate gradients
+      // preconditioned by multigrid V-cycles (see Multigrid), whose
+      // convergence does not slow down on large images. With the multigrid
+      // solver, nSORIterations is the number of V-cycles, tolerance applies
+      // to the relative residual of the system and ordering is not used
+      LinearSolver solver;
+      // if set, the image pyramids are built recursively, which is faster
+      // but gives slightly different results (see GaussianPyramid)
+      bool fastPyramid;
+      // if set, the wall time of every stage of the estimation (and its
+      // number of calls) is added to it, per pyramid level
+      Profile* profile;
+      static const int MinPixelsPerBlock = 16384;
+    public:
+      // if buffers is given, its images are used for the smoothed frames
+      static void getDxs(TImage& imdx,TImage& imdy,TImage& imdt,const TImage& im1,const TImage& im2,LevelBuffers* buffers=NULL);
+      static void SanityCheck(const TImage& imdx,const TImage& imdy,const TImage& imdt,double du,double dv);
+      static void warpFL(TImage& warpIm2,const TImage& Im1,const TImage& Im2,const TImage& vx,const TImage& vy);
+      static void warpFL(TImage& warpIm2,const TImage& Im1,const TImage& Im2,const TImage& flow);
 
 
-      static void genConstFlow(DImage& flow,double value,int width,int height);
-      static void genInImageMask(DImage& mask,const DImage& vx,const DImage& vy,int interval = 0);
-      static void genInImageMask(DImage& mask,const DImage& flow,int interval =0 );
-      static void SmoothFlowPDE(const DImage& Im1,const DImage& Im2, DImage& warpIm2,DImage& vx,DImage& vy,
+      static void genConstFlow(TImage& flow,double value,int width,int height);
+      static void genInImageMask(TImage& mask,const TImage& vx,const TImage& vy,int interval = 0);
+      static void genInImageMask(TImage& mask,const TImage& flow,int interval =0 );
+      // sets mask (of vx.npixels() values) where the forward flow (vx, vy)
+      // moves pixels out of the image, or where the backward flow (bx, by)
+      // at the position a pixel moves to (bilinearly interpolated) does not
+      // bring it back within threshold pixels, i.e. where pixels are likely
+      // occluded
+      static void genOcclusionMask(bool* mask,const TImage& vx,const TImage& vy,const TImage& bx,const TImage& by,double threshold);
+      void SmoothFlowPDE(const TImage& Im1,const TImage& Im2, TImage& warpIm2,TImage& vx,TImage& vy,
           double alpha,int nOuterFPIterations,int nInnerFPIterations,int nCGIterations);
 
-      static void SmoothFlowSOR(const DImage& Im1,const DImage& Im2, DImage& warpIm2, DImage& vx, DImage& vy,
-          double alpha,int nOuterFPIterations,int nInnerFPIterations,int nSORIterations);
+      // returns the total number of SOR iterations run. If tolerance is
+      // positive, each SOR loop stops as soon as the relative update of the
+      // flow increment drops below it. If buffers is given, its images are
+      // used instead of temporary ones. If derivatives2 is given, it holds
+      // the derivatives of Im2 for bicubic warps
+      int SmoothFlowSOR(const TImage& Im1,const TImage& Im2, TImage& warpIm2, TImage& vx, TImage& vy,
+          double alpha,int nOuterFPIterations,int nInnerFPIterations,int nSORIterations,double tolerance=0,
+          LevelBuffers* buffers=NULL,const BicubicDerivatives* derivatives2=NULL);
 
-      static void estGaussianMixture(const DImage& Im1,const DImage& Im2,GaussianMixture& para,double prior = 0.9);
-      static void estLaplacianNoise(const DImage& Im1,const DImage& Im2,Vector<double>& para);
-      static void Laplacian(DImage& output,const DImage& input,const DImage& weight);
+      static void estGaussianMixture(const TImage& Im1,const TImage& Im2,GaussianMixture& para,double prior = 0.9);
+      static void estLaplacianNoise(const TImage& Im1,const TImage& Im2,Vector<double>& para);
+      static void Laplacian(TImage& output,const TImage& input,const TImage& weight);
       static void testLaplacian(int dim=3);
 
-      // function of coarse to fine optical flow
-      static void Coarse2FineFlow(DImage& vx,DImage& vy,DImage &warpI2,const DImage& Im1,const DImage& Im2,double alpha,double ratio,int minWidth,
-          int nOuterFPIterations,int nInnerFPIterations,int nCGIterations);
+      // function of coarse to fine optical flow. If warmStart is set, vx and
+      // vy hold an initial flow estimate (at the resolution of Im1), which is
+      // used instead of a zero flow at the coarsest level. If iterations is
+      // given, it is filled with the number of SOR iterations run at every
+      // pyramid level (finest first). If warp is not set, the final warping
+      // of Im2 into warpI2 is skipped (and warpI2 is left untouched). If
+      // workspace is given, its pyramids and buffers are used (see Workspace).
+      // If stopLevel is positive, the estimation stops at that pyramid level
+      // (or at the coarsest one, if there are fewer levels): vx, vy and warpI2
+      // are then at the resolution of that level, and velocities in its
+      // pixels. If flows is given, it is filled with the velocities vx and vy
+      // estimated at every level, from the stop level (first) to the coarsest
+      // one, i.e. flows[2*k] and flows[2*k+1] hold the ones of level
+      // stopLevel+k
+      void Coarse2FineFlow(TImage& vx,TImage& vy,TImage &warpI2,const TImage& Im1,const TImage& Im2,double alpha,double ratio,int minWidth,
+          int nOuterFPIterations,int nInnerFPIterations,int nCGIterations,bool warmStart=false,
+          double tolerance=0,vector<int>* iterations=NULL,bool warp=true,Workspace* workspace=NULL,
+          int stopLevel=0,vector<TImage>* flows=NULL);
 
-      static void Coarse2FineFlowLevel(DImage& vx,DImage& vy,DImage &warpI2,const DImage& Im1,const DImage& Im2,double alpha,double ratio,int nLevels,
+      // same as above, but using pre-computed pyramids of the two images
+      void Coarse2FineFlow(TImage& vx,TImage& vy,TImage &warpI2,const TImage& Im1,const TImage& Im2,FeaturePyramid& Pyramid1,FeaturePyramid& Pyramid2,
+          double alpha,double ratio,int nOuterFPIterations,int nInnerFPIterations,int nCGIterations,bool warmStart=false,
+          double tolerance=0,vector<int>* iterations=NULL,bool warp=true,Workspace* workspace=NULL,
+          int stopLevel=0,vector<TImage>* flows=NULL);
+
+      // estimates both the flow from Im1 to Im2 (vx, vy, and Im2 warped by it
+      // in warpI2, if warp is set) and the one from Im2 to Im1 (bx, by and
+      // warpI1), with the settings of this solver, on pyramids built once.
+      // Both directions run concurrently (if nThreads is not 1), with the
+      // same results as two calls to Coarse2FineFlow(). Only the construction
+      // of the pyramids is profiled
+      void Coarse2FineFlowBidirectional(TImage& vx,TImage& vy,TImage& warpI2,TImage& bx,TImage& by,TImage& warpI1,
+          const TImage& Im1,const TImage& Im2,double alpha,double ratio,int minWidth,
+          int nOuterFPIterations,int nInnerFPIterations,int nCGIterations,
+          double tolerance=0,bool warp=true);
+
+      void Coarse2FineFlowLevel(TImage& vx,TImage& vy,TImage &warpI2,const TImage& Im1,const TImage& Im2,double alpha,double ratio,int nLevels,
           int nOuterFPIterations,int nInnerFPIterations,int nCGIterations);
 
       // function to convert image to features
-      static void im2feature(DImage& imfeature,const DImage& im);
+      static void im2feature(TImage& imfeature,const TImage& im);
 
       // function to load optical flow
-      static bool LoadOpticalFlow(const char* filename,DImage& flow);
+      static bool LoadOpticalFlow(const char* filename,TImage& flow);
 
-      static bool LoadOpticalFlow(ifstream& myfile,DImage& flow);
+      static bool LoadOpticalFlow(ifstream& myfile,TImage& flow);
 
-      static bool SaveOpticalFlow(const DImage& flow, const char* filename);
+      static bool SaveOpticalFlow(const TImage& flow, const char* filename);
 
-      static bool SaveOpticalFlow(const DImage& flow,ofstream& myfile);
+      static bool SaveOpticalFlow(const TImage& flow,ofstream& myfile);
 
       /**
-        static bool showFlow(const DImage& vx,const char* filename);
+        static bool showFlow(const TImage& vx,const char* filename);
        **/
 
       // function to assemble and dissemble flows
-      static void AssembleFlow(const DImage& vx,const DImage& vy,DImage& flow)
+      static void AssembleFlow(const TImage& vx,const TImage& vy,TImage& flow)
       {
         if(!flow.matchDimension(vx.width(),vx.height(),2))
           flow.allocate(vx.width(),vx.height(),2);
@@ -77,7 +171,7 @@ namespace sor {
           flow.data()[i*2+1] = vy.data()[i];
         }
       }
-      static void DissembleFlow(const DImage& flow,DImage& vx,DImage& vy)
+      static void DissembleFlow(const TImage& flow,TImage& vx,TImage& vy)
       {
         if(!vx.matchDimension(flow.width(),flow.height(),1))
           vx.allocate(flow.width(),flow.height());
@@ -89,7 +183,7 @@ namespace sor {
           vy.data()[i] = flow.data()[i*2+1];
         }
       }
-      static void ComputeOpticalFlow(const DImage& Im1,const DImage& Im2,DImage& flow)
+      static void ComputeOpticalFlow(const TImage& Im1,const TImage& Im2,TImage& flow)
       {
         if(!Im1.matchDimension(Im2))
         {
@@ -106,10 +200,74 @@ namespace sor {
         int nInnerFPIterations=1;
         int nCGIterations=40;
 
-        DImage vx,vy,warpI2;
-        OpticalFlow::Coarse2FineFlow(vx,vy,warpI2,Im1,Im2,alpha,ratio,minWidth,nOuterFPIterations,nInnerFPIterations,nCGIterations);
+        TImage vx,vy,warpI2;
+        OpticalFlowT<T> solver;
+        solver.Coarse2FineFlow(vx,vy,warpI2,Im1,Im2,alpha,ratio,minWidth,nOuterFPIterations,nInnerFPIterations,nCGIterations);
         AssembleFlow(vx,vy,flow);
       }
   };
 
+  // the Gaussian pyramid of an image together with the feature images (see
+  // OpticalFlow::im2feature()) of all of its levels, so they can be re-used
+  // by consecutive frame pairs of a video
+  template <class T>
+  class FeaturePyramidT
+  {
+    public:
+      typedef sor::Image<T> TImage;
+    private:
+      GaussianPyramidT<T> pyramid;
+      vector<TImage> features;
+    public:
+      // if profile is given, the time of the construction of the pyramid and
+      // of the feature images of every level is added to it
+      void ConstructPyramid(const TImage& image,double ratio,int minWidth,bool fast=false,
+          OpticalFlowBase::Profile* profile=NULL);
+      inline int nlevels() const {return pyramid.nlevels();};
+      inline TImage& Image(int index) {return pyramid.Image(index);};
+      inline TImage& Feature(int index) {return features[index];};
+  };
+
+  // the derivatives of an image its bicubic warps interpolate with (see
+  // Image::bicubicDerivatives())
+  struct BicubicDerivatives
+  {
+    DImage dx,dy,dxdy;
+  };
+
+  // the temporary images of OpticalFlow::SmoothFlowSOR() (and of
+  // OpticalFlow::Coarse2FineFlow()) for one pyramid level
+  template <class T>
+  struct LevelBuffersT
+  {
+    typedef sor::Image<T> TImage;
+    TImage mask,imdx,imdy,imdt;
+    TImage du,dv,uu,vv,ux,uy,vx,vy,Phi_1st;
+    TImage imdxy,imdx2,imdy2,imdtdx,imdtdy;
+    TImage foo1,foo2;
+    TImage warpIm2;
+    BicubicDerivatives derivatives2;
+    TImage smooth1,smooth2,smooth,filter;
+    vector<double> blockChange,blockNorm;
+    bob::ip::optflow::liu::Multigrid multigrid;
+  };
+
+  // all the buffers of a coarse to fine estimation: the pyramids of the two
+  // images and the temporary images of every pyramid level. Estimations on
+  // images of the same size (and with the same pyramid settings) re-use the
+  // memory of the previous estimation passed the same workspace instead of
+  // allocating their own. A workspace must not be used by concurrent
+  // estimations
+  template <class T>
+  class WorkspaceT
+  {
+    public:
+      FeaturePyramidT<T> pyramid1,pyramid2;
+      vector<LevelBuffersT<T> > levels;
+  };
+
+  typedef OpticalFlowT<double> OpticalFlow;
+  typedef FeaturePyramidT<double> FeaturePyramid;
+  typedef WorkspaceT<double> Workspace;
+
 }
@@ -11,111 +11,1748 @@
 #endif
 #include <bob.blitz/capi.h>
 #include <bob.blitz/cleanup.h>
+#include <structmember.h>
+
+#include <cstring>
+#include <string>
+#include <vector>
 
 #include "OpticalFlow.h"
+#include "../parallel.h"
+#include "../profile.h"
+#include "../tiling.h"
+
+using bob::ip::optflow::liu::parallel_for;
+using bob::ip::optflow::liu::tiled_flow;
+
+/**
+ * The numpy type number matching the precision of the solver (double, the
+ * default, or float)
+ */
+template <typename T> struct flow_type {};
+template <> struct flow_type<double> { static const int num = NPY_FLOAT64; };
+template <> struct flow_type<float> { static const int num = NPY_FLOAT32; };
+
+/**
+ * Temporarily assigns the memory storage of a C-contiguous image to the image
+ * type of the same precision that is used by Liu's framework. Gray-scale and
+ * interleaved (i.e. ``(height, width, channels)``) color data is aliased,
+ * planar (i.e. ``(channels, height, width)``) color data is converted
+ * (copied) into Liu's interleaved representation. Returns ``true`` if the data
+ * is aliased, in which case ``di.pData`` must be reset before ``di`` is
+ * destroyed.
+ */
+template <typename T>
+static bool data2dimage(T* data, Py_ssize_t nchannels,
+    Py_ssize_t height, Py_ssize_t width, sor::Image<T>& di,
+    bool interleaved=false) {
+  di.clear();
+  if (nchannels == 1 || interleaved) {
+    di.imWidth = width;
+    di.imHeight = height;
+    di.nChannels = nchannels;
+    di.computeDimension();
+    di.pData = data;
+    return true;
+  }
+  di.template ConvertFromMatlab<T>(data, width, height, nchannels);
+  return false;
+}
+
+/**
+ * Temporarily assigns the memory storage from the blitz array (of type
+ * ``flow_type<T>::num``) to the image type that is used by Liu's framework.
+ * 3D arrays are either planar or, if ``interleaved`` is set, interleaved.
+ * Returns ``true`` if the data is aliased (see data2dimage()).
+ */
+template <typename T>
+static bool bz2dimage(PyBlitzArrayObject* bz, sor::Image<T>& di,
+    bool interleaved=false) {
+  if (bz->ndim == 2) {
+    return data2dimage(reinterpret_cast<T*>(bz->data), 1,
+        bz->shape[0], bz->shape[1], di);
+  }
+  if (interleaved) {
+    return data2dimage(reinterpret_cast<T*>(bz->data), bz->shape[2],
+        bz->shape[0], bz->shape[1], di, true);
+  }
+  return data2dimage(reinterpret_cast<T*>(bz->data), bz->shape[0],
+      bz->shape[1], bz->shape[2], di);
+}
+
+/**
+ * Copies the estimated velocities and warped image into new numpy arrays of
+ * the same precision. ``ndim`` and ``shape`` describe the input images, which
+ * are planar (bob-style) or, if ``interleaved`` is set, interleaved. Outputs
+ * have the height and width of ``du`` (which are the ones of the input images,
+ * unless the estimation stopped at a coarser pyramid level). If ``out`` is
+ * given (see check_out()), velocities are written into its arrays instead of
+ * new ones. If ``returnWarped`` is not set, only ``(u, v)`` is returned (and
+ * ``dwarped_i2`` is not used).
+ */
+template <typename T>
+static PyObject* build_flow_output(Py_ssize_t ndim, Py_ssize_t* shape,
+    const sor::Image<T>& du, const sor::Image<T>& dv,
+    sor::Image<T>& dwarped_i2, bool interleaved=false, PyObject* out=0,
+    bool returnWarped=true) {
+
+  Py_ssize_t uv_shape[2] = {du.height(), du.width()};
+
+  PyObject* u = out ? PyTuple_GET_ITEM(out, 0) :
+    PyArray_SimpleNew(2, uv_shape, flow_type<T>::num);
+  if (!u) return 0;
+  if (out) Py_INCREF(u);
+  auto u_ = make_safe(u);
+  void* u_data = PyArray_DATA((PyArrayObject*)u);
+  memcpy(u_data, du.pData, sizeof(T)*du.nElements);
+
+  PyObject* v = out ? PyTuple_GET_ITEM(out, 1) :
+    PyArray_SimpleNew(2, uv_shape, flow_type<T>::num);
+  if (!v) return 0;
+  if (out) Py_INCREF(v);
+  auto v_ = make_safe(v);
+  void* v_data = PyArray_DATA((PyArrayObject*)v);
+  memcpy(v_data, dv.pData, sizeof(T)*dv.nElements);
+
+  if (!returnWarped) return Py_BuildValue("(OO)", u, v);
+
+  Py_ssize_t w2_shape[3] = {du.height(), du.width(), 0};
+  if (ndim == 3 && interleaved) w2_shape[2] = shape[2];
+  if (ndim == 3 && !interleaved) {
+    w2_shape[0] = shape[0];
+    w2_shape[1] = du.height();
+    w2_shape[2] = du.width();
+  }
+
+  PyObject* w2 = PyArray_SimpleNew(ndim, w2_shape, flow_type<T>::num);
+  if (!w2) return 0;
+  auto w2_ = make_safe(w2);
+  void* w2_data = PyArray_DATA((PyArrayObject*)w2);
+
+  if (ndim == 2 || interleaved) {
+    memcpy(w2_data, dwarped_i2.pData, sizeof(T)*dwarped_i2.nElements);
+  }
+  else {
+    dwarped_i2.ConvertToMatlab(reinterpret_cast<T*>(w2_data));
+  }
+
+  return Py_BuildValue("(OOO)", u, v, w2);
+}
+
+/**
+ * Converts the ``init_flow`` argument, a tuple ``(u0, v0)`` of 2D arrays with
+ * the given height and width, into the images that will seed the estimation.
+ * Returns ``false`` (with a Python exception set) in case of problems.
+ */
+template <typename T>
+static bool init_flow2dimage(PyObject* init_flow, Py_ssize_t height,
+    Py_ssize_t width, sor::Image<T>& du, sor::Image<T>& dv) {
+
+  PyBlitzArrayObject* u0 = 0;
+  PyBlitzArrayObject* v0 = 0;
+
+  if (!PyTuple_Check(init_flow) || !PyArg_ParseTuple(init_flow, "O&O&",
+        &PyBlitzArray_Converter, &u0,
+        &PyBlitzArray_Converter, &v0
+        )) {
+    Py_XDECREF(u0);
+    Py_XDECREF(v0);
+    PyErr_SetString(PyExc_TypeError, "`init_flow' should be a tuple `(u0, v0)' containing the initial velocities in `x' and `y'");
+    return false;
+  }
+
+  sor::Image<T>* outputs[2] = {&du, &dv};
+  PyBlitzArrayObject* inputs[2] = {u0, v0};
+  bool ok = true;
+
+  for (int k = 0; k < 2; ++k) {
+
+    PyBlitzArrayObject* tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(inputs[k], flow_type<T>::num);
+    Py_DECREF(inputs[k]);
+    inputs[k] = 0;
+    if (!tmp) { ok = false; continue; }
+    auto tmp_ = make_safe(tmp);
+
+    if (!ok) continue;
+
+    if (tmp->ndim != 2 || tmp->shape[0] != height || tmp->shape[1] != width) {
+      PyErr_Format(PyExc_RuntimeError, "arrays in `init_flow' should be 2D with shape (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d), matching the input images", height, width);
+      ok = false;
+      continue;
+    }
+
+    outputs[k]->allocate(width, height);
+    memcpy(outputs[k]->pData, tmp->data, sizeof(T)*outputs[k]->nElements);
+  }
+
+  return ok;
+}
+
+/**
+ * Checks the ``out`` argument, a tuple ``(u, v)`` of writeable, C-contiguous
+ * 2D arrays of type ``flow_type<T>::num`` with the given height and width,
+ * into which the estimated velocities will be written. Returns ``false``
+ * (with a Python exception set) in case of problems.
+ */
+template <typename T>
+static bool check_out(PyObject* out, Py_ssize_t height, Py_ssize_t width) {
+
+  if (!PyTuple_Check(out) || PyTuple_GET_SIZE(out) != 2) {
+    PyErr_SetString(PyExc_TypeError, "`out' should be a tuple `(u, v)' containing the arrays for the velocities in `x' and `y'");
+    return false;
+  }
+
+  for (int k = 0; k < 2; ++k) {
+    PyObject* o = PyTuple_GET_ITEM(out, k);
+    if (!PyArray_Check(o)) {
+      PyErr_SetString(PyExc_TypeError, "arrays in `out' should be numpy.ndarray's (or subclasses, e.g. numpy.memmap)");
+      return false;
+    }
+    PyArrayObject* a = reinterpret_cast<PyArrayObject*>(o);
+    if (PyArray_TYPE(a) != flow_type<T>::num) {
+      PyErr_Format(PyExc_TypeError, "arrays in `out' should have type `%s', matching the solver precision", PyBlitzArray_TypenumAsString(flow_type<T>::num));
+      return false;
+    }
+    if (PyArray_NDIM(a) != 2 || PyArray_DIM(a, 0) != height || PyArray_DIM(a, 1) != width) {
+      PyErr_Format(PyExc_RuntimeError, "arrays in `out' should be 2D with shape (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d), matching the input images", height, width);
+      return false;
+    }
+    if (!PyArray_ISCARRAY(a)) {
+      PyErr_SetString(PyExc_RuntimeError, "arrays in `out' should be writeable, aligned and C-contiguous");
+      return false;
+    }
+  }
+
+  return true;
+}
+
+/**
+ * Converts the name of a SOR ordering into its value. Returns ``false`` (with
+ * a Python exception set) if the name is unknown.
+ */
+static bool string2ordering(const char* name,
+    sor::OpticalFlow::SOROrdering& ordering) {
+
+  if (strcmp(name, "lexicographic") == 0) {
+    ordering = sor::OpticalFlow::Lexicographic;
+    return true;
+  }
+
+  if (strcmp(name, "redblack") == 0) {
+    ordering = sor::OpticalFlow::RedBlack;
+    return true;
+  }
+
+  PyErr_Format(PyExc_ValueError, "SOR ordering should be either `lexicographic' or `redblack', not `%s'", name);
+  return false;
+}
+
+/**
+ * Converts the name of a linear solver into its value. Returns ``false``
+ * (with a Python exception set) if the name is unknown.
+ */
+static bool string2solver(const char* name,
+    sor::OpticalFlow::LinearSolver& solver) {
+
+  if (strcmp(name, "sor") == 0) {
+    solver = sor::OpticalFlow::SORSolver;
+    return true;
+  }
+
+  if (strcmp(name, "multigrid") == 0) {
+    solver = sor::OpticalFlow::MultigridSolver;
+    return true;
+  }
+
+  PyErr_Format(PyExc_ValueError, "solver should be either `sor' or `multigrid', not `%s'", name);
+  return false;
+}
+
+/**
+ * Converts the name of an interpolation method into its value. Returns
+ * ``false`` (with a Python exception set) if the name is unknown.
+ */
+static bool string2interpolation(const char* name,
+    sor::OpticalFlow::InterpolationMethod& interpolation) {
+
+  if (strcmp(name, "bilinear") == 0) {
+    interpolation = sor::OpticalFlow::Bilinear;
+    return true;
+  }
+
+  if (strcmp(name, "bicubic") == 0) {
+    interpolation = sor::OpticalFlow::Bicubic;
+    return true;
+  }
+
+  PyErr_Format(PyExc_ValueError, "`interpolation' should be either `bilinear' or `bicubic', not `%s'", name);
+  return false;
+}
+
+/**
+ * Builds the list of velocities estimated at every pyramid level, returned by
+ * flow() if ``return_pyramid`` is set: ``flows`` holds the images ``u`` and
+ * ``v`` of every level, from the finest one to the coarsest one, which are
+ * copied into tuples of new numpy arrays of the same precision.
+ */
+template <typename T>
+static PyObject* build_flow_pyramid(const std::vector<sor::Image<T> >& flows) {
+
+  PyObject* retval = PyList_New(flows.size()/2);
+  if (!retval) return 0;
+  auto retval_ = make_safe(retval);
+
+  for (size_t k = 0; k < flows.size()/2; ++k) {
+    PyObject* uv[2] = {0, 0};
+    for (int i = 0; i < 2; ++i) {
+      const sor::Image<T>& image = flows[2*k+i];
+      Py_ssize_t shape[2] = {image.height(), image.width()};
+      uv[i] = PyArray_SimpleNew(2, shape, flow_type<T>::num);
+      if (!uv[i]) {
+        Py_XDECREF(uv[0]);
+        return 0;
+      }
+      memcpy(PyArray_DATA((PyArrayObject*)uv[i]), image.pData,
+          sizeof(T)*image.nElements);
+    }
+    PyObject* level = Py_BuildValue("(NN)", uv[0], uv[1]);
+    if (!level) return 0;
+    PyList_SET_ITEM(retval, k, level);
+  }
+
+  Py_INCREF(retval);
+  return retval;
+}
+
+/**
+ * Builds the dictionary returned by flow() if ``profile`` is set: the wall
+ * time of the whole estimation (``total``, in seconds), the cumulative wall
+ * time and number of calls of every stage over all pyramid levels
+ * (``stages``) and the ones of every pyramid level, from the finest to the
+ * coarsest (``levels``). Stages that do not run at a pyramid level (e.g. the
+ * construction of the pyramids) only appear in ``stages``.
+ */
+static PyObject* build_profile(const bob::ip::optflow::liu::Profile& profile,
+    double total) {
+
+  typedef bob::ip::optflow::liu::Profile::Entry Entry;
+
+  PyObject* stages = PyDict_New();
+  if (!stages) return 0;
+  auto stages_ = make_safe(stages);
+
+  int nlevels = profile.nlevels();
+  PyObject* levels = PyList_New(nlevels);
+  if (!levels) return 0;
+  auto levels_ = make_safe(levels);
+  for (int k = 0; k < nlevels; ++k) {
+    PyObject* level = PyDict_New();
+    if (!level) return 0;
+    PyList_SET_ITEM(levels, k, level);
+  }
+
+  for (auto it = profile.stages.begin(); it != profile.stages.end(); ++it) {
+    Entry sum;
+    for (size_t k = 0; k < it->second.size(); ++k) {
+      const Entry& entry = it->second[k];
+      sum.time += entry.time;
+      sum.calls += entry.calls;
+      if (k == 0 || !entry.calls) continue; //not at a pyramid level
+      PyObject* value = Py_BuildValue("{s:d,s:l}", "time", entry.time,
+          "calls", entry.calls);
+      if (!value) return 0;
+      auto value_ = make_safe(value);
+      if (PyDict_SetItemString(PyList_GET_ITEM(levels, k-1),
+            it->first.c_str(), value) < 0) return 0;
+    }
+    PyObject* value = Py_BuildValue("{s:d,s:l}", "time", sum.time, "calls",
+        sum.calls);
+    if (!value) return 0;
+    auto value_ = make_safe(value);
+    if (PyDict_SetItemString(stages, it->first.c_str(), value) < 0) return 0;
+  }
+
+  return Py_BuildValue("{s:d,s:O,s:O}", "total", total, "stages", stages,
+      "levels", levels);
+}
+
+/**
+ * Converts the ``stop_level`` and ``output_scale`` arguments of flow() into
+ * the pyramid level at which the estimation stops. Level ``k`` is scaled by
+ * ``ratio**k`` (with ``ratio`` clamped as by the pyramid construction), and
+ * the coarsest level that is not smaller than ``output_scale`` is chosen.
+ * Returns ``false`` (with a Python exception set) in case of problems.
+ */
+static bool scale2level(Py_ssize_t stop_level, PyObject* output_scale,
+    double ratio, int& level) {
+
+  if (stop_level < 0) {
+    PyErr_Format(PyExc_ValueError, "`stop_level' should not be negative, but you passed %" PY_FORMAT_SIZE_T "d", stop_level);
+    return false;
+  }
+  level = stop_level;
+
+  if (!output_scale || output_scale == Py_None) return true;
+
+  if (stop_level) {
+    PyErr_SetString(PyExc_ValueError, "`stop_level' and `output_scale' cannot be given at the same time");
+    return false;
+  }
+
+  double scale = PyFloat_AsDouble(output_scale);
+  if (scale == -1. && PyErr_Occurred()) return false;
+  if (!(scale > 0. && scale <= 1.)) {
+    PyErr_Format(PyExc_ValueError, "`output_scale' should be in the interval (0, 1], not %g", scale);
+    return false;
+  }
+
+  if (ratio > 0.98 || ratio < 0.4) ratio = 0.75;
+  level = (int)floor(log(scale)/log(ratio) + 1e-9);
+  return true;
+}
+
+/**
+ * Converts the name of a pyramid construction mode into whether the (faster)
+ * recursive construction is used. Returns ``false`` (with a Python exception
+ * set) if the name is unknown.
+ */
+static bool string2pyramid(const char* name, bool& fast) {
+
+  if (strcmp(name, "exact") == 0) {
+    fast = false;
+    return true;
+  }
+
+  if (strcmp(name, "fast") == 0) {
+    fast = true;
+    return true;
+  }
+
+  PyErr_Format(PyExc_ValueError, "`pyramid' should be either `exact' or `fast', not `%s'", name);
+  return false;
+}
+
+/**
+ * Re-usable memory of flow(): the pyramids of both input images and the
+ * temporary images of the solver at every pyramid level, for images of a
+ * fixed size
+ */
+typedef struct {
+  PyObject_HEAD
+  Py_ssize_t height; ///< height of the images the workspace is meant for
+  Py_ssize_t width; ///< width of the images the workspace is meant for
+  Py_ssize_t channels; ///< number of channels of those images
+  sor::WorkspaceT<double>* ws64; ///< buffers of double precision estimations
+  sor::WorkspaceT<float>* ws32; ///< buffers of single precision estimations
+  bool busy; ///< set while an estimation is using the buffers
+} PyWorkspaceObject;
+
+static PyTypeObject PyWorkspace_Type = {
+  PyVarObject_HEAD_INIT(0, 0)
+  0
+};
+
+/**
+ * The buffers of a workspace for a given solver precision (created on
+ * demand)
+ */
+template <typename T> struct workspace_buffers {};
+template <> struct workspace_buffers<double> {
+  static sor::WorkspaceT<double>*& get(PyWorkspaceObject* self) { return self->ws64; }
+};
+template <> struct workspace_buffers<float> {
+  static sor::WorkspaceT<float>*& get(PyWorkspaceObject* self) { return self->ws32; }
+};
+
+PyDoc_STRVAR(s_workspace_str, BOB_EXT_MODULE_NAME ".Workspace");
+PyDoc_STRVAR(s_workspace_doc,
+"Workspace(height, width, [channels=1])\n\
+\n\
+Re-usable memory for :py:func:`flow`.\n\
+\n\
+A workspace owns the Gaussian pyramids (and feature images) of\n\
+both input images and all temporary images of the solver, at\n\
+every level of the pyramid. They are allocated by the first call\n\
+to :py:func:`flow` using the workspace. Further calls, on images\n\
+of the same size and with the same pyramid settings, re-use them\n\
+instead of allocating (and releasing) their own. Results are the\n\
+same as without a workspace.\n\
+\n\
+Parameters:\n\
+\n\
+height, width\n\
+  The dimensions of the input images the workspace is used with\n\
+\n\
+channels\n\
+  [optional] The number of channels of those images: ``1`` for\n\
+  gray-scale images (the default) or ``3`` for color ones\n\
+\n\
+.. note::\n\
+\n\
+   A workspace cannot be used by concurrent calls: each thread\n\
+   calling :py:func:`flow` at the same time needs its own.\n\
+\n\
+");
+
+static PyObject* PyWorkspace_New(PyTypeObject* type, PyObject*, PyObject*) {
+
+  PyWorkspaceObject* self = (PyWorkspaceObject*)type->tp_alloc(type, 0);
+  if (!self) return 0;
+
+  self->height = 0;
+  self->width = 0;
+  self->channels = 0;
+  self->ws64 = 0;
+  self->ws32 = 0;
+  self->busy = false;
+
+  return reinterpret_cast<PyObject*>(self);
+}
+
+static void PyWorkspace_Delete(PyWorkspaceObject* self) {
+  delete self->ws64;
+  delete self->ws32;
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int PyWorkspace_Init(PyWorkspaceObject* self, PyObject* args,
+    PyObject* kwds) {
+
+  /* Parses input arguments in a single shot */
+  static const char* const_kwlist[] = {"height", "width", "channels", 0};
+  static char** kwlist = const_cast<char**>(const_kwlist);
+
+  Py_ssize_t height = 0;
+  Py_ssize_t width = 0;
+  Py_ssize_t channels = 1;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "nn|n", kwlist,
+        &height,
+        &width,
+        &channels
+        ))
+    return -1;
+
+  if (height <= 0 || width <= 0) {
+    PyErr_Format(PyExc_ValueError, "`height' and `width' should be positive, but you passed %" PY_FORMAT_SIZE_T "d and %" PY_FORMAT_SIZE_T "d", height, width);
+    return -1;
+  }
+
+  if (channels != 1 && channels != 3) {
+    PyErr_Format(PyExc_ValueError, "`channels' should be either 1 or 3, not %" PY_FORMAT_SIZE_T "d", channels);
+    return -1;
+  }
+
+  if (self->busy) {
+    PyErr_Format(PyExc_RuntimeError, "cannot re-initialize a `%s' while it is being used", Py_TYPE(self)->tp_name);
+    return -1;
+  }
+
+  delete self->ws64;
+  self->ws64 = 0;
+  delete self->ws32;
+  self->ws32 = 0;
+  self->height = height;
+  self->width = width;
+  self->channels = channels;
+  return 0;
+}
+
+static PyMemberDef PyWorkspace_members[] = {
+    {
+      const_cast<char*>("height"), T_PYSSIZET,
+      offsetof(PyWorkspaceObject, height), READONLY,
+      const_cast<char*>("The height of the images the workspace is meant for")
+    },
+    {
+      const_cast<char*>("width"), T_PYSSIZET,
+      offsetof(PyWorkspaceObject, width), READONLY,
+      const_cast<char*>("The width of the images the workspace is meant for")
+    },
+    {
+      const_cast<char*>("channels"), T_PYSSIZET,
+      offsetof(PyWorkspaceObject, channels), READONLY,
+      const_cast<char*>("The number of channels of those images")
+    },
+    {0}  /* Sentinel */
+};
+
+static bool init_Workspace(PyObject* module) {
+
+  PyWorkspace_Type.tp_name = s_workspace_str;
+  PyWorkspace_Type.tp_basicsize = sizeof(PyWorkspaceObject);
+  PyWorkspace_Type.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE;
+  PyWorkspace_Type.tp_doc = s_workspace_doc;
+  PyWorkspace_Type.tp_new = PyWorkspace_New;
+  PyWorkspace_Type.tp_init = reinterpret_cast<initproc>(PyWorkspace_Init);
+  PyWorkspace_Type.tp_dealloc = reinterpret_cast<destructor>(PyWorkspace_Delete);
+  PyWorkspace_Type.tp_members = PyWorkspace_members;
+
+  if (PyType_Ready(&PyWorkspace_Type) < 0) return false;
+
+  Py_INCREF(&PyWorkspace_Type);
+  return PyModule_AddObject(module, "Workspace", (PyObject*)&PyWorkspace_Type) >= 0;
+}
+
+/**
+ * Checks the workspace passed to flow() matches the input images and
+ * marks it as used (until the estimation is over)
+ */
+static bool acquire_workspace(PyWorkspaceObject* workspace, Py_ssize_t height,
+    Py_ssize_t width, Py_ssize_t channels) {
+
+  if (workspace->height != height || workspace->width != width ||
+      workspace->channels != channels) {
+    PyErr_Format(PyExc_RuntimeError, "`workspace' was created for images with %" PY_FORMAT_SIZE_T "d channel(s) of %" PY_FORMAT_SIZE_T "d x %" PY_FORMAT_SIZE_T "d pixels, but the input images have %" PY_FORMAT_SIZE_T "d channel(s) of %" PY_FORMAT_SIZE_T "d x %" PY_FORMAT_SIZE_T "d pixels", workspace->channels, workspace->height, workspace->width, channels, height, width);
+    return false;
+  }
+
+  if (workspace->busy) {
+    PyErr_Format(PyExc_RuntimeError, "`workspace' is being used by another estimation");
+    return false;
+  }
+
+  workspace->busy = true;
+  return true;
+}
+
+template <typename T>
+static PyObject* coarse2fine_flow (
+    PyBlitzArrayObject* i1, //first input image
+    PyBlitzArrayObject* i2, //second input image
+    double alpha=1.0,
+    double ratio=0.5,
+    int minWidth=40,
+    int nOuterFPIterations=4,
+    int nInnerFPIterations=1,
+    int nSORIterations=20,
+    PyObject* init_flow=0,
+    double tolerance=0,
+    bool returnIterations=false,
+    sor::OpticalFlow::SOROrdering ordering=sor::OpticalFlow::Lexicographic,
+    int nThreads=0,
+    bool interleaved=false,
+    PyObject* out=0,
+    bool returnWarped=true,
+    PyWorkspaceObject* workspace=0,
+    bool fastPyramid=false,
+    int stopLevel=0,
+    bool returnPyramid=false,
+    bool returnProfile=false,
+    sor::OpticalFlow::LinearSolver linearSolver=sor::OpticalFlow::SORSolver,
+    sor::OpticalFlow::InterpolationMethod interpolation=sor::OpticalFlow::Bilinear
+    ) {
+
+  //Output arrays
+  sor::Image<T> du;
+  sor::Image<T> dv;
+  sor::Image<T> dwarped_i2;
+
+  //Image dimensions
+  Py_ssize_t height = i1->shape[i1->ndim-2];
+  Py_ssize_t width = i1->shape[i1->ndim-1];
+  if (i1->ndim == 3 && interleaved) {
+    height = i1->shape[0];
+    width = i1->shape[1];
+  }
+
+  //Initial flow estimate, if any
+  bool warmStart = (init_flow && init_flow != Py_None);
+  if (warmStart && !init_flow2dimage(init_flow, height, width, du, dv))
+    return 0;
+
+  //Caller-provided output arrays, if any (when stopping at a coarser level,
+  //they are checked once the output dimensions are known)
+  if (out == Py_None) out = 0;
+  if (out && !stopLevel && !check_out<T>(out, height, width)) return 0;
+
+  //Re-usable buffers, if any
+  sor::WorkspaceT<T>* buffers = 0;
+  if (workspace) {
+    Py_ssize_t channels = 1;
+    if (i1->ndim == 3) channels = interleaved ? i1->shape[2] : i1->shape[0];
+    if (!acquire_workspace(workspace, height, width, channels)) return 0;
+    sor::WorkspaceT<T>*& ws = workspace_buffers<T>::get(workspace);
+    if (!ws) ws = new sor::WorkspaceT<T>;
+    buffers = ws;
+  }
+
+  sor::Image<T> di1;
+  sor::Image<T> di2;
+
+  //Maps input images
+  bool aliased = bz2dimage(i1, di1, interleaved);
+  bz2dimage(i2, di2, interleaved);
+
+  //Number of iterations run at every pyramid level
+  std::vector<int> iterations;
+
+  //Velocities estimated at every pyramid level, if requested
+  std::vector<sor::Image<T> > flows;
+
+  //Calls Optical Flow estimation - the solver holds its own noise model, so
+  //concurrent calls from different threads do not interfere
+  sor::OpticalFlowT<T> solver;
+  solver.ordering = ordering;
+  solver.nThreads = nThreads;
+  solver.fastPyramid = fastPyramid;
+  solver.solver = linearSolver;
+  solver.interpolation = interpolation;
+
+  //Time taken by every stage of the estimation, if requested
+  bob::ip::optflow::liu::Profile profile;
+  if (returnProfile) solver.profile = &profile;
+  double total = 0.;
+  std::string error;
+
+  Py_BEGIN_ALLOW_THREADS
+  try {
+    double start = bob::ip::optflow::liu::profile_clock();
+    solver.Coarse2FineFlow(du, dv, dwarped_i2, di1, di2,
+        alpha, ratio, minWidth, nOuterFPIterations, nInnerFPIterations,
+        nSORIterations, warmStart, tolerance, &iterations, returnWarped,
+        buffers, stopLevel, returnPyramid ? &flows : 0);
+    total = bob::ip::optflow::liu::profile_clock() - start;
+  }
+  catch (std::exception& e) {
+    error = e.what();
+  }
+  catch (...) {
+    error = "unknown exception";
+  }
+  Py_END_ALLOW_THREADS
+
+  if (workspace) workspace->busy = false;
+
+  if (aliased) {
+    //Resets input images so we don't get a delete on those
+    di1.pData = 0;
+    di2.pData = 0;
+  }
+  //else { for planar color images we do have to delete! }
+
+  if (!error.empty()) {
+    PyErr_Format(PyExc_RuntimeError, "flow estimation failed: %s", error.c_str());
+    return 0;
+  }
+
+  if (out && stopLevel && !check_out<T>(out, du.height(), du.width()))
+    return 0;
+
+  //Copies output data back
+  PyObject* retval = build_flow_output(i2->ndim, i2->shape, du, dv,
+      dwarped_i2, interleaved, out, returnWarped);
+  if (!retval || (!returnIterations && !returnPyramid && !returnProfile))
+    return retval;
+  auto retval_ = make_safe(retval);
+
+  //Appends the number of iterations run at every level, the velocities
+  //estimated at every level and/or the time taken by every stage
+  PyObject* last = PyTuple_New(returnIterations + returnPyramid +
+      returnProfile);
+  if (!last) return 0;
+  auto last_ = make_safe(last);
+
+  if (returnIterations) {
+    PyObject* levels = PyList_New(iterations.size());
+    if (!levels) return 0;
+    for (size_t k = 0; k < iterations.size(); ++k) {
+      PyObject* value = Py_BuildValue("i", iterations[k]);
+      if (!value) {
+        Py_DECREF(levels);
+        return 0;
+      }
+      PyList_SET_ITEM(levels, k, value);
+    }
+    PyTuple_SET_ITEM(last, 0, levels);
+  }
+
+  if (returnPyramid) {
+    PyObject* pyramid = build_flow_pyramid(flows);
+    if (!pyramid) return 0;
+    PyTuple_SET_ITEM(last, returnIterations, pyramid);
+  }
+
+  if (returnProfile) {
+    PyObject* stages = build_profile(profile, total);
+    if (!stages) return 0;
+    PyTuple_SET_ITEM(last, returnIterations + returnPyramid, stages);
+  }
+
+  return PySequence_Concat(retval, last);
+}
+
+static PyObject* coarse2fine_flow_batch (
+    PyBlitzArrayObject* frames, //stack of input frames
+    double alpha,
+    double ratio,
+    int minWidth,
+    int nOuterFPIterations,
+    int nInnerFPIterations,
+    int nSORIterations,
+    int nThreads,
+    double tolerance
+    ) {
+
+  const Py_ssize_t nFrames = frames->shape[0];
+  const Py_ssize_t nChannels = (frames->ndim == 3) ? 1 : frames->shape[1];
+  const Py_ssize_t height = frames->shape[frames->ndim-2];
+  const Py_ssize_t width = frames->shape[frames->ndim-1];
+  const Py_ssize_t planeSize = height * width;
+
+  //Output array: (N-1, 2, height, width)
+  Py_ssize_t shape[4] = {nFrames-1, 2, height, width};
+  PyObject* uv = PyArray_SimpleNew(4, shape, NPY_FLOAT64);
+  if (!uv) return 0;
+  auto uv_ = make_safe(uv);
+  double* uv_data = reinterpret_cast<double*>(PyArray_DATA((PyArrayObject*)uv));
+
+  double* data = reinterpret_cast<double*>(frames->data);
+  std::vector<sor::DImage> images(nFrames);
+  std::string error;
+
+  //Maps (or converts) all frames and estimates the flow of each consecutive
+  //pair, using a pool of native threads and a single GIL release
+  Py_BEGIN_ALLOW_THREADS
+  try {
+    parallel_for(nFrames, nThreads, [&](int k) {
+        data2dimage(data + k*nChannels*planeSize, nChannels, height, width,
+          images[k]);
+        });
+
+    parallel_for(nFrames-1, nThreads, [&](int k) {
+        sor::OpticalFlow solver;
+        sor::DImage du;
+        sor::DImage dv;
+        sor::DImage dwarped_i2;
+        solver.Coarse2FineFlow(du, dv, dwarped_i2, images[k], images[k+1],
+            alpha, ratio, minWidth, nOuterFPIterations, nInnerFPIterations,
+            nSORIterations, false, tolerance, 0, false);
+        memcpy(uv_data + (2*k)*planeSize, du.pData, sizeof(double)*planeSize);
+        memcpy(uv_data + (2*k+1)*planeSize, dv.pData, sizeof(double)*planeSize);
+        });
+  }
+  catch (std::exception& e) {
+    error = e.what();
+  }
+  catch (...) {
+    error = "unknown exception";
+  }
+
+  //Resets aliased input frames so we don't get a delete on those
+  if (nChannels == 1) for (auto& k : images) k.pData = 0;
+  Py_END_ALLOW_THREADS
+
+  if (!error.empty()) {
+    PyErr_Format(PyExc_RuntimeError, "flow estimation failed: %s", error.c_str());
+    return 0;
+  }
+
+  return Py_BuildValue("O", uv);
+}
+
+PyDoc_STRVAR(s_flow_str, "flow");
+PyDoc_STRVAR(s_flow_doc,
+"flow(i1, i2, [alpha=1.0, [ratio=0.5, [min_width=40, [n_outer_fp_iterations=4, [n_inner_fp_iterations=1, [n_sor_iterations=20, [init_flow=None, [tol=0., [return_iterations=False, [ordering='lexicographic', [n_threads=0, [dtype='float64', [interleaved=False, [out=None, [return_warped=True, [workspace=None, [pyramid='exact', [stop_level=0, [output_scale=None, [return_pyramid=False, [profile=False, [solver='sor', [interpolation='bilinear']]]]]]]]]]]]]]]]]]]]]]]) -> (u, v[, w2][, iterations][, pyramid][, profile])\n\
+\n\
+This method computes the dense optical flow field using a\n\
+coarse-to-fine approach. C++ code running under this call is\n\
+extracted from **the old version (pre Aug 1, 2011)** of\n\
+`Ce Liu's homepage\n\
+<http://people.csail.mit.edu/celiu/OpticalFlow/>`_ and should\n\
+give the exact same output as the Matlab equivalent.\n\
+\n\
+.. note::\n\
+\n\
+   This variant **uses** the Successive Over-Relaxation\n\
+   (SOR) that was implemented on August 1st., 2011 by C. Liu.\n\
+\n\
+Parameters:\n\
+\n\
+i1\n\
+  First input frame (grayscale/double image)\n\
+\n\
+i2\n\
+  Second input frame (same dimension and type of the first frame)\n\
+\n\
+alpha\n\
+  [optional] Regularization weight\n\
+\n\
+ratio\n\
+  [optional] Downsample ratio\n\
+\n\
+min_width\n\
+  [optional] Width of the coarsest level\n\
+\n\
+n_outer_fp_iterations\n\
+  [optional] The number of outer fixed point iterations\n\
+\n\
+n_inner_fp_iterations\n\
+  [optional] The number of inner fixed point iterations\n\
+\n\
+n_sor_iterations\n\
+  [optional] The number of successive-over-relaxation\n\
+  (SOR) iterations\n\
+\n\
+init_flow\n\
+  [optional] A tuple ``(u0, v0)`` with an initial estimate of\n\
+  the velocities (e.g., the flow of the previous pair of frames\n\
+  of a video), with the same dimensions as the input images.\n\
+  The estimation starts from this flow, downsampled to the\n\
+  coarsest level, instead of starting from zero. With a good\n\
+  initial estimate, fewer iterations are needed to converge.\n\
+\n\
+tol\n\
+  [optional] If positive, each SOR loop stops before running\n\
+  ``n_sor_iterations`` iterations, as soon as the relative\n\
+  update of the velocity increments between two successive SOR\n\
+  sweeps drops below this value. By default (``0``), all\n\
+  iterations are run and results are the same as on previous\n\
+  versions.\n\
+\n\
+return_iterations\n\
+  [optional] If set, also returns the number of SOR iterations\n\
+  actually run at every level of the pyramid.\n\
+\n\
+ordering\n\
+  [optional] The order in which each SOR sweep visits pixels.\n\
+  Either ``'lexicographic'`` (the default, row by row, as in the\n\
+  original code) or ``'redblack'``. In the red-black ordering,\n\
+  each sweep first updates pixels ``(y, x)`` with an even\n\
+  ``y + x`` and then the remaining ones. Pixels of the same color\n\
+  do not depend on each other, so each half sweep is split over\n\
+  ``n_threads`` threads. Results slightly differ from the ones of\n\
+  the lexicographic ordering, but do not depend on the number of\n\
+  threads.\n\
+\n\
+n_threads\n\
+  [optional] The number of native threads used by the\n\
+  ``'redblack'`` ordering (and by the smoothing sweeps of the\n\
+  ``'multigrid'`` solver). If smaller than 1 (the default), use\n\
+  one thread per available core. Small pyramid (and multigrid)\n\
+  levels use fewer threads.\n\
+\n\
+dtype\n\
+  [optional] The precision of the solver, either ``'float64'``\n\
+  (the default) or ``'float32'``. In single precision, all\n\
+  images of the pyramids and all intermediate buffers of the\n\
+  solver take half of the memory, the input images are cast to\n\
+  ``float32`` (instead of ``float64``) and all outputs are\n\
+  ``float32`` arrays. Results slightly differ from the ones in\n\
+  double precision (see the user guide).\n\
+\n\
+interleaved\n\
+  [optional] If set, 3D (color) input images are given as\n\
+  ``(height, width, channels)`` arrays with interleaved\n\
+  channels (as produced by most image libraries), instead of\n\
+  bob's planar ``(channels, height, width)`` layout. This is\n\
+  the layout used internally by the solver, so C-contiguous\n\
+  input arrays (of type ``dtype``) are used directly, without\n\
+  any copy. ``warped_i2`` is returned in the same layout.\n\
+\n\
+out\n\
+  [optional] A tuple ``(u, v)`` of writeable, C-contiguous 2D\n\
+  arrays of type ``dtype``, with the same height and width as\n\
+  the input images (e.g. slices of a larger array, or of a\n\
+  :py:class:`numpy.memmap`). If given, the velocities are\n\
+  written into (and returned as) these arrays, instead of new\n\
+  ones.\n\
+\n\
+return_warped\n\
+  [optional] If not set, the final warping of ``i2`` is skipped\n\
+  (saving its time and memory) and ``warped_i2`` is not\n\
+  returned.\n\
+\n\
+workspace\n\
+  [optional] A :py:class:`Workspace` for the shape of the input\n\
+  images. If given, the pyramids and temporary images of the\n\
+  estimation are kept in (and re-used from) the workspace,\n\
+  instead of being allocated by every call.\n\
+\n\
+pyramid\n\
+  [optional] How the Gaussian pyramids of the input images are\n\
+  built. ``'exact'`` (the default) smooths the full resolution\n\
+  image for every level, as the original code. ``'fast'``\n\
+  smooths and downsamples each level from the previous one, in\n\
+  a single pass, which is faster but gives slightly different\n\
+  flows (see the user guide).\n\
+\n\
+stop_level\n\
+  [optional] If positive, the coarse-to-fine estimation stops at\n\
+  this level of the pyramid (``0`` being the input resolution),\n\
+  or at the coarsest level if there are fewer levels, and the\n\
+  outputs are returned at the resolution of that level. Only the\n\
+  levels that are estimated are computed, which saves the time\n\
+  of the finest (and most expensive) ones.\n\
+\n\
+output_scale\n\
+  [optional] Instead of ``stop_level``, the scale (in ``(0, 1]``)\n\
+  of the outputs relative to the input images. The estimation\n\
+  stops at the coarsest level of the pyramid (of scale\n\
+  ``ratio**k``) that is not smaller than ``output_scale``.\n\
+\n\
+return_pyramid\n\
+  [optional] If set, also returns the velocities estimated at\n\
+  every level of the pyramid.\n\
+\n\
+profile\n\
+  [optional] If set, also returns the wall time taken by every\n\
+  stage of the estimation.\n\
+\n\
+solver\n\
+  [optional] The solver of the linear system of every inner fixed\n\
+  point iteration, either ``'sor'`` (the default, with\n\
+  ``n_sor_iterations`` SOR sweeps) or ``'multigrid'``. The\n\
+  multigrid solver runs conjugate gradients preconditioned by a\n\
+  multigrid V-cycle, with at most ``n_sor_iterations`` V-cycles\n\
+  (``tol`` being the relative residual norm, in the metric of the\n\
+  preconditioner, at which it stops). It minimizes the same\n\
+  energy, but converges in far fewer iterations: a few V-cycles\n\
+  (see :py:func:`bob.ip.optflow.liu.mg.flow`) reach residuals\n\
+  many hundreds of SOR sweeps do not. ``ordering`` is not used,\n\
+  and iterations count V-cycles.\n\
+\n\
+interpolation\n\
+  [optional] How the second image is warped by the velocities\n\
+  after every outer fixed point iteration, either\n\
+  ``'bilinear'`` (the default, as in the original code) or\n\
+  ``'bicubic'``. Bicubic interpolation is slower and gives\n\
+  slightly different flows. The final warping of the second\n\
+  image (``warped_i2``) is always bicubic.\n\
+\n\
+Returns a tuple containing three 2D arrays (of type ``dtype``)\n\
+with the same dimensions as the input images (or as the\n\
+``stop_level`` of the pyramid, with velocities in pixels of that\n\
+level):\n\
+\n\
+u\n\
+  Output velocities in ``x`` (horizontal axis).\n\
+\n\
+v\n\
+  Output velocities in ``y`` (vertical axis).\n\
+\n\
+warped_i2\n\
+  (only if ``return_warped`` is set) i2 as estimated by the\n\
+  optical flow field from i1\n\
+\n\
+iterations\n\
+  (only if ``return_iterations`` is set) A list with the total\n\
+  number of SOR iterations run at every pyramid level, over all\n\
+  fixed point iterations, from the finest level (first) to the\n\
+  coarsest one (last). Levels below ``stop_level`` count ``0``\n\
+  iterations.\n\
+\n\
+pyramid\n\
+  (only if ``return_pyramid`` is set) A list with a tuple\n\
+  ``(u, v)`` of 2D arrays for every level of the pyramid that was\n\
+  estimated, from ``stop_level`` (first, the same velocities as\n\
+  the ones returned above) to the coarsest level (last). The\n\
+  velocities of each level are in pixels of that level.\n\
+\n\
+profile\n\
+  (only if ``profile`` is set) A dictionary with the wall time of\n\
+  the whole estimation (``total``, in seconds), the cumulative\n\
+  wall time and number of calls of every stage (``stages``) and\n\
+  the ones of every pyramid level, from the finest (first) to the\n\
+  coarsest (``levels``, a list). Each stage maps to a dictionary\n\
+  with keys ``time`` (in seconds) and ``calls``. Stages are:\n\
+  ``pyramid`` (the Gaussian pyramids), ``im2feature`` (the feature\n\
+  images of every level), ``init`` (the initial flow of every level\n\
+  and the second image warped by it), ``getDxs`` (the image\n\
+  derivatives), ``weights`` (the robust weights and the linear\n\
+  system), ``solver`` (the linear solver), ``warp`` (the warping\n\
+  after every outer fixed point iteration), ``noise`` (the\n\
+  estimation of the noise model) and ``final_warp`` (the final\n\
+  warping of the second image).\n\
+\n\
+");
+
+PyObject* flow(PyObject*, PyObject* args, PyObject* kwds) {
+
+  /* Parses input arguments in a single shot */
+  static const char* const_kwlist[] = {
+    "i1",
+    "i2",
+    "alpha",
+    "ratio",
+    "min_width",
+    "n_outer_fp_iterations",
+    "n_inner_fp_iterations",
+    "n_sor_iterations",
+    "init_flow",
+    "tol",
+    "return_iterations",
+    "ordering",
+    "n_threads",
+    "dtype",
+    "interleaved",
+    "out",
+    "return_warped",
+    "workspace",
+    "pyramid",
+    "stop_level",
+    "output_scale",
+    "return_pyramid",
+    "profile",
+    "solver",
+    "interpolation",
+    0
+  };
+  static char** kwlist = const_cast<char**>(const_kwlist);
+
+  PyBlitzArrayObject* i1 = 0;
+  PyBlitzArrayObject* i2 = 0;
+  double alpha = 1.0;
+  double ratio = 0.5;
+  Py_ssize_t min_width = 40;
+  Py_ssize_t n_outer_fp_iterations = 4;
+  Py_ssize_t n_inner_fp_iterations = 1;
+  Py_ssize_t n_cg_iterations = 20;
+  PyObject* init_flow = 0;
+  double tol = 0.;
+  PyObject* return_iterations = Py_False;
+  const char* ordering = "lexicographic";
+  Py_ssize_t n_threads = 0;
+  int dtype = NPY_FLOAT64;
+  PyObject* interleaved = Py_False;
+  PyObject* out = 0;
+  PyObject* return_warped = Py_True;
+  PyObject* workspace = 0;
+  const char* pyramid = "exact";
+  Py_ssize_t stop_level = 0;
+  PyObject* output_scale = 0;
+  PyObject* return_pyramid = Py_False;
+  PyObject* profile = Py_False;
+  const char* solver = "sor";
+  const char* interpolation = "bilinear";
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&O&|ddnnnnOdOsnO&OOOOsnOOOss", kwlist,
+        &PyBlitzArray_Converter, &i1,
+        &PyBlitzArray_Converter, &i2,
+        &alpha,
+        &ratio,
+        &min_width,
+        &n_outer_fp_iterations,
+        &n_inner_fp_iterations,
+        &n_cg_iterations,
+        &init_flow,
+        &tol,
+        &return_iterations,
+        &ordering,
+        &n_threads,
+        &PyBlitzArray_TypenumConverter, &dtype,
+        &interleaved,
+        &out,
+        &return_warped,
+        &workspace,
+        &pyramid,
+        &stop_level,
+        &output_scale,
+        &return_pyramid,
+        &profile,
+        &solver,
+        &interpolation
+        ))
+    return 0;
+
+  if (dtype != NPY_FLOAT64 && dtype != NPY_FLOAT32) {
+    PyErr_Format(PyExc_ValueError, "`dtype' should be either `float64' or `float32', not `%s'", PyBlitzArray_TypenumAsString(dtype));
+    return 0;
+  }
+
+  int iterations = PyObject_IsTrue(return_iterations);
+  if (iterations < 0) return 0;
+
+  int hwc = PyObject_IsTrue(interleaved);
+  if (hwc < 0) return 0;
+
+  int warped = PyObject_IsTrue(return_warped);
+  if (warped < 0) return 0;
+
+  if (workspace == Py_None) workspace = 0;
+  if (workspace && !PyObject_TypeCheck(workspace, &PyWorkspace_Type)) {
+    PyErr_Format(PyExc_TypeError, "`workspace' should be a `%s', not a `%s'", PyWorkspace_Type.tp_name, Py_TYPE(workspace)->tp_name);
+    return 0;
+  }
+
+  bool fast_pyramid;
+  if (!string2pyramid(pyramid, fast_pyramid)) return 0;
+
+  int level;
+  if (!scale2level(stop_level, output_scale, ratio, level)) return 0;
+
+  int flows = PyObject_IsTrue(return_pyramid);
+  if (flows < 0) return 0;
+
+  int stages = PyObject_IsTrue(profile);
+  if (stages < 0) return 0;
+
+  sor::OpticalFlow::SOROrdering sor_ordering;
+  if (!string2ordering(ordering, sor_ordering)) return 0;
+
+  sor::OpticalFlow::LinearSolver linear_solver;
+  if (!string2solver(solver, linear_solver)) return 0;
+
+  sor::OpticalFlow::InterpolationMethod warp_interpolation;
+  if (!string2interpolation(interpolation, warp_interpolation)) return 0;
+
+  PyBlitzArrayObject* tmp = 0;
+
+  //make sure i1 is convertible to the solver precision
+  tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(i1, dtype);
+  Py_DECREF(i1);
+  i1 = tmp;
+  if (!i1) return 0;
+  auto i1_ = make_safe(i1);
+
+  //make sure i2 is convertible to the solver precision
+  tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(i2, dtype);
+  Py_DECREF(i2);
+  i2 = tmp;
+  if (!i2) return 0;
+  auto i2_ = make_safe(i2);
+
+  //some checks
+  if (i1->ndim != 2 && i1->ndim != 3) {
+    PyErr_Format(PyExc_TypeError, "method only supports 2D or 3D arrays for input image `i1', but you passed an array with %" PY_FORMAT_SIZE_T "d dimensions", i1->ndim);
+    return 0;
+  }
+
+  if (i1->ndim != i2->ndim) {
+    PyErr_Format(PyExc_TypeError, "input image arrays must have the same number of dimensions, but image `i1' has %" PY_FORMAT_SIZE_T "d dimensions while image `i2' has %" PY_FORMAT_SIZE_T "d", i1->ndim, i2->ndim);
+    return 0;
+  }
+
+  if (i1->ndim == 2) {
+    if (i1->shape[0] != i2->shape[0] || i2->shape[1] != i2->shape[1]) {
+    PyErr_Format(PyExc_RuntimeError, "shapes of the input images differ: (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d) != (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d)", i1->shape[0], i1->shape[1], i2->shape[0], i2->shape[1]);
+    return 0;
+    }
+  }
+  else { //ndim == 3
+    if (i1->shape[0] != i2->shape[0] || i2->shape[1] != i2->shape[1] ||
+        i2->shape[2] != i2->shape[2]) {
+      PyErr_Format(PyExc_RuntimeError, "shapes of the input images differ: (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d) != (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d)", i1->shape[0], i1->shape[1], i1->shape[2], i2->shape[0], i2->shape[1], i2->shape[2]);
+      return 0;
+    }
+  }
+
+  if (dtype == NPY_FLOAT32) {
+    return coarse2fine_flow<float>(i1, i2, alpha, ratio, min_width,
+        n_outer_fp_iterations, n_inner_fp_iterations, n_cg_iterations, init_flow, tol,
+        iterations, sor_ordering, n_threads, hwc, out, warped,
+        (PyWorkspaceObject*)workspace, fast_pyramid, level, flows, stages,
+        linear_solver, warp_interpolation);
+  }
+
+  return coarse2fine_flow<double>(i1, i2, alpha, ratio, min_width,
+      n_outer_fp_iterations, n_inner_fp_iterations, n_cg_iterations, init_flow, tol,
+      iterations, sor_ordering, n_threads, hwc, out, warped,
+      (PyWorkspaceObject*)workspace, fast_pyramid, level, flows, stages,
+      linear_solver, warp_interpolation);
+
+}
+
+template <typename T>
+static PyObject* coarse2fine_flow_bidirectional (
+    PyBlitzArrayObject* i1, //first input image
+    PyBlitzArrayObject* i2, //second input image
+    double alpha,
+    double ratio,
+    int minWidth,
+    int nOuterFPIterations,
+    int nInnerFPIterations,
+    int nSORIterations,
+    double tolerance,
+    sor::OpticalFlow::SOROrdering ordering,
+    int nThreads,
+    bool returnWarped,
+    bool fastPyramid,
+    sor::OpticalFlow::LinearSolver linearSolver,
+    bool returnOcclusion,
+    double threshold
+    ) {
+
+  //Output arrays
+  sor::Image<T> du;
+  sor::Image<T> dv;
+  sor::Image<T> dwarped_i2;
+  sor::Image<T> bu;
+  sor::Image<T> bv;
+  sor::Image<T> dwarped_i1;
+
+  //Occlusion mask, if requested
+  Py_ssize_t height = i1->shape[i1->ndim-2];
+  Py_ssize_t width = i1->shape[i1->ndim-1];
+  Py_ssize_t mask_shape[2] = {height, width};
+  PyObject* occlusion = 0;
+  if (returnOcclusion) {
+    occlusion = PyArray_SimpleNew(2, mask_shape, NPY_BOOL);
+    if (!occlusion) return 0;
+  }
+  auto occlusion_ = make_xsafe(occlusion);
+
+  sor::Image<T> di1;
+  sor::Image<T> di2;
+
+  //Maps input images
+  bool aliased = bz2dimage(i1, di1);
+  bz2dimage(i2, di2);
+
+  sor::OpticalFlowT<T> solver;
+  solver.ordering = ordering;
+  solver.nThreads = nThreads;
+  solver.fastPyramid = fastPyramid;
+  solver.solver = linearSolver;
+
+  std::string error;
+
+  Py_BEGIN_ALLOW_THREADS
+  try {
+    solver.Coarse2FineFlowBidirectional(du, dv, dwarped_i2, bu, bv,
+        dwarped_i1, di1, di2, alpha, ratio, minWidth, nOuterFPIterations,
+        nInnerFPIterations, nSORIterations, tolerance, returnWarped);
+    if (occlusion) {
+      sor::OpticalFlowT<T>::genOcclusionMask(reinterpret_cast<bool*>(
+            PyArray_DATA((PyArrayObject*)occlusion)), du, dv, bu, bv,
+          threshold);
+    }
+  }
+  catch (std::exception& e) {
+    error = e.what();
+  }
+  catch (...) {
+    error = "unknown exception";
+  }
+  Py_END_ALLOW_THREADS
+
+  if (aliased) {
+    //Resets input images so we don't get a delete on those
+    di1.pData = 0;
+    di2.pData = 0;
+  }
+
+  if (!error.empty()) {
+    PyErr_Format(PyExc_RuntimeError, "flow estimation failed: %s", error.c_str());
+    return 0;
+  }
+
+  //Copies output data back, forward flow first
+  PyObject* forward = build_flow_output(i2->ndim, i2->shape, du, dv,
+      dwarped_i2, false, 0, returnWarped);
+  if (!forward) return 0;
+  auto forward_ = make_safe(forward);
+
+  PyObject* backward = build_flow_output(i1->ndim, i1->shape, bu, bv,
+      dwarped_i1, false, 0, returnWarped);
+  if (!backward) return 0;
+  auto backward_ = make_safe(backward);
+
+  PyObject* retval = PySequence_Concat(forward, backward);
+  if (!retval || !occlusion) return retval;
+  auto retval_ = make_safe(retval);
+
+  PyObject* last = Py_BuildValue("(O)", occlusion);
+  if (!last) return 0;
+  auto last_ = make_safe(last);
+
+  return PySequence_Concat(retval, last);
+}
+
+PyDoc_STRVAR(s_flow_bidirectional_str, "flow_bidirectional");
+PyDoc_STRVAR(s_flow_bidirectional_doc,
+"flow_bidirectional(i1, i2, [alpha=1.0, [ratio=0.5, [min_width=40, [n_outer_fp_iterations=4, [n_inner_fp_iterations=1, [n_sor_iterations=20, [tol=0., [ordering='lexicographic', [n_threads=0, [dtype='float64', [return_warped=True, [pyramid='exact', [solver='sor', [return_occlusion=False, [threshold=1.0]]]]]]]]]]]]]]]) -> (u, v[, w2], bu, bv[, w1][, occlusion])\n\
+\n\
+Computes both the optical flow leading ``i1`` into ``i2`` and the\n\
+one leading ``i2`` into ``i1``, with the same results as two\n\
+calls to :py:func:`flow`, but building the Gaussian pyramid (and\n\
+the feature images) of each image once, and estimating both\n\
+directions concurrently, on two native threads. The GIL is\n\
+released for the whole estimation.\n\
+\n\
+Parameters:\n\
+\n\
+i1, i2\n\
+  Same as for :py:func:`flow` (3D images are planar)\n\
+\n\
+alpha, ratio, min_width, n_outer_fp_iterations, n_inner_fp_iterations, n_sor_iterations, tol, ordering, dtype, return_warped, pyramid, solver\n\
+  [optional] Same as for :py:func:`flow`\n\
+\n\
+n_threads\n\
+  [optional] The number of native threads estimating both\n\
+  directions. They are shared by the two directions, each one\n\
+  using half of them with the ``'redblack'`` ordering (or the\n\
+  ``'multigrid'`` solver, see :py:func:`flow`). If ``1``, both\n\
+  directions are estimated one after the other. If smaller than\n\
+  1 (the default), use one thread per available core.\n\
+\n\
+return_occlusion\n\
+  [optional] If set, also returns the pixels of ``i1`` that are\n\
+  likely occluded in ``i2``, by checking the consistency of both\n\
+  flows.\n\
+\n\
+threshold\n\
+  [optional] The largest distance (in pixels) between a pixel and\n\
+  the position it is brought back to by the backward flow (at\n\
+  the position the forward flow moves it to), for the pixel not\n\
+  to be occluded.\n\
+\n\
+Returns a tuple containing four 2D arrays (of type ``dtype``)\n\
+with the same dimensions as the input images, plus the warped\n\
+images and/or the occlusion mask, if requested:\n\
+\n\
+u, v\n\
+  The velocities in ``x`` and ``y`` leading ``i1`` into ``i2``.\n\
+\n\
+w2\n\
+  (only if ``return_warped`` is set) i2 as estimated by the\n\
+  optical flow field from i1\n\
+\n\
+bu, bv\n\
+  The velocities in ``x`` and ``y`` leading ``i2`` into ``i1``.\n\
+\n\
+w1\n\
+  (only if ``return_warped`` is set) i1 as estimated by the\n\
+  optical flow field from i2\n\
+\n\
+occlusion\n\
+  (only if ``return_occlusion`` is set) A 2D boolean array, set\n\
+  for the pixels of ``i1`` that the forward flow moves out of the\n\
+  image, or whose forward and backward velocities (the latter\n\
+  bilinearly interpolated at the position the pixel moves to) do\n\
+  not cancel out within ``threshold`` pixels.\n\
+\n\
+");
+
+PyObject* flow_bidirectional(PyObject*, PyObject* args, PyObject* kwds) {
+
+  /* Parses input arguments in a single shot */
+  static const char* const_kwlist[] = {
+    "i1",
+    "i2",
+    "alpha",
+    "ratio",
+    "min_width",
+    "n_outer_fp_iterations",
+    "n_inner_fp_iterations",
+    "n_sor_iterations",
+    "tol",
+    "ordering",
+    "n_threads",
+    "dtype",
+    "return_warped",
+    "pyramid",
+    "solver",
+    "return_occlusion",
+    "threshold",
+    0
+  };
+  static char** kwlist = const_cast<char**>(const_kwlist);
+
+  PyBlitzArrayObject* i1 = 0;
+  PyBlitzArrayObject* i2 = 0;
+  double alpha = 1.0;
+  double ratio = 0.5;
+  Py_ssize_t min_width = 40;
+  Py_ssize_t n_outer_fp_iterations = 4;
+  Py_ssize_t n_inner_fp_iterations = 1;
+  Py_ssize_t n_iterations = 20;
+  double tol = 0.;
+  const char* ordering = "lexicographic";
+  Py_ssize_t n_threads = 0;
+  int dtype = NPY_FLOAT64;
+  PyObject* return_warped = Py_True;
+  const char* pyramid = "exact";
+  const char* solver = "sor";
+  PyObject* return_occlusion = Py_False;
+  double threshold = 1.0;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&O&|ddnnnndsnO&OssOd", kwlist,
+        &PyBlitzArray_Converter, &i1,
+        &PyBlitzArray_Converter, &i2,
+        &alpha,
+        &ratio,
+        &min_width,
+        &n_outer_fp_iterations,
+        &n_inner_fp_iterations,
+        &n_iterations,
+        &tol,
+        &ordering,
+        &n_threads,
+        &PyBlitzArray_TypenumConverter, &dtype,
+        &return_warped,
+        &pyramid,
+        &solver,
+        &return_occlusion,
+        &threshold
+        ))
+    return 0;
+
+  auto i1_ = make_safe(i1);
+  auto i2_ = make_safe(i2);
+
+  if (dtype != NPY_FLOAT64 && dtype != NPY_FLOAT32) {
+    PyErr_Format(PyExc_ValueError, "`dtype' should be either `float64' or `float32', not `%s'", PyBlitzArray_TypenumAsString(dtype));
+    return 0;
+  }
+
+  int warped = PyObject_IsTrue(return_warped);
+  if (warped < 0) return 0;
+
+  int occlusion = PyObject_IsTrue(return_occlusion);
+  if (occlusion < 0) return 0;
+
+  if (threshold < 0) {
+    PyErr_Format(PyExc_ValueError, "`threshold' should not be negative, but you passed %g", threshold);
+    return 0;
+  }
+
+  bool fast_pyramid;
+  if (!string2pyramid(pyramid, fast_pyramid)) return 0;
+
+  sor::OpticalFlow::SOROrdering sor_ordering;
+  if (!string2ordering(ordering, sor_ordering)) return 0;
+
+  sor::OpticalFlow::LinearSolver linear_solver;
+  if (!string2solver(solver, linear_solver)) return 0;
+
+  //make sure both images are convertible to the solver precision
+  PyBlitzArrayObject* c1 = (PyBlitzArrayObject*)PyBlitzArray_Cast(i1, dtype);
+  if (!c1) return 0;
+  auto c1_ = make_safe(c1);
+
+  PyBlitzArrayObject* c2 = (PyBlitzArrayObject*)PyBlitzArray_Cast(i2, dtype);
+  if (!c2) return 0;
+  auto c2_ = make_safe(c2);
+
+  //some checks
+  if (c1->ndim != 2 && c1->ndim != 3) {
+    PyErr_Format(PyExc_TypeError, "method only supports 2D or 3D arrays for input image `i1', but you passed an array with %" PY_FORMAT_SIZE_T "d dimensions", c1->ndim);
+    return 0;
+  }
+
+  if (c1->ndim != c2->ndim) {
+    PyErr_Format(PyExc_TypeError, "input image arrays must have the same number of dimensions, but image `i1' has %" PY_FORMAT_SIZE_T "d dimensions while image `i2' has %" PY_FORMAT_SIZE_T "d", c1->ndim, c2->ndim);
+    return 0;
+  }
+
+  for (Py_ssize_t k = 0; k < c1->ndim; ++k) {
+    if (c1->shape[k] != c2->shape[k]) {
+      PyErr_Format(PyExc_RuntimeError, "shapes of the input images differ along dimension %" PY_FORMAT_SIZE_T "d: %" PY_FORMAT_SIZE_T "d != %" PY_FORMAT_SIZE_T "d", k, c1->shape[k], c2->shape[k]);
+      return 0;
+    }
+  }
+
+  if (dtype == NPY_FLOAT32) {
+    return coarse2fine_flow_bidirectional<float>(c1, c2, alpha, ratio,
+        min_width, n_outer_fp_iterations, n_inner_fp_iterations,
+        n_iterations, tol, sor_ordering, n_threads, warped, fast_pyramid,
+        linear_solver, occlusion, threshold);
+  }
+
+  return coarse2fine_flow_bidirectional<double>(c1, c2, alpha, ratio,
+      min_width, n_outer_fp_iterations, n_inner_fp_iterations, n_iterations,
+      tol, sor_ordering, n_threads, warped, fast_pyramid, linear_solver,
+      occlusion, threshold);
+
+}
+
+PyDoc_STRVAR(s_flow_batch_str, "flow_batch");
+PyDoc_STRVAR(s_flow_batch_doc,
+"flow_batch(frames, [alpha=1.0, [ratio=0.5, [min_width=40, [n_outer_fp_iterations=4, [n_inner_fp_iterations=1, [n_sor_iterations=20, [n_threads=0, [tol=0.]]]]]]]]) -> uv\n\
+\n\
+Computes the dense optical flow field between every two\n\
+consecutive frames of a stack, using the same estimator as\n\
+:py:func:`flow`. Pairs are distributed over a pool of native\n\
+threads and the GIL is released once for the whole batch.\n\
+\n\
+Parameters:\n\
+\n\
+frames\n\
+  A stack of ``N`` input frames. Either a 3D array with shape\n\
+  ``(N, height, width)`` (gray-scale) or a 4D array with shape\n\
+  ``(N, 3, height, width)`` (color, with planar channels), with\n\
+  ``N >= 2``\n\
+\n\
+alpha, ratio, min_width, n_outer_fp_iterations, n_inner_fp_iterations, n_sor_iterations\n\
+  [optional] Same as for :py:func:`flow`\n\
+\n\
+n_threads\n\
+  [optional] The number of native threads to use. If smaller\n\
+  than 1 (the default), use one thread per available core.\n\
+\n\
+tol\n\
+  [optional] Same as for :py:func:`flow`\n\
+\n\
+Returns a 4D double array with shape ``(N-1, 2, height, width)``.\n\
+Entry ``uv[k]`` contains the velocities ``u`` and ``v`` (see\n\
+:py:func:`flow`) estimated between frames ``k`` and ``k+1``.\n\
+\n\
+");
 
-/**
- * Temporarily assigns the memory storage from the blitz array to the double
- * image type that is used by Liu's framework.
- */
-static void bz2dimage(PyBlitzArrayObject* bz, sor::DImage& di) {
-  di.clear();
-  if (bz->ndim == 2) {
-    di.imWidth = bz->shape[1];
-    di.imHeight = bz->shape[0];
-    di.nChannels = 1;
-    di.computeDimension();
-    di.pData = reinterpret_cast<double*>(bz->data);
+PyObject* flow_batch(PyObject*, PyObject* args, PyObject* kwds) {
+
+  /* Parses input arguments in a single shot */
+  static const char* const_kwlist[] = {
+    "frames",
+    "alpha",
+    "ratio",
+    "min_width",
+    "n_outer_fp_iterations",
+    "n_inner_fp_iterations",
+    "n_sor_iterations",
+    "n_threads",
+    "tol",
+    0
+  };
+  static char** kwlist = const_cast<char**>(const_kwlist);
+
+  PyBlitzArrayObject* frames = 0;
+  double alpha = 1.0;
+  double ratio = 0.5;
+  Py_ssize_t min_width = 40;
+  Py_ssize_t n_outer_fp_iterations = 4;
+  Py_ssize_t n_inner_fp_iterations = 1;
+  Py_ssize_t n_iterations = 20;
+  Py_ssize_t n_threads = 0;
+  double tol = 0.;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&|ddnnnnnd", kwlist,
+        &PyBlitzArray_Converter, &frames,
+        &alpha,
+        &ratio,
+        &min_width,
+        &n_outer_fp_iterations,
+        &n_inner_fp_iterations,
+        &n_iterations,
+        &n_threads,
+        &tol
+        ))
+    return 0;
+
+  //make sure frames are convertible to float64
+  PyBlitzArrayObject* tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(frames, NPY_FLOAT64);
+  Py_DECREF(frames);
+  frames = tmp;
+  if (!frames) return 0;
+  auto frames_ = make_safe(frames);
+
+  //some checks
+  if (frames->ndim != 3 && frames->ndim != 4) {
+    PyErr_Format(PyExc_TypeError, "method only supports 3D or 4D arrays for input `frames', but you passed an array with %" PY_FORMAT_SIZE_T "d dimensions", frames->ndim);
+    return 0;
   }
-  else {
-    di.ConvertFromMatlab<double>(reinterpret_cast<double*>(bz->data),
-        bz->shape[2], bz->shape[1], bz->shape[0]);
+
+  if (frames->shape[0] < 2) {
+    PyErr_Format(PyExc_RuntimeError, "input `frames' must contain at least 2 frames, but you passed %" PY_FORMAT_SIZE_T "d", frames->shape[0]);
+    return 0;
+  }
+
+  if (frames->ndim == 4 && frames->shape[1] != 1 && frames->shape[1] != 3) {
+    PyErr_Format(PyExc_ValueError, "4D input `frames' should be a stack of color frames with shape (N, 3, height, width), but you passed an array with shape (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d) - frames with interleaved channels, of shape (N, height, width, 3), must be transposed first", frames->shape[0], frames->shape[1], frames->shape[2], frames->shape[3]);
+    return 0;
   }
+
+  return coarse2fine_flow_batch(frames, alpha, ratio, min_width,
+      n_outer_fp_iterations, n_inner_fp_iterations, n_iterations, n_threads,
+      tol);
+
 }
 
-static PyObject* coarse2fine_flow (
+static PyObject* coarse2fine_flow_tiled (
     PyBlitzArrayObject* i1, //first input image
     PyBlitzArrayObject* i2, //second input image
-    double alpha=1.0,
-    double ratio=0.5,
-    int minWidth=40,
-    int nOuterFPIterations=4,
-    int nInnerFPIterations=1,
-    int nSORIterations=20
+    const Py_ssize_t* roi, //(top, left, height, width)
+    const Py_ssize_t* tile, //(height, width)
+    int overlap,
+    int nThreads,
+    double alpha,
+    double ratio,
+    int minWidth,
+    int nOuterFPIterations,
+    int nInnerFPIterations,
+    int nSORIterations,
+    double tolerance
     ) {
 
   sor::DImage di1;
   sor::DImage di2;
 
   //Maps input images
-  bz2dimage(i1, di1);
+  bool aliased = bz2dimage(i1, di1);
   bz2dimage(i2, di2);
 
-  //Output arrays
   sor::DImage du;
   sor::DImage dv;
-  sor::DImage dwarped_i2;
+  std::string error;
 
-  //Calls Optical Flow estimation
+  //Estimates the flow tile by tile, using a pool of native threads and a
+  //single GIL release
   Py_BEGIN_ALLOW_THREADS
-  sor::OpticalFlow::Coarse2FineFlow(du, dv, dwarped_i2, di1, di2,
-      alpha, ratio, minWidth, nOuterFPIterations, nInnerFPIterations,
-      nSORIterations);
+  try {
+    tiled_flow(du, dv, di1, di2, roi[0], roi[1], roi[2], roi[3], tile[0],
+        tile[1], overlap, ratio, minWidth, nThreads,
+        [&](sor::DImage& vx, sor::DImage& vy, const sor::DImage& im1,
+          const sor::DImage& im2, bool warmStart) {
+          sor::OpticalFlow solver;
+          sor::DImage dwarped_i2;
+          solver.Coarse2FineFlow(vx, vy, dwarped_i2, im1, im2, alpha, ratio,
+              minWidth, nOuterFPIterations, nInnerFPIterations,
+              nSORIterations, warmStart, tolerance, 0, false);
+          });
+  }
+  catch (std::exception& e) {
+    error = e.what();
+  }
+  catch (...) {
+    error = "unknown exception";
+  }
   Py_END_ALLOW_THREADS
 
-  if (i1->ndim == 2) {
+  if (aliased) {
     //Resets input images so we don't get a delete on those
     di1.pData = 0;
     di2.pData = 0;
   }
-  //else { for info.nd == 3 we do have to delete! }
 
-  //Copies output data back
-  Py_ssize_t* shape = i1->shape;
-  if (i1->ndim == 3) shape += 1; //use the last two indices
+  if (!error.empty()) {
+    PyErr_Format(PyExc_RuntimeError, "flow estimation failed: %s", error.c_str());
+    return 0;
+  }
 
+  //Copies output data back
+  Py_ssize_t shape[2] = {roi[2], roi[3]};
   PyObject* u = PyArray_SimpleNew(2, shape, NPY_FLOAT64);
   if (!u) return 0;
   auto u_ = make_safe(u);
-  void* u_data = PyArray_DATA((PyArrayObject*)u);
-  memcpy(u_data, du.pData, sizeof(double)*du.nElements);
+  memcpy(PyArray_DATA((PyArrayObject*)u), du.pData, sizeof(double)*du.nElements);
 
   PyObject* v = PyArray_SimpleNew(2, shape, NPY_FLOAT64);
   if (!v) return 0;
   auto v_ = make_safe(v);
-  void* v_data = PyArray_DATA((PyArrayObject*)v);
-  memcpy(v_data, dv.pData, sizeof(double)*dv.nElements);
-
-  PyObject* w2 = PyArray_SimpleNew(i2->ndim, i2->shape, NPY_FLOAT64);
-  if (!w2) return 0;
-  auto w2_ = make_safe(w2);
-  void* w2_data = PyArray_DATA((PyArrayObject*)w2);
-
-  if (i1->ndim == 2) {
-    memcpy(w2_data, dwarped_i2.pData, sizeof(double)*dwarped_i2.nElements);
-  }
-  else {
-    dwarped_i2.ConvertToMatlab(reinterpret_cast<double*>(w2_data));
-  }
+  memcpy(PyArray_DATA((PyArrayObject*)v), dv.pData, sizeof(double)*dv.nElements);
 
-  return Py_BuildValue("(OOO)", u, v, w2);
+  return Py_BuildValue("(OO)", u, v);
 }
 
-PyDoc_STRVAR(s_flow_str, "flow");
-PyDoc_STRVAR(s_flow_doc,
-"flow(i1, i2, [alpha=1.0, [ratio=0.5, [min_width=40, [n_outer_fp_iterations=4, [n_inner_fp_iterations=1, [n_sor_iterations=20]]]]]]) -> (u, v, w2)\n\
-\n\
-This method computes the dense optical flow field using a\n\
-coarse-to-fine approach. C++ code running under this call is\n\
-extracted from **the old version (pre Aug 1, 2011)** of\n\
-`Ce Liu's homepage\n\
-<http://people.csail.mit.edu/celiu/OpticalFlow/>`_ and should\n\
-give the exact same output as the Matlab equivalent.\n\
+PyDoc_STRVAR(s_flow_tiled_str, "flow_tiled");
+PyDoc_STRVAR(s_flow_tiled_doc,
+"flow_tiled(i1, i2, [tile=(512, 512), [overlap=64, [n_threads=0, [roi=None, [alpha=1.0, [ratio=0.5, [min_width=40, [n_outer_fp_iterations=4, [n_inner_fp_iterations=1, [n_sor_iterations=20, [tol=0.]]]]]]]]]]]) -> (u, v)\n\
 \n\
-.. note::\n\
+Computes the dense optical flow field of large images (or of a\n\
+region of interest) tile by tile, using the same estimator as\n\
+:py:func:`flow`. Only the images of a tile (instead of the ones\n\
+of the whole frame) are kept in memory by each estimation, and\n\
+tiles are distributed over a pool of native threads.\n\
 \n\
-   This variant **uses** the Successive Over-Relaxation\n\
-   (SOR) that was implemented on August 1st., 2011 by C. Liu.\n\
+The whole region is first estimated at the finest level of the\n\
+pyramid that fits in a tile. Each tile is then estimated with\n\
+a margin of ``overlap`` pixels on every side (where available),\n\
+starting from this coarse flow (see ``init_flow`` in\n\
+:py:func:`flow`), and blended with its neighbours over the\n\
+margins. Results are close to, but not the same as, the ones of\n\
+:py:func:`flow`. If the region and its margins fit in a single\n\
+tile, its flow is estimated as :py:func:`flow` does.\n\
 \n\
 Parameters:\n\
 \n\
@@ -125,27 +1762,31 @@ i1\n\
 i2\n\
   Second input frame (same dimension and type of the first frame)\n\
 \n\
-alpha\n\
-  [optional] Regularization weight\n\
-\n\
-ratio\n\
-  [optional] Downsample ratio\n\
+tile\n\
+  [optional] The largest ``(height, width)`` of the tiles. The\n\
+  region of interest is split into tiles of even sizes, which\n\
+  are not made narrower than the pyramid needs (i.e.\n\
+  ``min_width/ratio`` pixels).\n\
 \n\
-min_width\n\
-  [optional] Width of the coarsest level\n\
+overlap\n\
+  [optional] The number of pixels by which tiles extend over\n\
+  their neighbours (and over the region of interest, where\n\
+  available).\n\
 \n\
-n_outer_fp_iterations\n\
-  [optional] The number of outer fixed point iterations\n\
+n_threads\n\
+  [optional] The number of native threads to use. If smaller\n\
+  than 1 (the default), use one thread per available core.\n\
 \n\
-n_inner_fp_iterations\n\
-  [optional] The number of inner fixed point iterations\n\
+roi\n\
+  [optional] A tuple ``(top, left, height, width)`` with the\n\
+  region of the input images to compute the flow of. By\n\
+  default, the flow of the whole images is computed.\n\
 \n\
-n_sor_iterations\n\
-  [optional] The number of successive-over-relaxation\n\
-  (SOR) iterations\n\
+alpha, ratio, min_width, n_outer_fp_iterations, n_inner_fp_iterations, n_sor_iterations, tol\n\
+  [optional] Same as for :py:func:`flow`\n\
 \n\
-Returns a tuple containing three 2D double arrays with the same\n\
-dimensions as the input images:\n\
+Returns a tuple containing two 2D double arrays with the height\n\
+and width of the region of interest:\n\
 \n\
 u\n\
   Output velocities in ``x`` (horizontal axis).\n\
@@ -153,58 +1794,70 @@ u\n\
 v\n\
   Output velocities in ``y`` (vertical axis).\n\
 \n\
-warped_i2\n\
-  i2 as estimated by the optical flow field from i1\n\
-\n\
 ");
 
-PyObject* flow(PyObject*, PyObject* args, PyObject* kwds) {
+PyObject* flow_tiled(PyObject*, PyObject* args, PyObject* kwds) {
 
   /* Parses input arguments in a single shot */
   static const char* const_kwlist[] = {
     "i1",
     "i2",
+    "tile",
+    "overlap",
+    "n_threads",
+    "roi",
     "alpha",
     "ratio",
     "min_width",
     "n_outer_fp_iterations",
     "n_inner_fp_iterations",
     "n_sor_iterations",
+    "tol",
     0
   };
   static char** kwlist = const_cast<char**>(const_kwlist);
 
   PyBlitzArrayObject* i1 = 0;
   PyBlitzArrayObject* i2 = 0;
+  Py_ssize_t tile[2] = {512, 512};
+  Py_ssize_t overlap = 64;
+  Py_ssize_t n_threads = 0;
+  PyObject* roi = 0;
   double alpha = 1.0;
   double ratio = 0.5;
   Py_ssize_t min_width = 40;
   Py_ssize_t n_outer_fp_iterations = 4;
   Py_ssize_t n_inner_fp_iterations = 1;
-  Py_ssize_t n_cg_iterations = 20;
+  Py_ssize_t n_iterations = 20;
+  double tol = 0.;
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&O&|ddnnnn", kwlist,
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&O&|(nn)nnOddnnnnd", kwlist,
         &PyBlitzArray_Converter, &i1,
         &PyBlitzArray_Converter, &i2,
+        &tile[0], &tile[1],
+        &overlap,
+        &n_threads,
+        &roi,
         &alpha,
         &ratio,
         &min_width,
         &n_outer_fp_iterations,
         &n_inner_fp_iterations,
-        &n_cg_iterations
+        &n_iterations,
+        &tol
         ))
     return 0;
 
-  PyBlitzArrayObject* tmp = 0;
-
-  //make sure i1 is convertible to float64
-  tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(i1, NPY_FLOAT64);
+  //make sure i1 and i2 are convertible to float64
+  PyBlitzArrayObject* tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(i1, NPY_FLOAT64);
   Py_DECREF(i1);
   i1 = tmp;
-  if (!i1) return 0;
+  if (!i1) {
+    Py_DECREF(i2);
+    return 0;
+  }
   auto i1_ = make_safe(i1);
 
-  //make sure i2 is convertible to float64
   tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(i2, NPY_FLOAT64);
   Py_DECREF(i2);
   i2 = tmp;
@@ -222,23 +1875,406 @@ PyObject* flow(PyObject*, PyObject* args, PyObject* kwds) {
     return 0;
   }
 
-  if (i1->ndim == 2) {
-    if (i1->shape[0] != i2->shape[0] || i2->shape[1] != i2->shape[1]) {
-    PyErr_Format(PyExc_RuntimeError, "shapes of the input images differ: (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d) != (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d)", i1->shape[0], i1->shape[1], i2->shape[0], i2->shape[1]);
+  for (Py_ssize_t k = 0; k < i1->ndim; ++k) {
+    if (i1->shape[k] != i2->shape[k]) {
+      PyErr_SetString(PyExc_RuntimeError, "shapes of the input images differ");
+      return 0;
+    }
+  }
+
+  if (tile[0] < 1 || tile[1] < 1) {
+    PyErr_Format(PyExc_ValueError, "`tile' should contain positive sizes, not (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d)", tile[0], tile[1]);
+    return 0;
+  }
+
+  if (overlap < 0) {
+    PyErr_Format(PyExc_ValueError, "`overlap' should not be negative, but you passed %" PY_FORMAT_SIZE_T "d", overlap);
     return 0;
+  }
+
+  //Region of interest: (top, left, height, width)
+  Py_ssize_t height = i1->shape[i1->ndim-2];
+  Py_ssize_t width = i1->shape[i1->ndim-1];
+  Py_ssize_t region[4] = {0, 0, height, width};
+  if (roi && roi != Py_None) {
+    if (!PyTuple_Check(roi) || !PyArg_ParseTuple(roi, "nnnn", &region[0],
+          &region[1], &region[2], &region[3])) {
+      PyErr_Clear();
+      PyErr_SetString(PyExc_TypeError, "`roi' should be a tuple `(top, left, height, width)' of integers");
+      return 0;
+    }
+    if (region[0] < 0 || region[1] < 0 || region[2] < 1 || region[3] < 1 ||
+        region[0] + region[2] > height || region[1] + region[3] > width) {
+      PyErr_Format(PyExc_ValueError, "`roi' should be a non-empty region of the input images, of shape (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d), not (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d)", height, width, region[0], region[1], region[2], region[3]);
+      return 0;
     }
   }
-  else { //ndim == 3
-    if (i1->shape[0] != i2->shape[0] || i2->shape[1] != i2->shape[1] ||
-        i2->shape[2] != i2->shape[2]) {
-      PyErr_Format(PyExc_RuntimeError, "shapes of the input images differ: (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d) != (%" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d, %" PY_FORMAT_SIZE_T "d)", i1->shape[0], i1->shape[1], i1->shape[2], i2->shape[0], i2->shape[1], i2->shape[2]);
+
+  return coarse2fine_flow_tiled(i1, i2, region, tile, overlap, n_threads,
+      alpha, ratio, min_width, n_outer_fp_iterations, n_inner_fp_iterations,
+      n_iterations, tol);
+
+}
+
+/**
+ * Streaming estimator for videos: keeps the last frame pushed and its
+ * pyramid, so each frame is smoothed, resized and converted to features once.
+ */
+typedef struct {
+  PyObject_HEAD
+  double alpha;
+  double ratio;
+  Py_ssize_t min_width;
+  Py_ssize_t n_outer_fp_iterations;
+  Py_ssize_t n_inner_fp_iterations;
+  Py_ssize_t n_iterations;
+  Py_ssize_t ndim; ///< dimensions of the frames pushed so far (0 if none)
+  Py_ssize_t shape[3]; ///< shape of the frames pushed so far
+  sor::DImage* previous; ///< last frame pushed
+  sor::FeaturePyramid* pyramid; ///< pyramid of the last frame pushed
+  sor::DImage* spare; ///< memory of an older frame, re-used by the next push
+  sor::FeaturePyramid* spare_pyramid; ///< memory of an older pyramid
+  sor::Workspace* workspace; ///< temporary images of the solver
+  double tol; ///< early termination tolerance of the inner solver
+  sor::OpticalFlow::SOROrdering ordering; ///< order of the SOR sweeps
+  Py_ssize_t n_threads; ///< threads used by the red-black SOR ordering
+  bool warm_start; ///< seeds each pair with the flow of the previous one
+  bool return_warped; ///< returns the warped frame as well
+  sor::DImage* u; ///< velocities in x estimated for the last pair
+  sor::DImage* v; ///< velocities in y estimated for the last pair
+} PyVideoFlowObject;
+
+static PyTypeObject PyVideoFlow_Type = {
+  PyVarObject_HEAD_INIT(0, 0)
+  0
+};
+
+PyDoc_STRVAR(s_videoflow_str, BOB_EXT_MODULE_NAME ".VideoFlow");
+PyDoc_STRVAR(s_videoflow_doc,
+"VideoFlow([alpha=1.0, [ratio=0.5, [min_width=40, [n_outer_fp_iterations=4, [n_inner_fp_iterations=1, [n_sor_iterations=20, [warm_start=False, [tol=0., [ordering='lexicographic', [n_threads=0, [return_warped=True]]]]]]]]]]])\n\
+\n\
+Streaming optical flow estimator for videos.\n\
+\n\
+Frames are fed one at a time through :py:meth:`push`, which\n\
+returns the flow between the previously pushed frame and the\n\
+new one, exactly as :py:func:`flow` would. The Gaussian pyramid\n\
+(and feature images) of the last frame pushed are kept, so\n\
+that each frame of the video is smoothed and resized only once.\n\
+The memory of older frames, of their pyramids and of the\n\
+temporary images of the solver is re-used for the next frames\n\
+(see :py:class:`Workspace`).\n\
+\n\
+Parameters are the same as for :py:func:`flow`, with the\n\
+addition of:\n\
+\n\
+warm_start\n\
+  [optional] If set, the estimation of each pair of frames\n\
+  starts from the flow estimated for the previous pair (see the\n\
+  ``init_flow`` parameter of :py:func:`flow`), instead of\n\
+  starting from zero. This allows using fewer outer and inner\n\
+  iterations on slowly varying motion. Results are then\n\
+  different from the ones of :py:func:`flow`.\n\
+\n\
+tol, ordering, n_threads, return_warped\n\
+  [optional] Same as for :py:func:`flow`\n\
+\n\
+.. note::\n\
+\n\
+   Objects of this type are not thread-safe: do not push frames\n\
+   into the same estimator from multiple threads at once.\n\
+\n\
+");
+
+static void PyVideoFlow_clear(PyVideoFlowObject* self) {
+  delete self->previous;
+  self->previous = 0;
+  delete self->pyramid;
+  self->pyramid = 0;
+  delete self->spare;
+  self->spare = 0;
+  delete self->spare_pyramid;
+  self->spare_pyramid = 0;
+  delete self->workspace;
+  self->workspace = 0;
+  self->ndim = 0;
+  delete self->u;
+  self->u = 0;
+  delete self->v;
+  self->v = 0;
+}
+
+static PyObject* PyVideoFlow_New(PyTypeObject* type, PyObject*, PyObject*) {
+
+  PyVideoFlowObject* self = (PyVideoFlowObject*)type->tp_alloc(type, 0);
+  if (!self) return 0;
+
+  self->previous = 0;
+  self->pyramid = 0;
+  self->spare = 0;
+  self->spare_pyramid = 0;
+  self->workspace = 0;
+  self->ndim = 0;
+  self->warm_start = false;
+  self->return_warped = true;
+  self->u = 0;
+  self->v = 0;
+
+  return reinterpret_cast<PyObject*>(self);
+}
+
+static void PyVideoFlow_Delete(PyVideoFlowObject* self) {
+  PyVideoFlow_clear(self);
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int PyVideoFlow_Init(PyVideoFlowObject* self, PyObject* args,
+    PyObject* kwds) {
+
+  /* Parses input arguments in a single shot */
+  static const char* const_kwlist[] = {
+    "alpha",
+    "ratio",
+    "min_width",
+    "n_outer_fp_iterations",
+    "n_inner_fp_iterations",
+    "n_sor_iterations",
+    "warm_start",
+    "tol",
+    "ordering",
+    "n_threads",
+    "return_warped",
+    0
+  };
+  static char** kwlist = const_cast<char**>(const_kwlist);
+
+  PyObject* warm_start = Py_False;
+  PyObject* return_warped = Py_True;
+  const char* ordering = "lexicographic";
+
+  self->alpha = 1.0;
+  self->ratio = 0.5;
+  self->min_width = 40;
+  self->n_outer_fp_iterations = 4;
+  self->n_inner_fp_iterations = 1;
+  self->n_iterations = 20;
+  self->tol = 0.;
+  self->n_threads = 0;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "|ddnnnnOdsnO", kwlist,
+        &self->alpha,
+        &self->ratio,
+        &self->min_width,
+        &self->n_outer_fp_iterations,
+        &self->n_inner_fp_iterations,
+        &self->n_iterations,
+        &warm_start,
+        &self->tol,
+        &ordering,
+        &self->n_threads,
+        &return_warped
+        ))
+    return -1;
+
+  int warm = PyObject_IsTrue(warm_start);
+  if (warm < 0) return -1;
+
+  if (!string2ordering(ordering, self->ordering)) return -1;
+
+  int warped = PyObject_IsTrue(return_warped);
+  if (warped < 0) return -1;
+
+  PyVideoFlow_clear(self);
+  self->warm_start = warm;
+  self->return_warped = warped;
+  return 0;
+}
+
+PyDoc_STRVAR(s_push_str, "push");
+PyDoc_STRVAR(s_push_doc,
+"push(frame) -> None | (u, v[, w2])\n\
+\n\
+Pushes the next frame of the video into the estimator.\n\
+\n\
+Parameters:\n\
+\n\
+frame\n\
+  The next input frame (grayscale or color). All frames pushed\n\
+  must have the same shape.\n\
+\n\
+Returns ``None`` for the first frame pushed (or the first after\n\
+a :py:meth:`reset`). Otherwise, returns the same as\n\
+:py:func:`flow`, for the previous frame and this one.\n\
+\n\
+");
+
+static PyObject* PyVideoFlow_push(PyVideoFlowObject* self, PyObject* args,
+    PyObject* kwds) {
+
+  /* Parses input arguments in a single shot */
+  static const char* const_kwlist[] = {"frame", 0};
+  static char** kwlist = const_cast<char**>(const_kwlist);
+
+  PyBlitzArrayObject* frame = 0;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+        &PyBlitzArray_Converter, &frame
+        ))
+    return 0;
+
+  //make sure frame is convertible to float64
+  PyBlitzArrayObject* tmp = (PyBlitzArrayObject*)PyBlitzArray_Cast(frame, NPY_FLOAT64);
+  Py_DECREF(frame);
+  frame = tmp;
+  if (!frame) return 0;
+  auto frame_ = make_safe(frame);
+
+  //some checks
+  if (frame->ndim != 2 && frame->ndim != 3) {
+    PyErr_Format(PyExc_TypeError, "method only supports 2D or 3D arrays for input `frame', but you passed an array with %" PY_FORMAT_SIZE_T "d dimensions", frame->ndim);
+    return 0;
+  }
+
+  if (self->ndim) {
+    bool same = (frame->ndim == self->ndim);
+    for (Py_ssize_t k = 0; same && k < frame->ndim; ++k)
+      same = (frame->shape[k] == self->shape[k]);
+    if (!same) {
+      PyErr_Format(PyExc_RuntimeError, "all frames pushed into a `%s' must have the same shape", Py_TYPE(self)->tp_name);
       return 0;
     }
   }
 
-  return coarse2fine_flow(i1, i2, alpha, ratio, min_width,
-      n_outer_fp_iterations, n_inner_fp_iterations, n_cg_iterations);
+  //Copies the input frame, as it is kept until the next push. The memory of
+  //the frame pushed before the previous one (and of its pyramid) is re-used
+  sor::DImage* current = self->spare ? self->spare : new sor::DImage;
+  sor::FeaturePyramid* pyramid = self->spare_pyramid ? self->spare_pyramid :
+    new sor::FeaturePyramid;
+  self->spare = 0;
+  self->spare_pyramid = 0;
+  if (!self->workspace) self->workspace = new sor::Workspace;
+  if (frame->ndim == 2) {
+    current->allocate(frame->shape[1], frame->shape[0]);
+    memcpy(current->pData, frame->data, sizeof(double)*current->nElements);
+  }
+  else {
+    //never aliases the frame (as bz2dimage() does for a single channel), as
+    //the cast frame is released once this method returns
+    current->ConvertFromMatlab(reinterpret_cast<double*>(frame->data),
+        frame->shape[2], frame->shape[1], frame->shape[0]);
+  }
+
+  //Output arrays
+  sor::DImage du;
+  sor::DImage dv;
+  sor::DImage dwarped_i2;
+
+  //Seeds the estimation with the flow of the previous pair
+  bool warmStart = (self->warm_start && self->u);
+  if (warmStart) {
+    du.copyData(*self->u);
+    dv.copyData(*self->v);
+  }
+
+  //Builds the pyramid of the new frame and estimates the flow against the
+  //previous frame, re-using its pyramid
+  sor::OpticalFlow solver;
+  solver.ordering = self->ordering;
+  solver.nThreads = self->n_threads;
+  std::string error;
+  Py_BEGIN_ALLOW_THREADS
+  try {
+    pyramid->ConstructPyramid(*current, self->ratio, self->min_width);
+    if (self->previous) {
+      solver.Coarse2FineFlow(du, dv, dwarped_i2, *self->previous, *current,
+          *self->pyramid, *pyramid, self->alpha, self->ratio,
+          self->n_outer_fp_iterations, self->n_inner_fp_iterations,
+          self->n_iterations, warmStart, self->tol, 0, self->return_warped,
+          self->workspace);
+    }
+  }
+  catch (std::exception& e) {
+    error = e.what();
+  }
+  catch (...) {
+    error = "unknown exception";
+  }
+  Py_END_ALLOW_THREADS
+
+  if (!error.empty()) {
+    //The estimator is left as it was, the new frame being a spare one
+    self->spare = current;
+    self->spare_pyramid = pyramid;
+    PyErr_Format(PyExc_RuntimeError, "flow estimation failed: %s", error.c_str());
+    return 0;
+  }
+
+  bool first = (self->previous == 0);
+
+  //The new frame becomes the previous one
+  self->spare = self->previous;
+  self->spare_pyramid = self->pyramid;
+  self->previous = current;
+  self->pyramid = pyramid;
+  self->ndim = frame->ndim;
+  for (Py_ssize_t k = 0; k < frame->ndim; ++k) self->shape[k] = frame->shape[k];
+
+  if (first) Py_RETURN_NONE;
+
+  if (self->warm_start) {
+    delete self->u;
+    delete self->v;
+    self->u = new sor::DImage(du);
+    self->v = new sor::DImage(dv);
+  }
+
+  return build_flow_output(frame->ndim, frame->shape, du, dv, dwarped_i2,
+      false, 0, self->return_warped);
+}
+
+PyDoc_STRVAR(s_reset_str, "reset");
+PyDoc_STRVAR(s_reset_doc,
+"reset() -> None\n\
+\n\
+Forgets the last frame pushed, e.g. to start a new video.\n\
+\n\
+");
+
+static PyObject* PyVideoFlow_reset(PyVideoFlowObject* self) {
+  PyVideoFlow_clear(self);
+  Py_RETURN_NONE;
+}
+
+static PyMethodDef PyVideoFlow_methods[] = {
+    {
+      s_push_str,
+      (PyCFunction)PyVideoFlow_push,
+      METH_VARARGS|METH_KEYWORDS,
+      s_push_doc
+    },
+    {
+      s_reset_str,
+      (PyCFunction)PyVideoFlow_reset,
+      METH_NOARGS,
+      s_reset_doc
+    },
+    {0}  /* Sentinel */
+};
+
+static bool init_VideoFlow(PyObject* module) {
 
+  PyVideoFlow_Type.tp_name = s_videoflow_str;
+  PyVideoFlow_Type.tp_basicsize = sizeof(PyVideoFlowObject);
+  PyVideoFlow_Type.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE;
+  PyVideoFlow_Type.tp_doc = s_videoflow_doc;
+  PyVideoFlow_Type.tp_new = PyVideoFlow_New;
+  PyVideoFlow_Type.tp_init = reinterpret_cast<initproc>(PyVideoFlow_Init);
+  PyVideoFlow_Type.tp_dealloc = reinterpret_cast<destructor>(PyVideoFlow_Delete);
+  PyVideoFlow_Type.tp_methods = PyVideoFlow_methods;
+
+  if (PyType_Ready(&PyVideoFlow_Type) < 0) return false;
+
+  Py_INCREF(&PyVideoFlow_Type);
+  return PyModule_AddObject(module, "VideoFlow", (PyObject*)&PyVideoFlow_Type) >= 0;
 }
 
 static PyMethodDef module_methods[] = {
@@ -248,6 +2284,24 @@ static PyMethodDef module_methods[] = {
       METH_VARARGS|METH_KEYWORDS,
       s_flow_doc
     },
+    {
+      s_flow_batch_str,
+      (PyCFunction)flow_batch,
+      METH_VARARGS|METH_KEYWORDS,
+      s_flow_batch_doc
+    },
+    {
+      s_flow_tiled_str,
+      (PyCFunction)flow_tiled,
+      METH_VARARGS|METH_KEYWORDS,
+      s_flow_tiled_doc
+    },
+    {
+      s_flow_bidirectional_str,
+      (PyCFunction)flow_bidirectional,
+      METH_VARARGS|METH_KEYWORDS,
+      s_flow_bidirectional_doc
+    },
     {0}  /* Sentinel */
 };
 
@@ -276,6 +2330,10 @@ static PyObject* create_module (void) {
 # endif
   if (!module) return 0;
 
+  /* register the types to python */
+  if (!init_VideoFlow(module)) return 0;
+  if (!init_Workspace(module)) return 0;
+
   /* imports dependencies */
   if (import_bob_blitz() < 0) return 0;
 
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Compact storage of optical flow estimations
+
+Flows are stored as arrays with shape ``(N, 2, height, width)``, holding the
+horizontal and vertical velocities between ``N+1`` consecutive frames, in one
+of two layouts:
+
+HDF5
+  An extendable dataset ``uv``, to which each flow is appended as a chunk of
+  its own (so reading a single flow only reads that chunk), optionally
+  compressed. Parameters of the estimation are stored as attributes of ``uv``.
+  This is the layout :py:func:`bob.io.base.load` reads.
+
+indexed
+  A ``.npy`` file (see :py:mod:`numpy.lib.format`), which
+  :py:func:`numpy.load` may map in memory, followed by the attributes of the
+  estimation, encoded as JSON, and by their length, as a little-endian 64-bit
+  integer. Flows are stored contiguously, so any flow is read in constant
+  time.
+
+Velocities are stored as 64-bit floats by default. Smaller floats may be used
+instead, or velocities may be quantized to 16-bit integers, multiples of a
+given ``step`` (in pixels), in which case the step is saved as the attribute
+``step``. Velocities of quantized flows are clipped to ``32767*step`` pixels.
+"""
+
+import json
+import struct
+import numpy
+
+# data types of stored velocities, quantized ones being the last
+DTYPES = ('float64', 'float32', 'float16', 'int16')
+
+# size of the header of indexed files, which is re-written once their number
+# of flows is known, so it must not grow
+_HEADER_SIZE = 128
+
+def _npy_header(dtype, shape):
+  """Returns a (padded) .npy header for an array of ``dtype`` and ``shape``"""
+
+  header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % \
+      (str(numpy.lib.format.dtype_to_descr(dtype)),
+          tuple(int(k) for k in shape))
+  magic = numpy.lib.format.magic(1, 0)
+  length = _HEADER_SIZE - len(magic) - 2
+  if len(header) >= length:
+    raise ValueError("flows with shape %s are too large to be indexed" % (shape,))
+  return magic + struct.pack('<H', length) + \
+      (header.ljust(length - 1) + '\n').encode('latin1')
+
+def _is_indexed(filename):
+  """Tells if ``filename`` is an indexed flow file (or an HDF5 one)"""
+
+  with open(filename, 'rb') as f:
+    return f.read(6) == numpy.lib.format.MAGIC_PREFIX
+
+class FlowWriter(object):
+  """Writes flows, one at a time, to a file
+
+  Parameters:
+
+  filename
+    The file to create (overwritten if it exists)
+
+  attributes
+    [optional] An iterable of tuples ``(name, value)`` with the parameters of
+    the estimation, saved once the file is closed
+
+  dtype
+    [optional] The data type of stored velocities, one of ``'float64'`` (the
+    default), ``'float32'``, ``'float16'`` (only with ``indexed=True``) or
+    ``'int16'`` (quantized velocities, requires ``step``)
+
+  step
+    [optional] The quantization step of velocities, in pixels, if ``dtype`` is
+    ``'int16'``
+
+  compression
+    [optional] The compression level of each flow, from 0 (no compression, the
+    default) to 9, for HDF5 files
+
+  indexed
+    [optional] If ``True``, writes an indexed file instead of an HDF5 one
+  """
+
+  def __init__(self, filename, attributes=(), dtype='float64', step=None,
+      compression=0, indexed=False):
+
+    if dtype not in DTYPES:
+      raise ValueError("`%s' is not a supported data type (choose from %s)" % (dtype, ', '.join(DTYPES)))
+    if (dtype == 'int16') != (step is not None):
+      raise ValueError("a quantization step must be given if, and only if, velocities are stored as int16")
+    if step is not None and step <= 0:
+      raise ValueError("the quantization step must be positive")
+    if not 0 <= compression <= 9:
+      raise ValueError("the compression level should be between 0 and 9")
+    if indexed and compression:
+      raise ValueError("indexed files are not compressed")
+    if dtype == 'float16' and not indexed:
+      raise ValueError("HDF5 files do not support 16-bit floats, use an indexed file or quantized velocities instead")
+
+    self.filename = filename
+    self.attributes = list(attributes)
+    if step is not None: self.attributes.append(('step', step))
+    self.dtype = numpy.dtype(dtype)
+    self.step = step
+    self.compression = compression
+    self.indexed = indexed
+    self.shape = None
+    self.count = 0
+
+    if indexed:
+      self.file = open(filename, 'w+b')
+    else:
+      import bob.io.base
+      self.file = bob.io.base.HDF5File(filename, 'w')
+
+  def encode(self, u, v):
+    """Returns the stored representation of a flow"""
+
+    uv = numpy.array((u, v))
+    if self.step is None: return uv.astype(self.dtype)
+    limit = numpy.iinfo(self.dtype).max
+    return numpy.clip(numpy.round(uv / self.step), -limit, limit).astype(self.dtype)
+
+  def append(self, u, v):
+    """Appends the flow of the next pair of frames"""
+
+    uv = self.encode(u, v)
+
+    if self.shape is None:
+      self.shape = uv.shape
+      if self.indexed: self.file.write(_npy_header(self.dtype, (0,) + uv.shape))
+    elif uv.shape != self.shape:
+      raise ValueError("flow shape %s differs from the one of previous flows, %s" % (uv.shape, self.shape))
+
+    if self.indexed:
+      self.file.write(uv.tobytes() if hasattr(uv, 'tobytes') else uv.tostring())
+    else:
+      self.file.append('uv', uv, compression=self.compression)
+    self.count += 1
+
+  def close(self):
+    """Saves the attributes and closes the file
+
+    HDF5 files cannot hold an empty ``uv`` dataset, so closing one to which no
+    flows were appended (e.g. for a single frame) raises a :py:exc:`ValueError`,
+    the file being left without flows nor attributes.
+    """
+
+    if self.indexed:
+      if self.shape is None:
+        self.shape = (2, 0, 0)
+        self.file.write(_npy_header(self.dtype, (0,) + self.shape))
+      trailer = json.dumps(dict(self.attributes), sort_keys=True).encode('utf-8')
+      self.file.write(trailer + struct.pack('<Q', len(trailer)))
+      self.file.seek(0)
+      self.file.write(_npy_header(self.dtype, (self.count,) + self.shape))
+      self.file.close()
+    else:
+      if not self.count:
+        del self.file
+        raise ValueError("no flows were appended, and HDF5 files cannot hold an empty `uv' dataset (use an indexed file instead)")
+      for key, value in self.attributes:
+        self.file.set_attribute(key, value, 'uv')
+      del self.file
+
+class FlowReader(object):
+  """Reads flows written by :py:class:`FlowWriter` (or by ``bob_of_liu.py``)
+
+  Flows are read lazily: ``reader[k]`` returns the flow between frames ``k``
+  and ``k+1`` as a 64-bit float array with shape ``(2, height, width)``,
+  reading only that flow from the file, and :py:meth:`read` returns all flows.
+  Quantized velocities are scaled back to pixels. The file stays open until
+  :py:meth:`close` is called, or until the end of a ``with`` block using the
+  reader.
+
+  Parameters:
+
+  filename
+    An HDF5 or indexed flow file
+  """
+
+  def __init__(self, filename):
+
+    self.filename = filename
+    self.indexed = _is_indexed(filename)
+
+    if self.indexed:
+      with open(filename, 'rb') as f:
+        if numpy.lib.format.read_magic(f) != (1, 0):
+          raise ValueError("`%s' is not an indexed flow file" % filename)
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+        offset = f.tell()
+        f.seek(offset + int(numpy.prod(shape)) * dtype.itemsize)
+        trailer = f.read()
+      length = struct.unpack('<Q', trailer[-8:])[0]
+      self.attributes = json.loads(trailer[-8-length:-8].decode('utf-8'))
+      self.dtype = dtype
+      self.length = shape[0]
+      if self.length:
+        self.data = numpy.memmap(filename, dtype, 'r', offset, shape)
+      else:
+        self.data = numpy.zeros(shape, dtype)
+    else:
+      import bob.io.base
+      self.file = bob.io.base.HDF5File(filename, 'r')
+      self.attributes = self.file.get_attributes('uv')
+      self.length = self.file.describe('uv')[0][1]
+
+    self.step = self.attributes.get('step')
+
+  def decode(self, uv):
+    """Returns the velocities (in pixels, as 64-bit floats) of a stored flow"""
+
+    uv = numpy.asarray(uv, dtype='float64')
+    if self.step is not None: uv *= self.step
+    return uv
+
+  def close(self):
+    """Closes the file (flows already returned stay valid)"""
+
+    if self.indexed: self.data = None
+    else: self.file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, k):
+    if k < 0: k += self.length
+    if not 0 <= k < self.length:
+      raise IndexError("flow %d is out of range (the file has %d flows)" % (k, self.length))
+    if self.indexed: return self.decode(self.data[k])
+    return self.decode(self.file.read('uv', pos=k))
+
+  def read(self):
+    """Returns all flows, as an array with shape ``(N, 2, height, width)``"""
+
+    if self.indexed: return self.decode(self.data)
+    return self.decode(self.file.read('uv'))
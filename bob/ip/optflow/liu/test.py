@@ -163,6 +163,995 @@ def test_simple_gray_cg_script():
 def test_rubberwhale_color_cg_script():
   external_run('color/rubberwhale', 'cg')
 
+def load_pair(sample):
+  """Loads the two (double) frames of a bundled sample"""
+
+  i1 = bob.io.base.load(F(__name__, '%s1.png' % sample)).astype('float64')/255.
+  i2 = bob.io.base.load(F(__name__, '%s2.png' % sample)).astype('float64')/255.
+  return i1, i2
+
+def run_threaded(method, samples, n_threads=4, **kwargs):
+  """Runs the estimation concurrently on all samples, from ``n_threads``
+  threads, and checks results are bit-identical to a serial run"""
+
+  import threading
+
+  pairs = [load_pair(k) for k in samples]
+  expected = [method(i1, i2, **kwargs) for (i1, i2) in pairs]
+
+  results = [[None]*len(pairs) for k in range(n_threads)]
+
+  def worker(t):
+    for j, (i1, i2) in enumerate(pairs):
+      results[t][j] = method(i1, i2, **kwargs)
+
+  threads = [threading.Thread(target=worker, args=(t,)) for t in range(n_threads)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+  for t in range(n_threads):
+    for j in range(len(pairs)):
+      assert results[t][j] is not None
+      for computed, reference in zip(results[t][j], expected[j]):
+        assert numpy.array_equal(computed, reference)
+
+def test_sor_threads():
+  run_threaded(sor.flow, ['gray/car', 'gray/table', 'color/car',
+    'color/table'])
+
+def test_cg_threads():
+  run_threaded(cg.flow, ['gray/car', 'color/car'], n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+def run_batch(method, batch_method, sample, **kwargs):
+  """Checks batched estimation matches pair-wise estimation"""
+
+  i1, i2 = load_pair(sample)
+  frames = numpy.array([i1, i2, i1])
+  uv = batch_method(frames, n_threads=2, **kwargs)
+
+  nose.tools.eq_(uv.shape, (2, 2) + i1.shape[-2:])
+  for k in range(len(frames)-1):
+    (u, v, wi2) = method(frames[k], frames[k+1], **kwargs)
+    assert numpy.array_equal(uv[k,0], u)
+    assert numpy.array_equal(uv[k,1], v)
+
+def test_sor_flow_batch_gray():
+  run_batch(sor.flow, sor.flow_batch, 'gray/car')
+
+def test_sor_flow_batch_color():
+  run_batch(sor.flow, sor.flow_batch, 'color/car')
+
+def test_cg_flow_batch_gray():
+  run_batch(cg.flow, cg.flow_batch, 'gray/car', n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+@nose.tools.raises(RuntimeError)
+def test_flow_batch_too_short():
+  i1, i2 = load_pair('gray/car')
+  sor.flow_batch(i1[numpy.newaxis])
+
+def test_flow_batch_interleaved_channels():
+  i1, i2 = load_pair('color/car')
+  frames = numpy.array([i1, i2, i1]).transpose(0, 2, 3, 1)
+  for method in (sor.flow_batch, cg.flow_batch):
+    nose.tools.assert_raises(ValueError, method, frames)
+
+def run_video(method, estimator_type, sample, **kwargs):
+  """Checks streaming estimation matches pair-wise estimation"""
+
+  i1, i2 = load_pair(sample)
+  frames = [i1, i2, i1]
+  estimator = estimator_type(**kwargs)
+
+  assert estimator.push(frames[0]) is None
+  for k in range(len(frames)-1):
+    computed = estimator.push(frames[k+1])
+    expected = method(frames[k], frames[k+1], **kwargs)
+    for c, e in zip(computed, expected):
+      assert numpy.array_equal(c, e)
+
+  # after a reset, the estimator starts over
+  estimator.reset()
+  assert estimator.push(frames[0]) is None
+
+def test_sor_video_flow_gray():
+  run_video(sor.flow, sor.VideoFlow, 'gray/car')
+
+def test_sor_video_flow_color():
+  run_video(sor.flow, sor.VideoFlow, 'color/car')
+
+def test_cg_video_flow_gray():
+  run_video(cg.flow, cg.VideoFlow, 'gray/car', n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+def test_video_flow_single_channel():
+  # frames with shape (1, height, width) are copied, as their temporary
+  # float64 casts are released once pushed
+  i1, i2 = load_pair('gray/car')
+  frames = [f[numpy.newaxis].astype('float32') for f in (i1, i2, i1, i2)]
+  for method, estimator_type, kwargs in [
+      (sor.flow, sor.VideoFlow, {}),
+      (cg.flow, cg.VideoFlow, dict(n_outer_fp_iterations=3, n_cg_iterations=10)),
+      ]:
+    estimator = estimator_type(**kwargs)
+    assert estimator.push(frames[0]) is None
+    for k in range(len(frames)-1):
+      computed = estimator.push(frames[k+1])
+      expected = method(frames[k], frames[k+1], **kwargs)
+      for c, e in zip(computed, expected):
+        assert numpy.array_equal(c, e)
+
+@nose.tools.raises(RuntimeError)
+def test_video_flow_shape_mismatch():
+  i1, i2 = load_pair('gray/car')
+  estimator = sor.VideoFlow()
+  estimator.push(i1)
+  estimator.push(i1[:-1])
+
+def run_warm_start(method, sample, **kwargs):
+  """Checks starting from a good initial flow converges faster"""
+
+  i1, i2 = load_pair(sample)
+  (u, v, wi2) = method(i1, i2)
+
+  # with few iterations, the warm start stays closer to the reference
+  cold = method(i1, i2, n_outer_fp_iterations=1, **kwargs)
+  warm = method(i1, i2, n_outer_fp_iterations=1, init_flow=(u, v), **kwargs)
+  cold_error = numpy.abs(cold[0] - u).mean() + numpy.abs(cold[1] - v).mean()
+  warm_error = numpy.abs(warm[0] - u).mean() + numpy.abs(warm[1] - v).mean()
+  assert warm_error < cold_error
+
+def test_sor_warm_start():
+  run_warm_start(sor.flow, 'gray/car', n_sor_iterations=5)
+
+def test_cg_warm_start():
+  run_warm_start(cg.flow, 'gray/car', n_cg_iterations=5)
+
+@nose.tools.raises(RuntimeError)
+def test_warm_start_shape_mismatch():
+  i1, i2 = load_pair('gray/car')
+  u0 = numpy.zeros((i1.shape[0]-1, i1.shape[1]))
+  sor.flow(i1, i2, init_flow=(u0, u0))
+
+@nose.tools.raises(TypeError)
+def test_warm_start_not_a_tuple():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, init_flow=numpy.zeros(i1.shape))
+
+def test_video_flow_warm_start():
+  i1, i2 = load_pair('gray/car')
+  estimator = sor.VideoFlow(warm_start=True)
+  assert estimator.push(i1) is None
+
+  # the first pair is not seeded
+  computed = estimator.push(i2)
+  expected = sor.flow(i1, i2)
+  for c, e in zip(computed, expected):
+    assert numpy.array_equal(c, e)
+
+  # the second pair is seeded with the flow of the first one
+  (u, v, wi2) = estimator.push(i1)
+  expected = sor.flow(i2, i1, init_flow=computed[0:2])
+  assert numpy.array_equal(u, expected[0])
+  assert numpy.array_equal(v, expected[1])
+
+def test_sor_iterations():
+  i1, i2 = load_pair('gray/car')
+  (u, v, wi2, iterations) = sor.flow(i1, i2, return_iterations=True)
+  expected = sor.flow(i1, i2)
+  assert numpy.array_equal(u, expected[0])
+  assert numpy.array_equal(v, expected[1])
+
+  # level k runs (4+k) outer iterations of (20+3k) SOR iterations each
+  nose.tools.eq_(iterations, [(4+k)*(20+3*k) for k in range(len(iterations))])
+
+def run_tolerance(method, sample, tol, **kwargs):
+  """Checks early termination runs fewer iterations"""
+
+  i1, i2 = load_pair(sample)
+  full = method(i1, i2, return_iterations=True, **kwargs)
+  early = method(i1, i2, tol=tol, return_iterations=True, **kwargs)
+  nose.tools.eq_(len(full[3]), len(early[3]))
+  assert all([e <= f for (e, f) in zip(early[3], full[3])])
+  assert sum(early[3]) < sum(full[3])
+
+def test_sor_tolerance():
+  run_tolerance(sor.flow, 'gray/car', 0.1)
+
+def test_cg_tolerance():
+  run_tolerance(cg.flow, 'gray/car', 0.3, n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+def test_sor_redblack():
+  i1, i2 = load_pair('gray/car')
+  (u, v, wi2) = sor.flow(i1, i2)
+  single = sor.flow(i1, i2, ordering='redblack', n_threads=1)
+  multi = sor.flow(i1, i2, ordering='redblack', n_threads=4)
+
+  # results do not depend on the number of threads
+  for s, m in zip(single, multi):
+    assert numpy.array_equal(s, m)
+
+  # and are close to the ones of the lexicographic ordering
+  assert numpy.allclose(u, single[0], atol=0.1)
+  assert numpy.allclose(v, single[1], atol=0.1)
+
+@nose.tools.raises(ValueError)
+def test_sor_unknown_ordering():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, ordering='zigzag')
+
+def warp_bicubic(i1, i2, u, v):
+  """Warps ``i2`` by ``(u, v)`` as the original, pixel-wise, bicubic
+  interpolation of the C++ code: pixels moving out of the image keep their
+  value in ``i1`` and results are clipped to ``[0, 1]``"""
+
+  def derivative(plane, axis):
+    pad = [(1, 1) if k == axis else (0, 0) for k in range(2)]
+    padded = numpy.pad(plane, pad, 'edge')
+    if axis == 0: return 0.5 * (padded[2:] - padded[:-2])
+    return 0.5 * (padded[:, 2:] - padded[:, :-2])
+
+  def hermite(t):
+    return (2*t**3 - 3*t**2 + 1, -2*t**3 + 3*t**2, t**3 - 2*t**2 + t,
+        t**3 - t**2)
+
+  height, width = u.shape
+  y, x = numpy.mgrid[0:height, 0:width].astype('float64')
+  xs, ys = x + u, y + v
+  inside = (xs >= 0) & (xs <= width-1) & (ys >= 0) & (ys <= height-1)
+  xs = numpy.where(inside, xs, x)
+  ys = numpy.where(inside, ys, y)
+  x0, y0 = xs.astype(int), ys.astype(int)
+  x1, y1 = numpy.minimum(x0+1, width-1), numpy.minimum(y0+1, height-1)
+  wx, wy = hermite(xs - x0), hermite(ys - y0)
+
+  def along_rows(f, fx, row):
+    return wx[0]*f[row, x0] + wx[1]*f[row, x1] + wx[2]*fx[row, x0] + \
+        wx[3]*fx[row, x1]
+
+  planes = []
+  for p1, p2 in zip(i1.reshape((-1,) + u.shape), i2.reshape((-1,) + u.shape)):
+    dx = derivative(p2, 1)
+    dy = derivative(p2, 0)
+    dxdy = derivative(dx, 0)
+    warped = wy[0]*along_rows(p2, dx, y0) + wy[1]*along_rows(p2, dx, y1) + \
+        wy[2]*along_rows(dy, dxdy, y0) + wy[3]*along_rows(dy, dxdy, y1)
+    planes.append(numpy.clip(numpy.where(inside, warped, p1), 0, 1))
+  return numpy.array(planes).reshape(i1.shape)
+
+def run_bicubic(sample):
+  """Checks the (row-wise) bicubic warps against the pixel-wise reference"""
+
+  i1, i2 = load_pair(sample)
+
+  # the final warping of i2 is bicubic, whatever the interpolation
+  (u, v, wi2) = sor.flow(i1, i2)
+  assert numpy.allclose(wi2, warp_bicubic(i1, i2, u, v))
+
+  (bu, bv, bwi2) = sor.flow(i1, i2, interpolation='bicubic')
+  assert numpy.allclose(bwi2, warp_bicubic(i1, i2, bu, bv))
+  assert numpy.allclose(u, bu, atol=0.1)
+  assert numpy.allclose(v, bv, atol=0.1)
+  assert not numpy.array_equal(u, bu)
+
+  # derivatives of i2 kept in a workspace give the same results
+  channels = 1 if i1.ndim == 2 else i1.shape[0]
+  workspace = sor.Workspace(i1.shape[-2], i1.shape[-1], channels)
+  for k in range(2):
+    computed = sor.flow(i1, i2, interpolation='bicubic', workspace=workspace)
+    for c, e in zip(computed, (bu, bv, bwi2)):
+      assert numpy.array_equal(c, e)
+
+def test_sor_bicubic_gray():
+  run_bicubic('gray/car')
+
+def test_sor_bicubic_color():
+  run_bicubic('color/car')
+
+@nose.tools.raises(ValueError)
+def test_sor_unknown_interpolation():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, interpolation='nearest')
+
+def run_float32(method, sample, **kwargs):
+  """Checks the single precision solver is close to the double precision one"""
+
+  i1, i2 = load_pair(sample)
+  expected = method(i1, i2, **kwargs)
+  computed = method(i1, i2, dtype='float32', **kwargs)
+  for c, e in zip(computed, expected):
+    nose.tools.eq_(c.dtype, numpy.float32)
+    nose.tools.eq_(c.shape, e.shape)
+    assert numpy.allclose(c, e, atol=1e-1)
+
+def test_sor_float32():
+  run_float32(sor.flow, 'gray/table')
+
+def test_cg_float32():
+  run_float32(cg.flow, 'color/car', n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+@nose.tools.raises(ValueError)
+def test_unsupported_dtype():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, dtype='int32')
+
+def test_cg_interleaved():
+  i1, i2 = load_pair('color/car')
+  expected = cg.flow(i1, i2, n_outer_fp_iterations=3, n_cg_iterations=10)
+
+  # (height, width, channels) copies of the input images
+  h1 = numpy.ascontiguousarray(i1.transpose(1, 2, 0))
+  h2 = numpy.ascontiguousarray(i2.transpose(1, 2, 0))
+  (u, v, wi2) = cg.flow(h1, h2, n_outer_fp_iterations=3, n_cg_iterations=10,
+      interleaved=True)
+  assert numpy.array_equal(u, expected[0])
+  assert numpy.array_equal(v, expected[1])
+  assert numpy.array_equal(wi2, expected[2].transpose(1, 2, 0))
+
+def run_out(method, sample):
+  """Checks velocities are written into the arrays passed as ``out``"""
+
+  i1, i2 = load_pair(sample)
+  expected = method(i1, i2)
+  uv = numpy.zeros((2,) + expected[0].shape, 'float64')
+  out = (uv[0], uv[1])
+  (u, v, wi2) = method(i1, i2, out=out)
+  assert u is out[0]
+  assert v is out[1]
+  assert numpy.array_equal(uv[0], expected[0])
+  assert numpy.array_equal(uv[1], expected[1])
+
+def test_sor_out():
+  run_out(sor.flow, 'gray/car')
+
+def test_cg_out():
+  run_out(cg.flow, 'gray/table')
+
+@nose.tools.raises(RuntimeError)
+def test_out_shape_mismatch():
+  i1, i2 = load_pair('gray/car')
+  u = numpy.zeros((i1.shape[0], i1.shape[1]+1), 'float64')
+  sor.flow(i1, i2, out=(u, u.copy()))
+
+@nose.tools.raises(TypeError)
+def test_out_dtype_mismatch():
+  i1, i2 = load_pair('gray/car')
+  u = numpy.zeros(i1.shape, 'float32')
+  sor.flow(i1, i2, out=(u, u.copy()))
+
+def run_no_warped(method, estimator_type, sample, **kwargs):
+  """Checks velocities do not change if the warped image is not returned"""
+
+  i1, i2 = load_pair(sample)
+  expected = method(i1, i2, **kwargs)
+  computed = method(i1, i2, return_warped=False, **kwargs)
+  nose.tools.eq_(len(computed), 2)
+  assert numpy.array_equal(computed[0], expected[0])
+  assert numpy.array_equal(computed[1], expected[1])
+
+  computed = method(i1, i2, return_warped=False, return_iterations=True,
+      **kwargs)
+  nose.tools.eq_(len(computed), 3)
+  assert isinstance(computed[2], list)
+
+  estimator = estimator_type(return_warped=False, **kwargs)
+  assert estimator.push(i1) is None
+  computed = estimator.push(i2)
+  nose.tools.eq_(len(computed), 2)
+  assert numpy.array_equal(computed[0], expected[0])
+  assert numpy.array_equal(computed[1], expected[1])
+
+def test_sor_no_warped():
+  run_no_warped(sor.flow, sor.VideoFlow, 'gray/car')
+
+def test_cg_no_warped():
+  run_no_warped(cg.flow, cg.VideoFlow, 'color/car', n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+def run_workspace(method, workspace_type, sample, **kwargs):
+  """Checks results do not change when buffers are re-used"""
+
+  i1, i2 = load_pair(sample)
+  expected = method(i1, i2, **kwargs)
+  channels = 1 if i1.ndim == 2 else i1.shape[0]
+  workspace = workspace_type(i1.shape[-2], i1.shape[-1], channels)
+  nose.tools.eq_(workspace.height, i1.shape[-2])
+  nose.tools.eq_(workspace.width, i1.shape[-1])
+  nose.tools.eq_(workspace.channels, channels)
+
+  # the second call re-uses the buffers filled by the first one, on other data
+  method(i2, i1, workspace=workspace, **kwargs)
+  for dtype in ('float64', 'float32'):
+    computed = method(i1, i2, workspace=workspace, dtype=dtype, **kwargs)
+    reference = method(i1, i2, dtype=dtype, **kwargs)
+    for k in range(3): assert numpy.array_equal(computed[k], reference[k])
+  computed = method(i1, i2, workspace=workspace, **kwargs)
+  for k in range(3): assert numpy.array_equal(computed[k], expected[k])
+
+def test_sor_workspace():
+  run_workspace(sor.flow, sor.Workspace, 'gray/car')
+
+def test_cg_workspace():
+  run_workspace(cg.flow, cg.Workspace, 'color/car', n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+@nose.tools.raises(RuntimeError)
+def test_workspace_shape_mismatch():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, workspace=sor.Workspace(i1.shape[0], i1.shape[1], 3))
+
+@nose.tools.raises(TypeError)
+def test_workspace_type_mismatch():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, workspace=cg.Workspace(i1.shape[0], i1.shape[1]))
+
+def run_fast_pyramid(method, sample, tolerance, **kwargs):
+  """Checks flows estimated on fast pyramids are close to the exact ones"""
+
+  i1, i2 = load_pair(sample)
+  exact = method(i1, i2, **kwargs)
+  fast = method(i1, i2, pyramid='fast', **kwargs)
+  for k in range(2):
+    nose.tools.eq_(fast[k].shape, exact[k].shape)
+    assert abs(fast[k] - exact[k]).mean() < tolerance
+
+def test_sor_fast_pyramid():
+  run_fast_pyramid(sor.flow, 'gray/car', 1e-3)
+
+def test_cg_fast_pyramid():
+  run_fast_pyramid(cg.flow, 'color/car', 0.25, n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+@nose.tools.raises(ValueError)
+def test_unknown_pyramid():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, pyramid='slow')
+
+def run_stop_level(method, sample, stop_level, output_scale, **kwargs):
+  """Checks estimations stopped at a coarser level match the ones of the
+  same level on a full estimation"""
+
+  i1, i2 = load_pair(sample)
+  full = method(i1, i2, return_pyramid=True, **kwargs)
+  pyramid = full[3]
+  assert len(pyramid) > stop_level
+  for k in range(2):
+    assert numpy.array_equal(pyramid[0][k], full[k])
+
+  coarse = method(i1, i2, stop_level=stop_level, return_pyramid=True,
+      **kwargs)
+  nose.tools.eq_(len(coarse[3]), len(pyramid) - stop_level)
+  nose.tools.eq_(coarse[2].shape, pyramid[stop_level][0].shape)
+  for k in range(2):
+    assert numpy.array_equal(coarse[k], pyramid[stop_level][k])
+
+  scaled = method(i1, i2, output_scale=output_scale, return_warped=False,
+      **kwargs)
+  for k in range(2):
+    assert numpy.array_equal(scaled[k], coarse[k])
+
+def test_sor_stop_level():
+  run_stop_level(sor.flow, 'gray/car', 2, 0.25)
+
+def test_cg_stop_level():
+  run_stop_level(cg.flow, 'gray/car', 2, 0.5, n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+@nose.tools.raises(ValueError)
+def test_negative_stop_level():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, stop_level=-1)
+
+@nose.tools.raises(ValueError)
+def test_stop_level_and_output_scale():
+  i1, i2 = load_pair('gray/car')
+  cg.flow(i1, i2, stop_level=1, output_scale=0.5)
+
+@nose.tools.raises(ValueError)
+def test_output_scale_out_of_range():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, output_scale=2.)
+
+def run_tiled(method, tiled_method, sample, tolerance, **kwargs):
+  """Checks tiled estimations are close to the ones of the whole images"""
+
+  i1, i2 = load_pair(sample)
+  full = method(i1, i2, **kwargs)
+
+  # a single tile is estimated as the whole images
+  single = tiled_method(i1, i2, tile=i1.shape[-2:], **kwargs)
+  for k in range(2):
+    assert numpy.array_equal(single[k], full[k])
+
+  tiled = tiled_method(i1, i2, tile=(256, 256), overlap=32, n_threads=2,
+      **kwargs)
+  for k in range(2):
+    nose.tools.eq_(tiled[k].shape, full[k].shape)
+    assert abs(tiled[k] - full[k]).mean() < tolerance
+
+  roi = tiled_method(i1, i2, tile=(256, 256), roi=(100, 50, 200, 300),
+      **kwargs)
+  for k in range(2):
+    nose.tools.eq_(roi[k].shape, (200, 300))
+    assert numpy.isfinite(roi[k]).all()
+
+def test_sor_flow_tiled():
+  run_tiled(sor.flow, sor.flow_tiled, 'gray/car', 0.1)
+
+def test_cg_flow_tiled():
+  run_tiled(cg.flow, cg.flow_tiled, 'gray/car', 0.25, n_outer_fp_iterations=3,
+      n_cg_iterations=10)
+
+@nose.tools.raises(ValueError)
+def test_flow_tiled_roi_out_of_bounds():
+  i1, i2 = load_pair('gray/car')
+  sor.flow_tiled(i1, i2, roi=(0, 0, i1.shape[0]+1, 10))
+
+@nose.tools.raises(ValueError)
+def test_flow_tiled_negative_overlap():
+  i1, i2 = load_pair('gray/car')
+  cg.flow_tiled(i1, i2, overlap=-1)
+
+def run_profile(method, sample, outer, extra_outer, **kwargs):
+  """Checks profiled estimations give the same results, and the time taken
+  by every stage of every pyramid level"""
+
+  i1, i2 = load_pair(sample)
+  expected = method(i1, i2, n_outer_fp_iterations=outer, **kwargs)
+  computed = method(i1, i2, n_outer_fp_iterations=outer,
+      return_iterations=True, profile=True, **kwargs)
+  for k in range(3): assert numpy.array_equal(computed[k], expected[k])
+
+  iterations, profile = computed[3:]
+  stages = profile['stages']
+  nose.tools.eq_(len(profile['levels']), len(iterations))
+  for name in ('pyramid', 'final_warp'):
+    assert name in stages
+    assert not any(name in level for level in profile['levels'])
+  for k, level in enumerate(profile['levels']):
+    #the number of outer iterations may depend on the level
+    n = outer + k*extra_outer
+    for name in ('getDxs', 'weights', 'solver', 'warp'):
+      nose.tools.eq_(level[name]['calls'], n)
+    nose.tools.eq_(level['im2feature']['calls'], 2)
+    nose.tools.eq_(level['init']['calls'], 1)
+  for name, stage in stages.items():
+    assert stage['time'] >= 0
+    calls = [k[name]['calls'] for k in profile['levels'] if name in k]
+    if calls: nose.tools.eq_(stage['calls'], sum(calls))
+  assert sum(k['time'] for k in stages.values()) <= profile['total']
+
+def test_sor_profile():
+  run_profile(sor.flow, 'gray/car', 4, 1)
+
+def test_cg_profile():
+  run_profile(cg.flow, 'gray/car', 3, 0, n_cg_iterations=10)
+
+def warp_residual(i1, i2, u, v):
+  """Returns the mean absolute difference between ``i1`` and ``i2``, warped
+  (bilinearly) by the flow ``(u, v)``"""
+
+  h, w = i1.shape
+  y, x = numpy.mgrid[0:h, 0:w]
+  x = numpy.clip(x + u, 0, w - 1)
+  y = numpy.clip(y + v, 0, h - 1)
+  x0 = numpy.minimum(numpy.floor(x).astype(int), w - 2)
+  y0 = numpy.minimum(numpy.floor(y).astype(int), h - 2)
+  dx = x - x0
+  dy = y - y0
+  top = i2[y0,x0]*(1-dx) + i2[y0,x0+1]*dx
+  bottom = i2[y0+1,x0]*(1-dx) + i2[y0+1,x0+1]*dx
+  return abs(i1 - (top*(1-dy) + bottom*dy)).mean()
+
+def test_mg_flow():
+  from . import mg
+
+  # the multigrid solver minimizes the energy of the SOR reference (which
+  # runs too few SOR sweeps to solve its linear systems), so its flow
+  # explains the frames better
+  f = bob.io.base.HDF5File(F(__name__, 'gray/sor/table.hdf5'))
+  uv = f.read('uv')
+  i1, i2 = load_pair('gray/table')
+  u, v, w2 = mg.flow(i1, i2)
+  assert warp_residual(i1, i2, u, v) < 0.9 * warp_residual(i1, i2, *uv)
+
+  # a few V-cycles are (almost) as good as many
+  u10, v10, w10 = mg.flow(i1, i2, n_vcycles=10)
+  assert numpy.hypot(u - u10, v - v10).mean() < 0.05
+
+def test_mg_tolerance():
+  from . import mg
+
+  i1, i2 = load_pair('gray/car')
+  u, v, w2, full = mg.flow(i1, i2, return_iterations=True)
+  u, v, w2, early = mg.flow(i1, i2, tol=0.5, return_iterations=True)
+  nose.tools.eq_(len(full), len(early))
+  for k, l in zip(early, full): assert 0 < k <= l
+  assert sum(early) < sum(full)
+
+@nose.tools.raises(TypeError)
+def test_mg_n_sor_iterations():
+  from . import mg
+  i1, i2 = load_pair('gray/car')
+  mg.flow(i1, i2, n_sor_iterations=20)
+
+@nose.tools.raises(ValueError)
+def test_unknown_solver():
+  i1, i2 = load_pair('gray/car')
+  sor.flow(i1, i2, solver='jacobi')
+
+def test_sor_flow_bidirectional():
+  for sample in ('gray/car', 'color/car'):
+    i1, i2 = load_pair(sample)
+    forward = sor.flow(i1, i2, n_outer_fp_iterations=2)
+    backward = sor.flow(i2, i1, n_outer_fp_iterations=2)
+    for n_threads in (1, 2):
+      computed = sor.flow_bidirectional(i1, i2, n_outer_fp_iterations=2,
+          n_threads=n_threads)
+      nose.tools.eq_(len(computed), 6)
+      for k, expected in enumerate(forward + backward):
+        assert numpy.array_equal(computed[k], expected)
+
+def test_sor_flow_bidirectional_occlusion():
+  i1, i2 = load_pair('gray/car')
+  u, v, bu, bv, occlusion = sor.flow_bidirectional(i1, i2,
+      n_outer_fp_iterations=2, return_warped=False, return_occlusion=True)
+  nose.tools.eq_(occlusion.dtype, numpy.bool_)
+  nose.tools.eq_(occlusion.shape, i1.shape)
+
+  # pixels moving out of the image are always occluded, and the only ones
+  # with a large enough threshold
+  y, x = numpy.mgrid[0:i1.shape[0], 0:i1.shape[1]]
+  outside = (x + u < 0) | (x + u > i1.shape[1] - 1) | \
+      (y + v < 0) | (y + v > i1.shape[0] - 1)
+  assert occlusion[outside].all()
+  loose = sor.flow_bidirectional(i1, i2, n_outer_fp_iterations=2,
+      return_warped=False, return_occlusion=True, threshold=1e6)[-1]
+  assert numpy.array_equal(loose, outside)
+  strict = sor.flow_bidirectional(i1, i2, n_outer_fp_iterations=2,
+      return_warped=False, return_occlusion=True, threshold=0.)[-1]
+  assert strict.sum() >= occlusion.sum()
+
+@nose.tools.raises(ValueError)
+def test_sor_flow_bidirectional_negative_threshold():
+  i1, i2 = load_pair('gray/car')
+  sor.flow_bidirectional(i1, i2, return_occlusion=True, threshold=-1.)
+
+def test_flow_cache():
+  from . import FlowCache
+  import tempfile
+  import shutil
+
+  i1, i2 = load_pair('gray/car')
+  tmpdir = tempfile.mkdtemp()
+
+  try:
+    cache = FlowCache(tmpdir)
+    expected = sor.flow(i1, i2)
+    computed = cache.flow(sor.flow, i1, i2)
+    nose.tools.eq_(len(cache.entries()), 1)
+    for k in range(3): assert numpy.array_equal(computed[k], expected[k])
+
+    #hits are loaded as memory-mapped arrays, other parameters are misses
+    cached = cache.flow(sor.flow, i1, i2, n_threads=2)
+    nose.tools.eq_(len(cache.entries()), 1)
+    for k in range(3):
+      assert isinstance(cached[k], numpy.memmap)
+      assert numpy.array_equal(cached[k], expected[k])
+    cache.flow(sor.flow, i2, i1)
+    cache.flow(cg.flow, i1, i2, n_outer_fp_iterations=3, n_cg_iterations=10)
+    nose.tools.eq_(len(cache.entries()), 3)
+
+    #the least recently used estimations are evicted first
+    cache.flow(sor.flow, i1, i2)
+    path = cache.path(cache.key(sor.flow, i1, i2, {}))
+    size = dict((k[0], k[1]) for k in cache.entries())[path]
+    cache.evict(size)
+    nose.tools.eq_([k[0] for k in cache.entries()], [path])
+    cache.evict()
+    nose.tools.eq_(cache.entries(), [])
+    nose.tools.eq_(cache.size, 0)
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_flow_cache_incomplete():
+  from . import FlowCache
+  import tempfile
+  import shutil
+
+  i1, i2 = load_pair('gray/car')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    cache = FlowCache(tmpdir)
+    cache.flow(sor.flow, i1, i2)
+    key = cache.key(sor.flow, i1, i2, {})
+    nose.tools.eq_(len(cache.load(key)), 3)
+
+    #an estimation partly removed by another process is a miss
+    path = cache.path(key)
+    os.unlink(os.path.join(path, '2.npy'))
+    nose.tools.eq_(cache.load(key), None)
+    os.unlink(os.path.join(path, 'outputs'))
+    nose.tools.eq_(cache.load(key), None)
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_flow_cache_unsupported():
+  from . import FlowCache
+  import tempfile
+  import shutil
+
+  i1, i2 = load_pair('gray/car')
+  tmpdir = tempfile.mkdtemp()
+  try:
+    cache = FlowCache(tmpdir)
+    for name in ('return_iterations', 'return_pyramid', 'profile'):
+      nose.tools.assert_raises(ValueError, cache.flow, sor.flow, i1, i2,
+          **{name: True})
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_flow_storage():
+  from . import FlowWriter, FlowReader
+  import tempfile
+  import shutil
+
+  i1, i2 = load_pair('gray/car')
+  flows = [sor.flow(i1, i2)[:2], sor.flow(i2, i1)[:2]]
+  attributes = [('method', 'SOR'), ('alpha', 1.0)]
+  tmpdir = tempfile.mkdtemp()
+
+  try:
+    for n, (options, atol) in enumerate([
+        (dict(), 0.),
+        (dict(compression=6), 0.),
+        (dict(dtype='float32', indexed=True), 1e-5),
+        (dict(dtype='float16', indexed=True), 1e-2),
+        (dict(dtype='int16', step=0.01), 0.005),
+        (dict(dtype='int16', step=0.01, indexed=True), 0.005),
+        ]):
+      filename = os.path.join(tmpdir, 'flows%d' % n)
+      writer = FlowWriter(filename, attributes, **options)
+      for u, v in flows: writer.append(u, v)
+      writer.close()
+
+      with FlowReader(filename) as reader:
+        nose.tools.eq_(len(reader), 2)
+        nose.tools.eq_(reader.attributes['method'], 'SOR')
+        nose.tools.eq_(reader.indexed, options.get('indexed', False))
+        expected = numpy.array(flows)
+        assert numpy.allclose(reader.read(), expected, rtol=0, atol=atol)
+        for k in (1, 0, -1):
+          assert numpy.allclose(reader[k], expected[k], rtol=0, atol=atol)
+        nose.tools.assert_raises(IndexError, reader.__getitem__, 2)
+
+    #indexed files are .npy files
+    uv = numpy.load(filename, mmap_mode='r')
+    nose.tools.eq_(uv.dtype, numpy.int16)
+    nose.tools.eq_(uv.shape, (2, 2) + i1.shape)
+
+    #16-bit floats are not supported by HDF5 files, steps are for int16 only
+    nose.tools.assert_raises(ValueError, FlowWriter, filename,
+        dtype='float16')
+    nose.tools.assert_raises(ValueError, FlowWriter, filename, step=0.01)
+    nose.tools.assert_raises(ValueError, FlowWriter, filename,
+        indexed=True, compression=6)
+
+    #HDF5 files cannot be closed without flows, unlike indexed ones
+    filename = os.path.join(tmpdir, 'empty')
+    nose.tools.assert_raises(ValueError, FlowWriter(filename).close)
+    filename = os.path.join(tmpdir, 'empty.npy')
+    FlowWriter(filename, attributes, indexed=True).close()
+    with FlowReader(filename) as reader: nose.tools.eq_(len(reader), 0)
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_cg_multiply_a():
+  from .bench import cg_system
+
+  # the fused kernel must give the same results as the original one, also on
+  # images without interior (or with a single row or column)
+  systems = [cg_system(*load_pair('gray/car'))]
+  numpy.random.seed(0)
+  for shape in ((1, 7), (7, 1), (1, 1), (2, 2), (3, 5)):
+    systems.append([numpy.random.rand(*shape) for k in range(6)])
+
+  for system in systems:
+    fused = cg._multiply_a(*system, alpha=0.02)
+    reference = cg._multiply_a(*system, alpha=0.02, reference=True)
+    assert numpy.array_equal(fused[0], reference[0])
+    assert numpy.array_equal(fused[1], reference[1])
+    nose.tools.eq_(fused[2], reference[2])
+
+def test_bench():
+  from . import bench
+  import tempfile
+  import json
+
+  (fd, out) = tempfile.mkstemp('.json')
+  os.close(fd)
+  del fd
+
+  try:
+    options = ['--methods=sor', '--scales=0.5', '--threads=1', '--repeat=1',
+        '--pairs=1', 'gray/simple']
+    nose.tools.eq_(bench.main(options + ['--output', out]), 0)
+    with open(out, 'rt') as f: report = json.load(f)
+    nose.tools.eq_(len(report['results']), 1)
+    result = report['results'][0]
+    nose.tools.eq_(result['method'], 'sor')
+    i1, i2 = load_pair('gray/simple')
+    nose.tools.eq_(result['shape'], [int(round(0.5*k)) for k in i1.shape])
+    assert result['pairs_per_second'] > 0
+    assert result['peak_rss'] > 0
+    assert result['stages']['total'] > 0
+
+    #a throughput drop of up to 100% is not a regression
+    nose.tools.eq_(bench.main(options + ['--baseline', out, '--tolerance=1',
+      '--output', out]), 0)
+    with open(out, 'rt') as f: report = json.load(f)
+    nose.tools.eq_(len(report['comparison']), 1)
+    assert not report['comparison'][0]['regression']
+
+  finally:
+    os.unlink(out)
+
+def test_sequence_script():
+  from .script import flow
+  import tempfile
+
+  sample = 'gray/car'
+  images = [F(__name__, '%s%d.png' % (sample, k)) for k in (1, 2, 1)]
+  (fd, out) = tempfile.mkstemp('.hdf5')
+  os.close(fd)
+  del fd
+  os.unlink(out)
+
+  try:
+    nose.tools.eq_(flow.main(['sor'] + images + [out]), 0)
+
+    #flows are appended to the output as they are estimated
+    uv = bob.io.base.load(out)
+    i1, i2 = load_pair(sample)
+    nose.tools.eq_(uv.shape, (2, 2) + i1.shape)
+    for k, (f1, f2) in enumerate([(i1, i2), (i2, i1)]):
+      (u, v, wi2) = sor.flow(f1, f2)
+      assert numpy.array_equal(uv[k,0], u)
+      assert numpy.array_equal(uv[k,1], v)
+
+  finally:
+    if os.path.exists(out): os.unlink(out)
+
+def test_pipeline_script():
+  from .script import flow
+  import tempfile
+  import shutil
+
+  sample = 'gray/car'
+  images = [F(__name__, '%s%d.png' % (sample, k)) for k in (1, 2, 1, 2)]
+  tmpdir = tempfile.mkdtemp()
+
+  try:
+    #estimations of all threads are written in order
+    outputs = []
+    for options in (['--prefetch=1'], ['--workers=2', '--prefetch=1'],
+        ['--workers=3']):
+      outputs.append(os.path.join(tmpdir, '%d.hdf5' % len(outputs)))
+      nose.tools.eq_(flow.main(['--verbose', 'sor'] + options + images +
+        [outputs[-1]]), 0)
+
+    i1, i2 = load_pair(sample)
+    (u, v, wi2) = sor.flow(i1, i2)
+    (bu, bv, wi1) = sor.flow(i2, i1)
+    for output in outputs:
+      uv = bob.io.base.load(output)
+      nose.tools.eq_(uv.shape, (3, 2) + i1.shape)
+      for k, (fu, fv) in enumerate([(u, v), (bu, bv), (u, v)]):
+        assert numpy.array_equal(uv[k,0], fu)
+        assert numpy.array_equal(uv[k,1], fv)
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_manifest_script():
+  from .script import flow
+  import tempfile
+  import shutil
+
+  sample = 'gray/car'
+  images = [F(__name__, '%s%d.png' % (sample, k)) for k in (1, 2, 1)]
+  tmpdir = tempfile.mkdtemp()
+
+  try:
+    outputs = [os.path.join(tmpdir, 'out', '%d.hdf5' % k) for k in range(2)]
+    manifest = os.path.join(tmpdir, 'manifest.txt')
+    with open(manifest, 'wt') as f:
+      f.write('# frames, then output\n')
+      f.write(' '.join(images + [outputs[0]]) + '\n\n')
+      f.write(' '.join(images[1:] + [outputs[1]]) + '\n')
+
+    #pairs are spread over worker processes, flows are the same as flow()'s
+    nose.tools.eq_(flow.main(['sor', '--jobs=2', '--manifest', manifest]), 0)
+    i1, i2 = load_pair(sample)
+    pairs = [(i1, i2), (i2, i1)]
+    for k, output in enumerate(outputs):
+      uv = bob.io.base.load(output)
+      nose.tools.eq_(uv.shape, (2-k, 2) + i1.shape)
+      for j, (f1, f2) in enumerate(pairs[k:]):
+        (u, v, wi2) = sor.flow(f1, f2)
+        assert numpy.array_equal(uv[j,0], u)
+        assert numpy.array_equal(uv[j,1], v)
+
+    #complete outputs are skipped when resuming
+    os.unlink(outputs[1])
+    mtime = os.path.getmtime(outputs[0])
+    nose.tools.eq_(flow.main(['sor', '--resume', '--manifest', manifest]), 0)
+    nose.tools.eq_(os.path.getmtime(outputs[0]), mtime)
+    nose.tools.eq_(bob.io.base.load(outputs[1]).shape, (1, 2) + i1.shape)
+
+    #inputs with a single frame have no flows, so their outputs are skipped
+    for output in outputs: os.unlink(output)
+    for options in ([], ['--jobs=2']):
+      nose.tools.eq_(flow.main(['--video-frames=1', 'sor', '--manifest',
+        manifest] + options), 0)
+      nose.tools.eq_(os.listdir(os.path.join(tmpdir, 'out')), [])
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_failed_script():
+  from .script import flow
+  import tempfile
+  import shutil
+
+  #the last frame does not have the shape of the others
+  images = [F(__name__, 'gray/car%d.png' % k) for k in (1, 2)] + \
+      [F(__name__, 'gray/table1.png')]
+  tmpdir = tempfile.mkdtemp()
+
+  try:
+    #the error is raised again and no partial output is left behind
+    output = os.path.join(tmpdir, 'flows.hdf5')
+    for options in ([], ['--workers=2'], ['--jobs=2']):
+      nose.tools.assert_raises(RuntimeError, flow.main, ['sor'] + options +
+          images + [output])
+      nose.tools.eq_(os.listdir(tmpdir), [])
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_compact_script():
+  from .script import flow
+  from . import FlowReader
+  import tempfile
+
+  sample = 'gray/car'
+  images = [F(__name__, '%s%d.png' % (sample, k)) for k in (1, 2, 1)]
+  (fd, out) = tempfile.mkstemp('.npy')
+  os.close(fd)
+  del fd
+  os.unlink(out)
+
+  try:
+    nose.tools.eq_(flow.main(['sor', '--indexed', '--quantize=0.01'] +
+      images + [out]), 0)
+
+    i1, i2 = load_pair(sample)
+    (u, v, wi2) = sor.flow(i2, i1)
+    with FlowReader(out) as reader:
+      nose.tools.eq_(len(reader), 2)
+      nose.tools.eq_(reader.attributes['method'], 'SOR')
+      nose.tools.eq_(reader.step, 0.01)
+      assert numpy.allclose(reader[1], (u, v), rtol=0, atol=0.005)
+
+  finally:
+    if os.path.exists(out): os.unlink(out)
+
 @nose.tools.nottest
 def test_video_script():
   from .script import flow
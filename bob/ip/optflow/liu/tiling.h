@@ -0,0 +1,217 @@
+/**
+ * @date Sun 18 Oct 2026 16:40:12 CEST
+ *
+ * @brief Tiled estimation of the flow of large images (or of a region of
+ * interest), shared by the SOR and CG bindings. All functions in here are
+ * meant to be called without holding the GIL.
+ */
+
+#ifndef BOB_IP_OPTFLOW_LIU_TILING_H
+#define BOB_IP_OPTFLOW_LIU_TILING_H
+
+#include <algorithm>
+#include <cmath>
+#include <mutex>
+#include <vector>
+
+#include "parallel.h"
+
+namespace bob { namespace ip { namespace optflow { namespace liu {
+
+  /**
+   * Returns the smoothing (relative to the full resolution image) of level
+   * ``level`` of a Gaussian pyramid built with ``ratio``, following the
+   * schedule of ``GaussianPyramid::ConstructPyramid()``
+   */
+  inline double pyramid_sigma(double ratio, int level) {
+    double base = 1/ratio - 1;
+    int n = log(0.25)/log(ratio);
+    std::vector<double> sigma(level+1, 0.);
+    for (int i = 1; i <= level; ++i) {
+      if (i <= n) sigma[i] = base*i;
+      else {
+        double s = base*n/pow(ratio, i-n);
+        sigma[i] = sqrt(sigma[i-n]*sigma[i-n] + s*s);
+      }
+    }
+    return sigma[level];
+  }
+
+  /**
+   * Bilinearly interpolates the coarse velocities ``cu`` and ``cv``, estimated
+   * on a downsampled version of a region of ``height x width`` pixels, at the
+   * ``patch`` of that region starting at ``(top, left)``, filling ``u`` and
+   * ``v`` with velocities in pixels of the full resolution region
+   */
+  template <typename TImage>
+  void upsample_flow(TImage& u, TImage& v, const TImage& cu, const TImage& cv,
+      int height, int width, int top, int left, int patchHeight,
+      int patchWidth) {
+
+    const int ch = cu.height(), cw = cu.width();
+    const double sy = (double)ch/height, sx = (double)cw/width;
+    u.allocate(patchWidth, patchHeight);
+    v.allocate(patchWidth, patchHeight);
+
+    for (int y = 0; y < patchHeight; ++y) {
+      double fy = std::min(std::max((top+y+0.5)*sy - 0.5, 0.), ch-1.);
+      int y0 = std::min((int)fy, ch-1), y1 = std::min(y0+1, ch-1);
+      double dy = fy - y0;
+      for (int x = 0; x < patchWidth; ++x) {
+        double fx = std::min(std::max((left+x+0.5)*sx - 0.5, 0.), cw-1.);
+        int x0 = std::min((int)fx, cw-1), x1 = std::min(x0+1, cw-1);
+        double dx = fx - x0;
+        double w00 = (1-dx)*(1-dy), w01 = dx*(1-dy), w10 = (1-dx)*dy, w11 = dx*dy;
+        int k = y*patchWidth + x;
+        u.pData[k] = (w00*cu.pData[y0*cw+x0] + w01*cu.pData[y0*cw+x1] +
+            w10*cu.pData[y1*cw+x0] + w11*cu.pData[y1*cw+x1])/sx;
+        v.pData[k] = (w00*cv.pData[y0*cw+x0] + w01*cv.pData[y0*cw+x1] +
+            w10*cv.pData[y1*cw+x0] + w11*cv.pData[y1*cw+x1])/sy;
+      }
+    }
+  }
+
+  /**
+   * Weight of the pixel at ``x`` of a tile whose core spans ``[begin, end)``,
+   * for blending it with the neighbouring tiles over ``overlap`` pixels on
+   * each side of the seams. ``first`` and ``last`` tell whether the tile has
+   * no neighbour before or after it. The weights of two neighbouring tiles sum
+   * to one
+   */
+  inline double seam_weight(int x, int begin, int end, int overlap,
+      bool first, bool last) {
+    double w = 1.;
+    if (!first) w = std::min(w, overlap ?
+        (x - begin + overlap + 0.5)/(2*overlap) : (x >= begin ? 1. : 0.));
+    if (!last) w = std::min(w, overlap ?
+        (end + overlap - x - 0.5)/(2*overlap) : (x < end ? 1. : 0.));
+    return std::max(w, 0.);
+  }
+
+  /**
+   * Estimates the flow of the region of interest ``(top, left, height,
+   * width)`` of ``Im1`` and ``Im2`` tile by tile, filling ``vx`` and ``vy``
+   * (with the dimensions of the region of interest).
+   *
+   * The region is split into tiles of (at most) ``tileHeight x tileWidth``
+   * pixels. Each tile is estimated with a margin of ``overlap`` pixels (where
+   * available), seeded with a coarse flow of the whole region (computed at
+   * the finest pyramid level that fits in a tile), and blended with its
+   * neighbours over the margins. Tiles are distributed over ``nThreads``
+   * native threads. Tiles are never made narrower than a pyramid of
+   * ``minWidth`` (and ``ratio``) needs. If the region (with its margins) fits
+   * in a single tile, its flow is estimated directly.
+   *
+   * ``estimate(vx, vy, im1, im2, warmStart)`` runs the coarse to fine
+   * estimation of ``im1`` and ``im2``, starting from ``vx`` and ``vy`` if
+   * ``warmStart`` is set.
+   */
+  template <typename TImage, typename Estimate>
+  void tiled_flow(TImage& vx, TImage& vy, const TImage& Im1,
+      const TImage& Im2, int top, int left, int height, int width,
+      int tileHeight, int tileWidth, int overlap, double ratio, int minWidth,
+      int nThreads, Estimate estimate) {
+
+    // the ratio cannot be arbitrary numbers (see GaussianPyramid)
+    if (ratio > 0.98 || ratio < 0.4) ratio = 0.75;
+    const double minSize = minWidth/ratio;
+
+    // the region used for the estimation: the region of interest and its
+    // margins, where available
+    const int r0 = std::max(top-overlap, 0);
+    const int r1 = std::min(top+height+overlap, Im1.height());
+    const int c0 = std::max(left-overlap, 0);
+    const int c1 = std::min(left+width+overlap, Im1.width());
+    const int rh = r1-r0, rw = c1-c0;
+
+    // tiles of even sizes, not narrower than a pyramid needs
+    int ny = (height + tileHeight - 1)/tileHeight;
+    int nx = (width + tileWidth - 1)/tileWidth;
+    nx = std::max(1, std::min(nx, (int)(width/minSize)));
+
+    // the finest pyramid level at which the whole region fits in a tile
+    int level = 0;
+    double scale = 1.;
+    while ((rh*scale > tileHeight || rw*scale > tileWidth) &&
+        (int)(rw*scale*ratio) >= minSize) {
+      ++level;
+      scale *= ratio;
+    }
+
+    vx.allocate(width, height);
+    vy.allocate(width, height);
+
+    TImage region1, region2;
+    const bool whole = (rh == Im1.height() && rw == Im1.width());
+    if (!whole) {
+      Im1.crop(region1, c0, r0, rw, rh);
+      Im2.crop(region2, c0, r0, rw, rh);
+    }
+    const TImage& R1 = whole ? Im1 : region1;
+    const TImage& R2 = whole ? Im2 : region2;
+
+    if (nx*ny == 1 || level == 0) {
+      TImage u, v;
+      estimate(u, v, R1, R2, false);
+      u.crop(vx, left-c0, top-r0, width, height);
+      v.crop(vy, left-c0, top-r0, width, height);
+      return;
+    }
+
+    // the coarse flow of the whole region
+    TImage cu, cv;
+    {
+      TImage coarse1, coarse2, temp;
+      double sigma = pyramid_sigma(ratio, level);
+      int cw = std::max(1, (int)(rw*scale)), ch = std::max(1, (int)(rh*scale));
+      R1.GaussianSmoothingResize(coarse1, sigma, sigma*3, cw, ch, temp);
+      R2.GaussianSmoothingResize(coarse2, sigma, sigma*3, cw, ch, temp);
+      region1.clear();
+      region2.clear();
+      estimate(cu, cv, coarse1, coarse2, false);
+    }
+
+    // the flow of every tile, blended into the output
+    std::vector<double> weights((size_t)width*height, 0.);
+    std::mutex mutex;
+
+    parallel_for(nx*ny, nThreads, [&](int k) {
+        const int ty = k/nx, tx = k%nx;
+        const int y0 = top + (height*ty)/ny, y1 = top + (height*(ty+1))/ny;
+        const int x0 = left + (width*tx)/nx, x1 = left + (width*(tx+1))/nx;
+        const int p0 = std::max(y0-overlap, 0);
+        const int p1 = std::min(y1+overlap, Im1.height());
+        const int q0 = std::max(x0-overlap, 0);
+        const int q1 = std::min(x1+overlap, Im1.width());
+
+        TImage t1, t2, u, v;
+        Im1.crop(t1, q0, p0, q1-q0, p1-p0);
+        Im2.crop(t2, q0, p0, q1-q0, p1-p0);
+        upsample_flow(u, v, cu, cv, rh, rw, p0-r0, q0-c0, p1-p0, q1-q0);
+        estimate(u, v, t1, t2, true);
+
+        std::lock_guard<std::mutex> lock(mutex);
+        for (int y = std::max(p0, top); y < std::min(p1, top+height); ++y) {
+          double wy = seam_weight(y, y0, y1, overlap, ty == 0, ty == ny-1);
+          if (wy <= 0.) continue;
+          for (int x = std::max(q0, left); x < std::min(q1, left+width); ++x) {
+            double w = wy*seam_weight(x, x0, x1, overlap, tx == 0, tx == nx-1);
+            if (w <= 0.) continue;
+            size_t o = (size_t)(y-top)*width + (x-left);
+            size_t i = (size_t)(y-p0)*(q1-q0) + (x-q0);
+            vx.pData[o] += w*u.pData[i];
+            vy.pData[o] += w*v.pData[i];
+            weights[o] += w;
+          }
+        }
+        });
+
+    for (size_t o = 0; o < weights.size(); ++o) {
+      vx.pData[o] /= weights[o];
+      vy.pData[o] /= weights[o];
+    }
+  }
+
+}}}}
+
+#endif /* BOB_IP_OPTFLOW_LIU_TILING_H */